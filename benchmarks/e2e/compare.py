@@ -0,0 +1,82 @@
+"""对比两次 run.py 的结果文件，按 (service, mode, concurrency) 输出关键指标的变化。
+
+示例：
+    python benchmarks/e2e/compare.py baseline.json current.json --threshold 10 --fail-on-regression
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+
+# (指标路径, 数值越大越好)
+METRICS = [
+    (("throughput_rps",), True),
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p95"), False),
+    (("latency_ms", "p99"), False),
+    (("ttfe_ms", "p95"), False),
+    (("peak_rss_mb",), False),
+]
+
+
+def _load(path: Path) -> dict[tuple, dict]:
+    data = json.loads(path.read_text())
+    return {(r["service"], r["mode"], r["concurrency"]): r for r in data.get("results", [])}
+
+
+def _get(row: dict, path: tuple[str, ...]) -> float | None:
+    value = row
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, (int, float)) else None
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="对比两次端到端压测结果")
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("current", type=Path)
+    parser.add_argument("--threshold", type=float, default=10.0, help="变差超过该百分比视为回退")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    base = _load(args.baseline)
+    cur = _load(args.current)
+    regressions: list[str] = []
+    for key in sorted(set(base) & set(cur)):
+        service, mode, concurrency = key
+        cells = []
+        for path, higher_is_better in METRICS:
+            old, new = _get(base[key], path), _get(cur[key], path)
+            name = ".".join(path)
+            if old is None or new is None or old == 0:
+                cells.append(f"{name}={new}")
+                continue
+            change = (new - old) / old * 100.0
+            worse = -change if higher_is_better else change
+            mark = ""
+            if worse > args.threshold:
+                mark = " !"
+                regressions.append(f"{service}/{mode}/c={concurrency} {name}: {old} -> {new} ({change:+.1f}%)")
+            cells.append(f"{name}={old}->{new} ({change:+.1f}%){mark}")
+        print(f"{service:<8} {mode:<6} c={concurrency:<3} " + "  ".join(cells))
+        if cur[key]["ok"] < cur[key]["requests"]:
+            regressions.append(f"{service}/{mode}/c={concurrency} 失败请求 {cur[key]['requests'] - cur[key]['ok']} 个：{cur[key]['errors']}")
+
+    missing = sorted(set(base) - set(cur))
+    if missing:
+        print("当前结果缺少：" + ", ".join(f"{s}/{m}/c={c}" for s, m, c in missing))
+    if regressions:
+        print(f"\n超过 {args.threshold:.0f}% 的回退：")
+        for line in regressions:
+            print("  " + line)
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""本地替身：Loki、Prometheus 与 OpenAI 兼容的流式 LLM，供端到端压测使用。
+
+三者挂在同一个 FastAPI 应用上（Loki 走 /loki/api/v1/*，Prometheus 走 /api/v1/*，LLM 走 /v1/chat/completions），
+延迟与响应大小通过 FAKE_* 环境变量配置，由 run.py 启动时注入。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+LOKI_LATENCY_MS = _env_float("FAKE_LOKI_LATENCY_MS", 80.0)
+LOKI_LINES = _env_int("FAKE_LOKI_LINES", 200)
+LOKI_STREAMS = _env_int("FAKE_LOKI_STREAMS", 4)
+LOKI_LINE_BYTES = _env_int("FAKE_LOKI_LINE_BYTES", 200)
+LOKI_SERVICES = _env_int("FAKE_LOKI_SERVICES", 8)
+PROM_LATENCY_MS = _env_float("FAKE_PROM_LATENCY_MS", 40.0)
+PROM_SERIES = _env_int("FAKE_PROM_SERIES", 4)
+PROM_MAX_POINTS = _env_int("FAKE_PROM_MAX_POINTS", 720)
+LLM_TTFT_MS = _env_float("FAKE_LLM_TTFT_MS", 400.0)
+LLM_TOKEN_MS = _env_float("FAKE_LLM_TOKEN_MS", 15.0)
+LLM_CHUNK_CHARS = _env_int("FAKE_LLM_CHUNK_CHARS", 8)
+LLM_TOOL_ROUNDS = _env_int("FAKE_LLM_TOOL_ROUNDS", 2)
+JITTER = _env_float("FAKE_JITTER", 0.2)
+SEED = _env_int("FAKE_SEED", 7)
+
+app = FastAPI(title="Aegis benchmark fakes")
+_rng = random.Random(SEED)
+_counters: dict[str, int] = {}
+
+_LEVELS = ["ERROR", "WARN", "INFO", "ERROR", "ERROR"]
+_MESSAGES = [
+    "request failed: upstream connect error or disconnect/reset before headers, status=503",
+    "db query timeout after 5000ms on table todos, retrying",
+    "authentication failed for user id={uid}: invalid token",
+    "panic: runtime error: invalid memory address or nil pointer dereference",
+    "GET /api/todos/{uid} 500 in {ms}ms",
+    "connection refused to redis:6379",
+]
+
+
+async def _delay(base_ms: float) -> None:
+    if base_ms <= 0:
+        return
+    spread = base_ms * JITTER
+    await asyncio.sleep(max(0.0, _rng.uniform(base_ms - spread, base_ms + spread)) / 1000.0)
+
+
+def _count(name: str) -> None:
+    _counters[name] = _counters.get(name, 0) + 1
+
+
+def _service_names() -> list[str]:
+    base = ["todo-api", "user-service", "auth-service", "ai-service", "gateway", "notify-worker", "redis", "postgres"]
+    return [base[i % len(base)] + ("" if i < len(base) else f"-{i // len(base)}") for i in range(LOKI_SERVICES)]
+
+
+def _log_line(i: int) -> str:
+    msg = _MESSAGES[i % len(_MESSAGES)].format(uid=1000 + i * 7 % 997, ms=50 + i * 13 % 4000)
+    line = f"{_LEVELS[i % len(_LEVELS)]} {msg}"
+    if len(line) < LOKI_LINE_BYTES:
+        line += " ctx=" + "x" * (LOKI_LINE_BYTES - len(line) - 5)
+    return line[:LOKI_LINE_BYTES]
+
+
+def _seconds(value: str | None, default: float) -> float:
+    """解析 Unix 秒/纳秒或 RFC3339 时间戳（Loki、Prometheus 都接受这几种写法）。"""
+    if not value:
+        return default
+    try:
+        number = float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    return number / 1e9 if number > 1e12 else number
+
+
+def _step_seconds(step: str | None) -> float:
+    step = (step or "60").strip()
+    if step[-1] in "smh":
+        return float(step[:-1]) * {"s": 1, "m": 60, "h": 3600}[step[-1]]
+    return float(step)
+
+
+def _ns_range(params) -> tuple[int, int]:
+    now = time.time()
+    start = int(_seconds(params.get("start"), now - 3600) * 1e9)
+    end = int(_seconds(params.get("end"), now) * 1e9)
+    return start, max(end, start + 1)
+
+
+def _matrix(series: int, start_s: float, end_s: float, step_s: float, label_key: str) -> list[dict]:
+    step_s = max(step_s, 1.0)
+    points = max(1, min(PROM_MAX_POINTS, int((end_s - start_s) / step_s) + 1))
+    result = []
+    for s in range(series):
+        base = 1.0 + s
+        values = [[start_s + i * step_s, f"{base + 0.3 * ((i * 7 + s) % 11):.4f}"] for i in range(points)]
+        result.append({"metric": {label_key: _service_names()[s % LOKI_SERVICES]}, "values": values})
+    return result
+
+
+def _is_metric_query(query: str) -> bool:
+    return bool(re.search(r"\b(count_over_time|rate|bytes_rate|sum|topk)\s*\(", query or ""))
+
+
+@app.get("/loki/api/v1/labels")
+async def loki_labels():
+    _count("loki.labels")
+    await _delay(LOKI_LATENCY_MS)
+    return {"status": "success", "data": ["app", "namespace", "pod", "level"]}
+
+
+@app.get("/loki/api/v1/label/{label}/values")
+async def loki_label_values(label: str):
+    _count("loki.label_values")
+    await _delay(LOKI_LATENCY_MS)
+    return {"status": "success", "data": _service_names()}
+
+
+@app.get("/loki/api/v1/query_range")
+async def loki_query_range(request: Request):
+    _count("loki.query_range")
+    params = request.query_params
+    await _delay(LOKI_LATENCY_MS)
+    start, end = _ns_range(params)
+    query = params.get("query", "")
+    if _is_metric_query(query):
+        step_s = _step_seconds(params.get("step"))
+        data = {"resultType": "matrix", "result": _matrix(PROM_SERIES, start / 1e9, end / 1e9, step_s, "app")}
+        return {"status": "success", "data": data}
+    limit = min(int(params.get("limit") or LOKI_LINES), LOKI_LINES)
+    streams = max(1, LOKI_STREAMS)
+    span = end - start
+    result = []
+    for s in range(streams):
+        count = limit // streams + (1 if s < limit % streams else 0)
+        values = [[str(end - (i * streams + s) * span // max(limit, 1)), _log_line(i * streams + s)] for i in range(count)]
+        result.append({"stream": {"app": _service_names()[s % LOKI_SERVICES], "level": "error"}, "values": values})
+    return {"status": "success", "data": {"resultType": "streams", "result": result}}
+
+
+@app.get("/loki/api/v1/query")
+async def loki_query(request: Request):
+    _count("loki.query")
+    await _delay(LOKI_LATENCY_MS)
+    now = time.time()
+    result = [{"metric": {"app": name}, "value": [now, str(3 + i)]} for i, name in enumerate(_service_names()[:PROM_SERIES])]
+    return {"status": "success", "data": {"resultType": "vector", "result": result}}
+
+
+@app.get("/api/v1/query_range")
+async def prometheus_query_range(request: Request):
+    _count("prometheus.query_range")
+    params = request.query_params
+    await _delay(PROM_LATENCY_MS)
+    start = _seconds(params.get("start"), time.time() - 3600)
+    end = _seconds(params.get("end"), time.time())
+    data = {"resultType": "matrix", "result": _matrix(PROM_SERIES, start, end, _step_seconds(params.get("step")), "service")}
+    return {"status": "success", "data": data}
+
+
+@app.get("/api/v1/query")
+async def prometheus_query(request: Request):
+    _count("prometheus.query")
+    await _delay(PROM_LATENCY_MS)
+    now = time.time()
+    result = [{"metric": {"service": name}, "value": [now, str(0.5 + i)]} for i, name in enumerate(_service_names()[:PROM_SERIES])]
+    return {"status": "success", "data": {"resultType": "vector", "result": result}}
+
+
+@app.get("/stats")
+async def stats():
+    return {"requests": dict(sorted(_counters.items()))}
+
+
+# ---- LLM ----
+
+_RCA_ANSWER = {
+    "summary": "todo-api 在故障窗口内大量 503，上游 postgres 查询超时导致连接池耗尽。",
+    "suspected_service": "todo-api",
+    "root_cause": "postgres 慢查询拖满连接池，todo-api 请求排队超时。",
+    "evidence": ["db query timeout after 5000ms on table todos", "GET /api/todos 500"],
+    "suggested_actions": ["为 todos 表补充索引", "调小连接池获取超时并增加熔断"],
+}
+_PREDICT_ANSWER = {
+    "risk_score": 0.42,
+    "risk_level": "medium",
+    "likely_failures": ["数据库连接池耗尽", "上游 503"],
+    "explanation": "错误日志计数近 6 小时持续上升，P95 延迟同步抬升。",
+}
+_CHATOPS_ANSWER = "最近 30 分钟 todo-api 的 5xx 主要集中在 /api/todos，错误率约 2.3%，与 postgres 查询超时同时出现。"
+
+
+def _window() -> tuple[str, str]:
+    end = datetime.now(timezone.utc)
+    return (end - timedelta(minutes=30)).isoformat(), end.isoformat()
+
+
+def _tool_plan(tool_names: set[str], text: str) -> list[tuple[str, dict]]:
+    start_iso, end_iso = _window()
+    calls: list[tuple[str, dict]] = []
+    if "rca_collect_evidence" in tool_names:
+        calls.append(("rca_collect_evidence", {"start_iso": start_iso, "end_iso": end_iso}))
+    if "predict_collect_features" in tool_names:
+        m = re.search(r"服务：(\S+)", text)
+        calls.append(("predict_collect_features", {"service_name": m.group(1) if m else "todo-api", "lookback_hours": 6}))
+    if "loki_query_range_lines" in tool_names:
+        logql = '{app="todo-api"} |~ "(?i)error|exception"'
+        calls.append(("loki_query_range_lines", {"logql": logql, "start_iso": start_iso, "end_iso": end_iso, "limit": 200}))
+    if "prometheus_query_range" in tool_names:
+        promql = 'sum(rate(http_requests_total{service="todo-api",status=~"5.."}[5m]))'
+        calls.append(("prometheus_query_range", {"promql": promql, "start_iso": start_iso, "end_iso": end_iso, "step": "60s"}))
+    return calls
+
+
+def _final_answer(tool_names: set[str], text: str) -> str:
+    if "rca_collect_evidence" in tool_names or "suspected_service" in text:
+        return json.dumps(_RCA_ANSWER, ensure_ascii=False)
+    if "predict_collect_features" in tool_names or "risk_score" in text:
+        return json.dumps(_PREDICT_ANSWER, ensure_ascii=False)
+    return _CHATOPS_ANSWER
+
+
+def _structured_answer(schema_name: str) -> str:
+    if schema_name == "RCAOutput":
+        return json.dumps(_RCA_ANSWER, ensure_ascii=False)
+    if schema_name == "LikelyFailures":
+        return json.dumps(_PREDICT_ANSWER, ensure_ascii=False)
+    return json.dumps({"summary": _CHATOPS_ANSWER}, ensure_ascii=False)
+
+
+def _plan(body: dict) -> tuple[str, list[tuple[str, dict]]]:
+    """按请求内容决定本轮回复：前 LLM_TOOL_ROUNDS 轮调用工具，之后给出最终答案；结构化输出请求直接返回对应 JSON。"""
+    messages = body.get("messages") or []
+    text = "\n".join(str(m.get("content") or "") for m in messages if isinstance(m, dict))
+    tools = body.get("tools") or []
+    tool_names = {t.get("function", {}).get("name") for t in tools if isinstance(t, dict)}
+    choice = body.get("tool_choice")
+    if isinstance(choice, dict) and choice.get("function", {}).get("name"):
+        name = choice["function"]["name"]
+        return "", [(name, json.loads(_structured_answer(name)))]
+    fmt = body.get("response_format") or {}
+    if fmt.get("type") == "json_schema":
+        return _structured_answer(fmt.get("json_schema", {}).get("name", "")), []
+    rounds = sum(1 for m in messages if isinstance(m, dict) and m.get("role") == "assistant" and m.get("tool_calls"))
+    if tool_names and rounds < LLM_TOOL_ROUNDS:
+        calls = _tool_plan(tool_names, text)
+        if calls:
+            return "", calls
+    return _final_answer(tool_names, text), []
+
+
+def _usage(body: dict, completion: str, calls: list) -> dict:
+    prompt = sum(len(str(m.get("content") or "")) for m in body.get("messages") or [] if isinstance(m, dict)) // 2
+    out = (len(completion) + sum(len(json.dumps(a)) for _, a in calls)) // 2
+    return {"prompt_tokens": prompt, "completion_tokens": out, "total_tokens": prompt + out}
+
+
+def _chunk(cid: str, model: str, delta: dict, finish: str | None = None) -> str:
+    payload = {
+        "id": cid,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+    }
+    return "data: " + json.dumps(payload, ensure_ascii=False) + "\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    _count("llm.chat_completions")
+    body = await request.json()
+    model = body.get("model") or "fake"
+    content, calls = _plan(body)
+    usage = _usage(body, content, calls)
+    cid = "chatcmpl-" + uuid.uuid4().hex
+    tool_calls = [
+        {"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function", "function": {"name": name, "arguments": json.dumps(args, ensure_ascii=False)}}
+        for name, args in calls
+    ]
+    finish = "tool_calls" if tool_calls else "stop"
+
+    if not body.get("stream"):
+        await _delay(LLM_TTFT_MS + LLM_TOKEN_MS * max(1, len(content) // max(1, LLM_CHUNK_CHARS)))
+        message = {"role": "assistant", "content": content or None}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        return JSONResponse(
+            {
+                "id": cid,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+                "usage": usage,
+            }
+        )
+
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+    async def events():
+        await _delay(LLM_TTFT_MS)
+        yield _chunk(cid, model, {"role": "assistant", "content": ""})
+        for i in range(0, len(content), max(1, LLM_CHUNK_CHARS)):
+            yield _chunk(cid, model, {"content": content[i : i + LLM_CHUNK_CHARS]})
+            await _delay(LLM_TOKEN_MS)
+        for index, call in enumerate(tool_calls):
+            yield _chunk(cid, model, {"tool_calls": [{"index": index, **call}]})
+            await _delay(LLM_TOKEN_MS)
+        yield _chunk(cid, model, {}, finish)
+        if include_usage:
+            payload = {"id": cid, "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": [], "usage": usage}
+            yield "data: " + json.dumps(payload) + "\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
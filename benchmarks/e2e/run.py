@@ -0,0 +1,310 @@
+"""端到端压测：启动本地替身（fakes.py）与待测服务，按给定并发驱动同步/流式接口，输出延迟分位数、吞吐、首事件延迟与峰值 RSS。
+
+示例：
+    python benchmarks/e2e/run.py --services chatops,rca,predict --modes sync,stream \
+        --concurrency 1,4,16 --requests 40 --output bench-e2e.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterator
+
+import httpx
+
+
+HERE = Path(__file__).resolve().parent
+REPO = HERE.parent.parent
+SERVICES_DIR = REPO / "services"
+
+ENDPOINTS = {
+    "chatops": "/api/chatops/query",
+    "rca": "/api/rca/analyze",
+    "predict": "/api/predict/run",
+}
+
+
+def _request_body(service: str) -> dict:
+    if service == "chatops":
+        return {"question": "最近 30 分钟 todo-api 有没有 5xx？主要是哪些接口？", "time_range": {"last_minutes": 30}}
+    if service == "rca":
+        end = datetime.now(timezone.utc)
+        return {
+            "description": "todo-api 大量 503，用户无法加载待办列表。",
+            "time_range": {"start": (end - timedelta(minutes=30)).isoformat(), "end": end.isoformat()},
+        }
+    return {"service_name": "todo-api", "lookback_hours": 6}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _peak_rss_mb(pid: int) -> float | None:
+    """读取 /proc/<pid>/status 中的 VmHWM（进程启动以来的 RSS 峰值）；非 Linux 平台返回 None。"""
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return round(int(line.split()[1]) / 1024.0, 1)
+    except OSError:
+        return None
+    return None
+
+
+def _wait_healthy(url: str, proc: subprocess.Popen, timeout_s: float) -> None:
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} 进程提前退出，退出码 {proc.returncode}")
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} 在 {timeout_s:.0f}s 内未就绪")
+
+
+@contextlib.contextmanager
+def _serve(app: str, cwd: Path, env: dict, health_path: str, log_path: Path) -> Iterator[tuple[str, subprocess.Popen]]:
+    port = _free_port()
+    cmd = [
+        sys.executable, "-m", "uvicorn", app,
+        "--host", "127.0.0.1", "--port", str(port),
+        "--log-level", "warning", "--no-access-log",
+    ]
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with log_path.open("wb") as log:
+        proc = subprocess.Popen(cmd, cwd=cwd, env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT)
+        base = f"http://127.0.0.1:{port}"
+        try:
+            _wait_healthy(base + health_path, proc, 60.0)
+            yield base, proc
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def _fake_env(args: argparse.Namespace) -> dict[str, str]:
+    return {
+        "FAKE_LOKI_LATENCY_MS": str(args.loki_latency_ms),
+        "FAKE_LOKI_LINES": str(args.loki_lines),
+        "FAKE_LOKI_LINE_BYTES": str(args.loki_line_bytes),
+        "FAKE_PROM_LATENCY_MS": str(args.prom_latency_ms),
+        "FAKE_PROM_SERIES": str(args.prom_series),
+        "FAKE_LLM_TTFT_MS": str(args.llm_ttft_ms),
+        "FAKE_LLM_TOKEN_MS": str(args.llm_token_ms),
+        "FAKE_LLM_TOOL_ROUNDS": str(args.llm_tool_rounds),
+        "FAKE_JITTER": str(args.jitter),
+    }
+
+
+def _service_env(fakes_url: str, extra: list[str]) -> dict[str, str]:
+    env = {
+        "LOKI_BASE_URL": fakes_url,
+        "PROMETHEUS_BASE_URL": fakes_url,
+        "ARK_BASE_URL": fakes_url + "/v1",
+        "ARK_API_KEY": "benchmark",
+        "LLM_MODEL": "fake-model",
+        "SESSION_BACKEND": "memory",
+    }
+    for item in extra:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+def _percentiles(values: list[float]) -> dict | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def at(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))] * 1000.0, 1)
+
+    return {
+        "p50": at(0.50),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "mean": round(sum(ordered) / len(ordered) * 1000.0, 1),
+        "max": round(ordered[-1] * 1000.0, 1),
+    }
+
+
+async def _one(client: httpx.AsyncClient, url: str, body: dict, stream: bool) -> dict:
+    started = time.perf_counter()
+    sample: dict = {"ok": False, "status": None, "error": None, "ttfe": None, "first_token": None}
+    try:
+        if stream:
+            async with client.stream("POST", url, json=body) as r:
+                sample["status"] = r.status_code
+                async for line in r.aiter_lines():
+                    if not line.strip():
+                        continue
+                    now = time.perf_counter() - started
+                    if sample["ttfe"] is None:
+                        sample["ttfe"] = now
+                    event = json.loads(line).get("event")
+                    if event == "llm_token" and sample["first_token"] is None:
+                        sample["first_token"] = now
+                    elif event == "final":
+                        sample["ok"] = True
+                    elif event == "error":
+                        sample["error"] = "stream_error"
+        else:
+            r = await client.post(url, json=body)
+            sample["status"] = r.status_code
+            sample["ok"] = r.status_code == 200
+        if not sample["ok"] and sample["error"] is None:
+            sample["error"] = f"http_{sample['status']}"
+    except Exception as exc:
+        sample["error"] = type(exc).__name__
+    sample["latency"] = time.perf_counter() - started
+    return sample
+
+
+async def _drive(base: str, service: str, stream: bool, concurrency: int, total: int, timeout_s: float) -> tuple[list[dict], float]:
+    url = base + ENDPOINTS[service] + ("/stream" if stream else "")
+    samples: list[dict] = []
+    pending = iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout_s, limits=limits) as client:
+
+        async def worker() -> None:
+            for _ in pending:
+                samples.append(await _one(client, url, _request_body(service), stream))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return samples, time.perf_counter() - started
+
+
+def _summarize(service: str, mode: str, concurrency: int, samples: list[dict], wall_s: float, rss_mb: float | None) -> dict:
+    ok = [s for s in samples if s["ok"]]
+    errors: dict[str, int] = {}
+    for s in samples:
+        if not s["ok"]:
+            errors[s["error"]] = errors.get(s["error"], 0) + 1
+    return {
+        "service": service,
+        "mode": mode,
+        "endpoint": ENDPOINTS[service] + ("/stream" if mode == "stream" else ""),
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": errors,
+        "wall_s": round(wall_s, 3),
+        "throughput_rps": round(len(ok) / wall_s, 3) if wall_s > 0 else None,
+        "latency_ms": _percentiles([s["latency"] for s in ok]),
+        "ttfe_ms": _percentiles([s["ttfe"] for s in ok if s["ttfe"] is not None]),
+        "first_token_ms": _percentiles([s["first_token"] for s in ok if s["first_token"] is not None]),
+        "peak_rss_mb": rss_mb,
+    }
+
+
+def _print_row(row: dict) -> None:
+    lat = row["latency_ms"] or {}
+    ttfe = row["ttfe_ms"] or {}
+    print(
+        f"{row['service']:<8} {row['mode']:<6} c={row['concurrency']:<3} ok={row['ok']}/{row['requests']:<4} "
+        f"rps={row['throughput_rps'] or 0:<7} p50={lat.get('p50')} p95={lat.get('p95')} p99={lat.get('p99')} "
+        f"ttfe_p50={ttfe.get('p50')} rss={row['peak_rss_mb']}MB",
+        flush=True,
+    )
+
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def _csv(value: str) -> list[str]:
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Aegis 三个服务的端到端压测")
+    parser.add_argument("--services", type=_csv, default=["chatops", "rca", "predict"])
+    parser.add_argument("--modes", type=_csv, default=["sync", "stream"], help="sync 和/或 stream")
+    parser.add_argument("--concurrency", type=lambda v: [int(x) for x in _csv(v)], default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="每个并发档位的请求数")
+    parser.add_argument("--warmup", type=int, default=2, help="每个服务正式压测前的预热请求数")
+    parser.add_argument("--timeout-s", type=float, default=180.0)
+    parser.add_argument("--loki-latency-ms", type=float, default=80.0)
+    parser.add_argument("--loki-lines", type=int, default=200, help="Loki 单次查询返回的最大日志行数")
+    parser.add_argument("--loki-line-bytes", type=int, default=200)
+    parser.add_argument("--prom-latency-ms", type=float, default=40.0)
+    parser.add_argument("--prom-series", type=int, default=4)
+    parser.add_argument("--llm-ttft-ms", type=float, default=400.0)
+    parser.add_argument("--llm-token-ms", type=float, default=15.0)
+    parser.add_argument("--llm-tool-rounds", type=int, default=2, help="最终回答之前的工具调用轮数")
+    parser.add_argument("--jitter", type=float, default=0.2, help="替身延迟的相对抖动幅度")
+    parser.add_argument("--env", action="append", default=[], help="额外传给服务进程的环境变量 KEY=VALUE，可重复")
+    parser.add_argument("--output", type=Path, default=None, help="结果 JSON 路径")
+    parser.add_argument("--log-dir", type=Path, default=Path(tempfile.gettempdir()) / "aegis-bench", help="替身与服务进程的输出日志目录")
+    args = parser.parse_args(argv)
+
+    unknown = [s for s in args.services if s not in ENDPOINTS]
+    if unknown:
+        parser.error(f"未知服务：{', '.join(unknown)}")
+
+    report: dict = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items()},
+        },
+        "results": [],
+    }
+    print(f"进程日志目录：{args.log_dir}")
+    with _serve("fakes:app", HERE, _fake_env(args), "/stats", args.log_dir / "fakes.log") as (fakes_url, _):
+        for service in args.services:
+            env = _service_env(fakes_url, args.env)
+            service_dir = SERVICES_DIR / f"{service}-service"
+            with _serve("app.main:app", service_dir, env, "/healthz", args.log_dir / f"{service}.log") as (base, proc):
+                if args.warmup:
+                    asyncio.run(_drive(base, service, False, 1, args.warmup, args.timeout_s))
+                for mode in args.modes:
+                    for concurrency in args.concurrency:
+                        samples, wall_s = asyncio.run(
+                            _drive(base, service, mode == "stream", concurrency, args.requests, args.timeout_s)
+                        )
+                        row = _summarize(service, mode, concurrency, samples, wall_s, _peak_rss_mb(proc.pid))
+                        report["results"].append(row)
+                        _print_row(row)
+        report["upstream_requests"] = httpx.get(fakes_url + "/stats", timeout=5.0).json()["requests"]
+    report["meta"]["finished_at"] = datetime.now(timezone.utc).isoformat()
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f"结果已写入 {args.output}")
+    return 0 if all(r["ok"] == r["requests"] for r in report["results"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
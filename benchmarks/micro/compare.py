@@ -0,0 +1,67 @@
+"""对比两次 micro/run.py 的结果文件，按 (service, case, size) 输出 ops/sec 与内存分配的变化。
+
+示例：
+    python benchmarks/micro/compare.py baseline.json current.json --threshold 10 --fail-on-regression
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+
+# (指标, 数值越大越好)
+METRICS = [
+    ("ops_per_s", True),
+    ("peak_alloc_kib", False),
+    ("retained_blocks", False),
+]
+
+
+def _load(path: Path) -> dict[tuple, dict]:
+    data = json.loads(path.read_text())
+    return {(r["service"], r["case"], r["size"]): r for r in data.get("results", [])}
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="对比两次微基准结果")
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("current", type=Path)
+    parser.add_argument("--threshold", type=float, default=10.0, help="变差超过该百分比视为回退")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    base = _load(args.baseline)
+    cur = _load(args.current)
+    regressions: list[str] = []
+    for key in sorted(set(base) & set(cur)):
+        service, case, size = key
+        cells = []
+        for name, higher_is_better in METRICS:
+            old, new = base[key].get(name), cur[key].get(name)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or old == 0:
+                cells.append(f"{name}={new}")
+                continue
+            change = (new - old) / old * 100.0
+            worse = -change if higher_is_better else change
+            mark = ""
+            if worse > args.threshold:
+                mark = " !"
+                regressions.append(f"{service}/{case}/{size} {name}: {old} -> {new} ({change:+.1f}%)")
+            cells.append(f"{name}={old}->{new} ({change:+.1f}%){mark}")
+        print(f"{service:<8} {case:<24} {size:<6} " + "  ".join(cells))
+
+    missing = sorted(set(base) - set(cur))
+    if missing:
+        print("当前结果缺少：" + ", ".join(f"{s}/{c}/{n}" for s, c, n in missing))
+    if regressions:
+        print(f"\n超过 {args.threshold:.0f}% 的回退：")
+        for line in regressions:
+            print("  " + line)
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
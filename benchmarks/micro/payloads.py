@@ -0,0 +1,121 @@
+"""微基准用的合成负载：与 Loki / Prometheus 真实响应同构，规模可控，结果可复现（固定随机种子）。"""
+
+from __future__ import annotations
+
+import json
+import random
+import time
+
+SERVICES = ["todo-api", "user-service", "auth-service", "gateway", "notification", "billing", "search", "frontend"]
+_LEVELS = ["ERROR", "WARN", "ERROR", "ERROR", "FATAL"]
+_TEMPLATES = [
+    'request failed path=/api/todos/{id} status={status} latency_ms={ms} trace_id={trace}',
+    'java.lang.IllegalStateException: connection refused to {host}:5432 after {ms}ms',
+    'login failed for user=user{id} reason="invalid password" ip=10.0.{a}.{b}',
+    'upstream timeout calling {host} elapsed={ms}ms retry={retry}',
+    'panic: runtime error: index out of range [{id}] with length {retry}',
+    'unauthorized: token expired sub=user{id} iat={trace}',
+]
+
+
+def _line(rng: random.Random, line_bytes: int) -> str:
+    text = rng.choice(_LEVELS) + " " + rng.choice(_TEMPLATES).format(
+        id=rng.randint(1, 50_000),
+        status=rng.choice([401, 403, 500, 502, 503, 504]),
+        ms=rng.randint(1, 30_000),
+        trace=f"{rng.getrandbits(64):016x}",
+        host=rng.choice(SERVICES),
+        a=rng.randint(0, 255),
+        b=rng.randint(0, 255),
+        retry=rng.randint(0, 5),
+    )
+    if len(text) < line_bytes:
+        text += " " + "x" * (line_bytes - len(text) - 1)
+    return text[:line_bytes]
+
+
+def loki_streams(
+    lines: int,
+    streams: int = 8,
+    line_bytes: int = 200,
+    window_s: float = 6 * 3600,
+    duplicate_ratio: float = 0.0,
+    end_ns: int | None = None,
+    seed: int = 1,
+) -> dict:
+    """/loki/api/v1/query_range 的 streams 响应；行均匀分布到 streams 个流，时间戳落在 [end - window_s, end]。
+
+    duplicate_ratio 控制重复日志内容的比例（模拟重试风暴中刷屏的同一条错误）。
+    """
+    rng = random.Random(seed)
+    end_ns = end_ns or time.time_ns()
+    start_ns = end_ns - int(window_s * 1e9)
+    streams = max(1, min(streams, lines or 1))
+    pool: list[str] = []
+    result = []
+    for s in range(streams):
+        count = lines // streams + (1 if s < lines % streams else 0)
+        values = []
+        for _ in range(count):
+            if pool and rng.random() < duplicate_ratio:
+                text = rng.choice(pool)
+            else:
+                text = _line(rng, line_bytes)
+                if len(pool) < 64:
+                    pool.append(text)
+            values.append([str(rng.randint(start_ns, end_ns)), text])
+        values.sort(key=lambda v: v[0], reverse=True)
+        result.append(
+            {
+                "stream": {
+                    "service_name": SERVICES[s % len(SERVICES)],
+                    "namespace": "todo",
+                    "pod": f"{SERVICES[s % len(SERVICES)]}-{s:02d}-7c9f8",
+                    "level": "error",
+                },
+                "values": values,
+            }
+        )
+    return {"status": "success", "data": {"resultType": "streams", "result": result}}
+
+
+def prometheus_matrix(series: int, points: int = 360, step_s: int = 60, end_s: float | None = None, seed: int = 1) -> dict:
+    """/api/v1/query_range 的 matrix 响应：series 条序列，每条 points 个点。"""
+    rng = random.Random(seed)
+    end_s = int(end_s or time.time())
+    start_s = end_s - (points - 1) * step_s
+    result = []
+    for i in range(series):
+        base = rng.uniform(0.1, 50.0)
+        result.append(
+            {
+                "metric": {
+                    "__name__": "http_requests_total",
+                    "service": SERVICES[i % len(SERVICES)],
+                    "instance": f"10.0.{i // 250}.{i % 250}:8080",
+                    "status": rng.choice(["200", "401", "500"]),
+                },
+                "values": [[start_s + k * step_s, f"{base * (1 + 0.2 * rng.random()):.6g}"] for k in range(points)],
+            }
+        )
+    return {"status": "success", "data": {"resultType": "matrix", "result": result}}
+
+
+def agent_steps(lines: int, steps: int = 4, seed: int = 1) -> list[tuple]:
+    """AgentExecutor 的 intermediate_steps：steps 次工具调用，日志行共 lines 条，平均分到各次观测结果里。"""
+    from langchain_core.agents import AgentAction
+
+    rng = random.Random(seed)
+    out = []
+    per_step = max(1, lines // steps)
+    for i in range(steps):
+        logql = f'{{service_name="{SERVICES[i % len(SERVICES)]}"}} |~ "(?i)error|timeout"'
+        tool_input = {"logql": logql, "start_iso": "2026-10-19T00:00:00Z", "end_iso": "2026-10-19T06:00:00Z", "limit": per_step}
+        observation = {
+            "logql": logql,
+            "line_count": per_step,
+            "lines": [f"{1_760_000_000_000_000_000 + k} [service_name={SERVICES[i % len(SERVICES)]}] {_line(rng, 160)}" for k in range(per_step)],
+        }
+        log = f"Invoking: `loki_query_range_lines` with `{json.dumps(tool_input, ensure_ascii=False)}`"
+        out.append((AgentAction(tool="loki_query_range_lines", tool_input=tool_input, log=log), observation))
+    return out
@@ -0,0 +1,297 @@
+"""数据处理热路径的微基准：在合成负载上测量 ops/sec 与单次调用的内存分配。
+
+三个服务的包名都是 app，因此每个服务在独立子进程中导入并测量（--worker），主进程汇总结果。
+
+示例：
+    python benchmarks/micro/run.py --services chatops,rca,predict \
+        --lines 100,1000,10000,50000 --series 1,20,200 --output bench-micro.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+
+HERE = Path(__file__).resolve().parent
+REPO = HERE.parent.parent
+SERVICES_DIR = REPO / "services"
+
+# 每个服务要测的用例；名称同时用于 --cases 过滤
+CASES = {
+    "chatops": ["flatten_log_lines", "prometheus_reshape", "stringify", "build_trace"],
+    "rca": ["flatten_log_lines", "collect_evidence_dedupe", "rank_evidence", "prometheus_reshape", "stringify", "build_trace"],
+    "predict": ["flatten_log_lines", "pattern_sketch", "prometheus_reshape", "stringify", "build_trace"],
+}
+
+
+class _MemoryLoki:
+    """按服务名返回预先生成的查询结果，只替代网络往返，不改变被测代码路径。"""
+
+    def __init__(self, results: dict):
+        self._results = results
+
+    async def label_values(self, label: str) -> list[str]:
+        return list(self._results)
+
+    async def query_range(self, query: str, start, end, limit: int = 200, **kwargs):
+        for service, result in self._results.items():
+            if f'"{service}"' in query:
+                return result
+        raise KeyError(query)
+
+
+def _build_case(service: str, case: str, size: int, args: argparse.Namespace) -> Callable[[], object]:
+    import payloads
+
+    if case == "flatten_log_lines":
+        from app.loki_client import LokiQueryResult
+
+        result = LokiQueryResult(payloads.loki_streams(size, line_bytes=args.line_bytes))
+        return result.flatten_log_lines
+    if case == "prometheus_reshape":
+        from app.tools.prometheus_query_range import _reshape_series
+
+        matrix = payloads.prometheus_matrix(size, points=args.points)
+        return lambda: _reshape_series(matrix)
+    if case == "stringify":
+        from app.main import _stringify
+
+        observation = payloads.agent_steps(size, steps=1)[0][1]
+        return lambda: _stringify(observation)
+    if case == "build_trace":
+        from app.main import _build_trace
+
+        steps = payloads.agent_steps(size)
+        return lambda: _build_trace(steps)
+    if case == "pattern_sketch":
+        from app.sketch import PatternSketch
+
+        end_ns = time.time_ns()
+        raw = payloads.loki_streams(size, line_bytes=args.line_bytes, window_s=24 * 3600, end_ns=end_ns)
+        end = datetime.fromtimestamp(end_ns / 1e9, tz=timezone.utc)
+        start = datetime.fromtimestamp(end_ns / 1e9 - 24 * 3600, tz=timezone.utc)
+
+        def sketch() -> list[dict]:
+            agg = PatternSketch(start, end)
+            agg.add_page(raw)
+            return agg.top_patterns(5)
+
+        return sketch
+    if case == "rank_evidence":
+        from app.evidence_rank import EvidenceRanker
+        from app.loki_client import LokiQueryResult
+
+        lines = LokiQueryResult(payloads.loki_streams(size, line_bytes=args.line_bytes, duplicate_ratio=0.5)).flatten_log_lines()
+        baseline = LokiQueryResult(payloads.loki_streams(size, line_bytes=args.line_bytes, seed=2)).flatten_log_lines()
+
+        def rank() -> list[str]:
+            ranker = EvidenceRanker()
+            for line in baseline:
+                ranker.add_baseline(line)
+            for i, line in enumerate(lines):
+                ranker.add(payloads.SERVICES[i % len(payloads.SERVICES)], line)
+            return ranker.select(200, 6000)[0]
+
+        return rank
+    if case == "collect_evidence_dedupe":
+        from app.loki_client import LokiQueryResult
+        from app.tools.rca_collect_evidence import collect_evidence
+
+        # 每个服务再按关键词查一次且返回相同结果，使一半的行走“已见过”分支
+        per_service = max(1, size // len(payloads.SERVICES))
+        loki = _MemoryLoki(
+            {
+                name: LokiQueryResult(payloads.loki_streams(per_service, streams=2, line_bytes=args.line_bytes, seed=i))
+                for i, name in enumerate(payloads.SERVICES)
+            }
+        )
+        loop = asyncio.new_event_loop()
+        end = datetime.now(timezone.utc)
+        start = end.replace(hour=0, minute=0, second=0, microsecond=0)
+        return lambda: loop.run_until_complete(
+            collect_evidence(
+                loki,
+                start,
+                end,
+                max_services=len(payloads.SERVICES),
+                per_service_log_limit=per_service,
+                max_total_lines=size,
+                text_patterns=["timeout"],
+            )
+        )
+    raise ValueError(f"未知用例：{case}")
+
+
+def _time(fn: Callable[[], object], min_time_s: float, repeat: int) -> tuple[list[float], int]:
+    fn()
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time_s:
+            break
+        loops *= 2
+    per_call = [elapsed / loops]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        per_call.append((time.perf_counter() - started) / loops)
+    return per_call, loops
+
+
+def _allocations(fn: Callable[[], object]) -> dict:
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    result = fn()
+    retained_blocks = sys.getallocatedblocks() - blocks_before
+    del result
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = fn()
+        current, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+    return {
+        "peak_alloc_kib": round((peak - baseline) / 1024, 1),
+        "retained_kib": round((current - baseline) / 1024, 1),
+        "retained_blocks": retained_blocks,
+    }
+
+
+def _worker(args: argparse.Namespace) -> int:
+    service = args.worker
+    sys.path.insert(0, str(HERE))
+    sys.path.insert(0, str(SERVICES_DIR / f"{service}-service"))
+    rows = []
+    for case in CASES[service]:
+        if args.cases and case not in args.cases:
+            continue
+        param, sizes = ("series", args.series) if case == "prometheus_reshape" else ("lines", args.lines)
+        for size in sizes:
+            fn = _build_case(service, case, size, args)
+            per_call, loops = _time(fn, args.min_time_s, args.repeat)
+            median = statistics.median(per_call)
+            row = {
+                "service": service,
+                "case": case,
+                "param": param,
+                "size": size,
+                "ops_per_s": round(1.0 / median, 2),
+                "median_us": round(median * 1e6, 2),
+                "best_us": round(min(per_call) * 1e6, 2),
+                "loops": loops,
+                **_allocations(fn),
+            }
+            rows.append(row)
+            print(
+                f"{service:<8} {case:<24} {param}={size:<6} {row['ops_per_s']:>12.1f} ops/s "
+                f"{row['median_us']:>12.1f} us  peak {row['peak_alloc_kib']:>10.1f} KiB  blocks {row['retained_blocks']}",
+                flush=True,
+            )
+    args.output.write_text(json.dumps(rows, ensure_ascii=False))
+    return 0
+
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def _csv(value: str) -> list[str]:
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def _ints(value: str) -> list[int]:
+    return [int(v) for v in _csv(value)]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Aegis 数据处理热路径微基准")
+    parser.add_argument("--services", type=_csv, default=list(CASES))
+    parser.add_argument("--cases", type=_csv, default=[], help="只跑指定用例，逗号分隔；默认全部")
+    parser.add_argument("--lines", type=_ints, default=[100, 1000, 10000, 50000], help="日志类用例的行数档位")
+    parser.add_argument("--series", type=_ints, default=[1, 20, 200], help="Prometheus 用例的序列数档位")
+    parser.add_argument("--points", type=int, default=360, help="每条序列的点数")
+    parser.add_argument("--line-bytes", type=int, default=200)
+    parser.add_argument("--min-time-s", type=float, default=0.2, help="每轮计时的最短时长，循环次数据此自动放大")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--worker", choices=list(CASES), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        return _worker(args)
+
+    report = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items() if k != "worker"},
+        },
+        "results": [],
+    }
+    failed = []
+    for service in args.services:
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as fh:
+            out = Path(fh.name)
+        cmd = [
+            sys.executable,
+            str(Path(__file__).resolve()),
+            "--worker", service,
+            "--cases", ",".join(args.cases),
+            "--lines", ",".join(map(str, args.lines)),
+            "--series", ",".join(map(str, args.series)),
+            "--points", str(args.points),
+            "--line-bytes", str(args.line_bytes),
+            "--min-time-s", str(args.min_time_s),
+            "--repeat", str(args.repeat),
+            "--output", str(out),
+        ]
+        try:
+            proc = subprocess.run(cmd, cwd=SERVICES_DIR / f"{service}-service")
+            if proc.returncode != 0:
+                failed.append(service)
+                continue
+            report["results"].extend(json.loads(out.read_text()))
+        finally:
+            out.unlink(missing_ok=True)
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f"结果已写入 {args.output}")
+    if failed:
+        print("以下服务的微基准失败：" + ", ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
-from langchain.agents import AgentExecutor
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.memory import ConversationBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
+
+from ..settings import settings
+from .concurrent import ConcurrentAgentExecutor
 
 
 try:
@@ -12,7 +14,7 @@ except Exception:
     from langchain.agents import create_openai_functions_agent as create_tool_calling_agent
 
 
-def build_executor(llm: BaseChatModel, tools, memory: ConversationBufferMemory | None) -> AgentExecutor:
+def build_executor(llm: BaseChatModel, tools, memory: BaseChatMemory | None) -> ConcurrentAgentExecutor:
     prompt = ChatPromptTemplate.from_messages(
         [
             (
@@ -28,12 +30,15 @@ def build_executor(llm: BaseChatModel, tools, memory: ConversationBufferMemory |
                 "你在生成 LogQL 时，应假设这些字段可能已经按规范落地，但也要兼容老日志中缺失部分字段的情况："
                 " - 对于 HTTP 请求日志，优先按 event=http_request、service=<服务名>、method、path、status、duration_ms 等字段进行文本过滤；"
                 " - 对于业务事件日志，优先使用 event=login/register/todo_create/todo_update/todo_delete/ai_chat 等字段，而不是只靠模糊关键字。"
+                "当问题只关心日志的数量、速率或排名（如“有多少条 5xx”“每秒多少次登录失败”“哪个服务报错最多”）时，"
+                "使用工具 loki_count_logs 在 Loki 侧聚合计数（by 分组、top_n 取前 N），不要用 loki_query_range_lines 拉取原始日志再自行计数，"
+                "因为原始日志受 limit 截断，数出来的结果会偏小。"
                 "当需要查询数值类指标（如 QPS、错误率、延迟、CPU/内存使用率、业务成功率等）时，使用工具 prometheus_query_range 调用 Prometheus 的 /api/v1/query_range 接口。"
                 "在构造 PromQL 时，请优先参考以下常见指标家族（示例，并非完整列表）："
                 " - HTTP 通用：http_requests_total、http_request_duration_seconds_bucket。"
                 "   注意：在 Todo_List 当前环境中，这两类指标用 service 标签区分 user-service/todo-service/ai-service。"
                 "   你在选择器中必须使用 service=\"user-service\" 这类条件进行过滤，可以按 service、method、path、status 等维度聚合；"
-                "   严禁在 http_requests_total 或 http_request_duration_seconds_bucket 的选择器中使用 app 或 namespace 标签，比如 {app=\"user-service\"} 或 {app=\"user-service\", namespace=\"todo-list\"}，"
+                "   严禁在 http_requests_total 或 http_request_duration_seconds_bucket 的选择器中使用 app 或 namespace 标签，比如 {{app=\"user-service\"}} 或 {{app=\"user-service\", namespace=\"todo-list\"}}，"
                 "   因为这些标签在实际指标上并不存在，会导致查询结果始终为空。"
                 " - 业务：user_registration_*、user_login_*、todo_*、ai_chat_*；"
                 " - 可用性与资源：up、process_resident_memory_bytes、process_cpu_seconds_total；"
@@ -52,17 +57,20 @@ def build_executor(llm: BaseChatModel, tools, memory: ConversationBufferMemory |
                 "调用任何工具前，先调用 trace_note 简要记录本轮要做什么与原因（不超过80字）。"
                 "最终回答必须使用简洁的中文，自洽且可执行，并在需要时解释你参考了哪些指标与日志。",
             ),
-            MessagesPlaceholder(variable_name="chat_history"),
+            MessagesPlaceholder(variable_name="chat_history", optional=True),
             ("human", "{input}"),
             MessagesPlaceholder(variable_name="agent_scratchpad"),
         ]
     )
     agent = create_tool_calling_agent(llm, tools, prompt)
-    return AgentExecutor(
+    return ConcurrentAgentExecutor(
         agent=agent,
         tools=tools,
         memory=memory,
         verbose=True,
         handle_parsing_errors=True,
         return_intermediate_steps=True,
+        max_tool_concurrency=settings.agent_max_tool_concurrency,
+        deadline_reserve_s=settings.deadline_reserve_s,
+        partial_llm=llm,
     )
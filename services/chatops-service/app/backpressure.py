@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import time
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+import httpx
+
+from .settings import settings
+
+
+T = TypeVar("T")
+
+
+class BackendUnavailable(Exception):
+    """后端熔断或并发排队超时时快速失败，不再向已过载的后端发请求。"""
+
+    def __init__(self, backend: str, reason: str, retry_after_s: float | None = None):
+        super().__init__(f"{backend} 暂不可用：{reason}")
+        self.backend = backend
+        self.reason = reason
+        self.retry_after_s = retry_after_s
+
+    def observation(self) -> dict:
+        return {
+            "error": "backend_unavailable",
+            "backend": self.backend,
+            "message": str(self),
+            "retry_after_s": round(self.retry_after_s, 1) if self.retry_after_s is not None else None,
+        }
+
+
+def is_backend_failure(exc: BaseException) -> bool:
+    """只有连接错误、超时、429/5xx 计入熔断；4xx（如查询语法错误）说明后端是健康的。"""
+    if isinstance(exc, BackendUnavailable):
+        return False
+    response = getattr(exc, "response", None)
+    status = getattr(exc, "status_code", None) or getattr(response, "status_code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    if isinstance(exc, (httpx.TransportError, asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    return type(exc).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+class AdaptiveLimiter:
+    """AIMD 并发限制：延迟不超过长期基线的 tolerance 倍时每轮加 1，超过或失败时乘以 backoff。"""
+
+    def __init__(self, name: str, initial: int, min_limit: int, max_limit: int):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.inflight = 0
+        self.baseline_s: float | None = None
+        self.last_latency_s: float | None = None
+        self.rejected = 0
+        self._cond = asyncio.Condition()
+        self._last_decrease = 0.0
+
+    async def acquire(self, timeout_s: float) -> None:
+        async with self._cond:
+            try:
+                await asyncio.wait_for(self._cond.wait_for(lambda: self.inflight < int(self.limit)), timeout_s)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise BackendUnavailable(self.name, f"并发已达上限 {int(self.limit)}，排队超过 {timeout_s:.1f}s") from None
+            self.inflight += 1
+
+    async def release(self, latency_s: float | None, overloaded: bool) -> None:
+        async with self._cond:
+            self.inflight -= 1
+            if latency_s is not None:
+                self.last_latency_s = latency_s
+                if self.baseline_s is None:
+                    self.baseline_s = latency_s
+                else:
+                    self.baseline_s += settings.backend_limit_baseline_alpha * (latency_s - self.baseline_s)
+                if latency_s > self.baseline_s * settings.backend_limit_tolerance:
+                    overloaded = True
+            now = time.monotonic()
+            if overloaded:
+                if now - self._last_decrease >= (self.baseline_s or 0.0):
+                    self.limit = max(float(self.min_limit), self.limit * settings.backend_limit_backoff)
+                    self._last_decrease = now
+            elif latency_s is not None:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / max(self.limit, 1.0))
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "inflight": self.inflight,
+            "baseline_ms": round(self.baseline_s * 1000.0, 1) if self.baseline_s is not None else None,
+            "last_latency_ms": round(self.last_latency_s * 1000.0, 1) if self.last_latency_s is not None else None,
+            "rejected": self.rejected,
+        }
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后打开；冷却期后放行一个探测请求（half_open），成功则关闭，失败则重新打开。"""
+
+    def __init__(self, name: str, failure_threshold: int, cooldown_s: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown_s = cooldown_s
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self.short_circuited = 0
+        self._probing = False
+
+    def before_call(self) -> None:
+        if self.state == "closed":
+            return
+        elapsed = time.monotonic() - (self.opened_at or 0.0)
+        if self.state == "open" and elapsed >= self.cooldown_s:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return
+        self.short_circuited += 1
+        raise BackendUnavailable(self.name, "熔断中，后端近期持续失败", max(0.0, self.cooldown_s - elapsed))
+
+    def on_success(self) -> None:
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def on_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def on_neutral(self) -> None:
+        self._probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "short_circuited": self.short_circuited,
+        }
+
+
+class _Slot:
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.latency_s: float | None = None
+
+    def first_byte(self) -> None:
+        if self.latency_s is None:
+            self.latency_s = time.monotonic() - self.started
+
+
+class BackendGuard:
+    def __init__(self, name: str):
+        self.name = name
+        self.limiter = AdaptiveLimiter(
+            name,
+            settings.backend_limit_initial,
+            settings.backend_limit_min,
+            settings.backend_limit_max,
+        )
+        self.breaker = CircuitBreaker(name, settings.backend_breaker_failures, settings.backend_breaker_cooldown_s)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, queue_timeout_s: float | None = None) -> AsyncIterator[_Slot]:
+        """占用一个并发名额；流式调用可在收到首个分片时调用 first_byte()，以首字节延迟作为限流信号。"""
+        self.breaker.before_call()
+        try:
+            await self.limiter.acquire(queue_timeout_s if queue_timeout_s is not None else settings.backend_queue_timeout_s)
+        except BaseException:
+            self.breaker.on_neutral()
+            raise
+        slot = _Slot()
+        overloaded = False
+        try:
+            yield slot
+            slot.first_byte()
+            self.breaker.on_success()
+        except BaseException as exc:
+            overloaded = is_backend_failure(exc)
+            if overloaded:
+                self.breaker.on_failure()
+            else:
+                self.breaker.on_neutral()
+            raise
+        finally:
+            await asyncio.shield(self.limiter.release(None if overloaded else slot.latency_s, overloaded))
+
+    async def run(self, fn: Callable[[], Awaitable[T]], queue_timeout_s: float | None = None) -> T:
+        async with self.slot(queue_timeout_s):
+            return await fn()
+
+    def stats(self) -> dict:
+        return {"limiter": self.limiter.stats(), "breaker": self.breaker.stats()}
+
+
+_guards: dict[str, BackendGuard] = {}
+
+
+def get_guard(name: str) -> BackendGuard:
+    guard = _guards.get(name)
+    if guard is None:
+        guard = BackendGuard(name)
+        _guards[name] = guard
+    return guard
+
+
+def stats() -> dict[str, dict]:
+    return {name: guard.stats() for name, guard in _guards.items()}
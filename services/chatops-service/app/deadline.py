@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import time
+from typing import Awaitable, Callable, Iterator, ParamSpec, TypeVar
+
+from .settings import settings
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """请求级时间预算已耗尽；继承 TimeoutError，现有的超时处理分支会照常生效。"""
+
+
+@contextlib.contextmanager
+def scope(budget_s: float | None) -> Iterator[None]:
+    """为当前请求设置截止时间；嵌套时取更早的一个。在此期间创建的 Task 会继承该截止时间。"""
+    if budget_s is None or budget_s <= 0:
+        yield
+        return
+    at = time.monotonic() + budget_s
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(current, at))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float | None:
+    at = _deadline.get()
+    if at is None:
+        return None
+    return at - time.monotonic()
+
+
+def clamp(timeout_s: float | None, reserve_s: float = 0.0) -> float | None:
+    """把单次调用的超时收缩到剩余预算（减去 reserve_s），预算已耗尽时返回 0。"""
+    left = remaining()
+    if left is None:
+        return timeout_s
+    left = max(0.0, left - reserve_s)
+    return left if timeout_s is None else min(timeout_s, left)
+
+
+def check(what: str = "请求") -> float | None:
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"{what}已超出时间预算")
+    return left
+
+
+def budgeted(fn: Callable[P, Awaitable[R]]) -> Callable[P, Awaitable[R]]:
+    """在 settings.request_budget_s 的请求预算内执行被装饰的协程函数。"""
+
+    @functools.wraps(fn)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        with scope(settings.request_budget_s):
+            return await fn(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import time
+from typing import Any, AsyncIterator, Coroutine, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_openai import ChatOpenAI
+
+from . import deadline, metrics, replay
+from .backpressure import get_guard
+
+
+_guarded: contextvars.ContextVar[bool] = contextvars.ContextVar("llm_guarded", default=False)
+
+
+class GuardedChatOpenAI(ChatOpenAI):
+    """每次模型调用占用 "llm" 后端的一个自适应并发名额并经过熔断器；流式调用以首个分片延迟作为限流信号。
+
+    存在请求级截止时间时，单次调用的超时不超过剩余预算。每次实际的 HTTP 调用记录一次耗时、首分片延迟与 token 用量。
+    启用录制/回放（见 replay.py）时，模型的请求与响应在此录制或由 fixture 提供。
+    """
+
+    def _apply_deadline(self, kwargs: dict) -> float | None:
+        """把本次请求的 HTTP 超时收缩到请求剩余预算。"""
+        budget = deadline.check("LLM 调用")
+        if budget is not None:
+            limit = kwargs.get("timeout") or self.request_timeout
+            kwargs["timeout"] = min(budget, limit) if isinstance(limit, (int, float)) else budget
+        return budget
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if _guarded.get():
+            return await self._replayable_generate(super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs), messages)
+        budget = self._apply_deadline(kwargs)
+        token = _guarded.set(True)
+        started = time.perf_counter()
+        result: ChatResult | None = None
+        try:
+            async with get_guard("llm").slot():
+                result = await asyncio.wait_for(
+                    self._replayable_generate(super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs), messages),
+                    budget,
+                )
+                return result
+        finally:
+            _guarded.reset(token)
+            if not self.streaming:
+                usage = getattr(result.generations[0].message, "usage_metadata", None) if result and result.generations else None
+                metrics.observe_llm(self.model_name, time.perf_counter() - started, "ok" if result else "error", usage)
+
+    async def _replayable_generate(self, call: Coroutine[Any, Any, ChatResult], messages: List[BaseMessage]) -> ChatResult:
+        # streaming=True 时 _agenerate 内部会走 _astream，由流式路径负责录制/回放
+        if self.streaming:
+            return await call
+        return await replay.llm_generate(messages, call)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if _guarded.get():
+            async for chunk in self._metered_stream(messages, stop, run_manager, **kwargs):
+                yield chunk
+            return
+        self._apply_deadline(kwargs)
+        async with get_guard("llm").slot() as slot:
+            async for chunk in self._metered_stream(messages, stop, run_manager, **kwargs):
+                slot.first_byte()
+                deadline.check("LLM 调用")
+                yield chunk
+
+    async def _metered_stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]],
+        run_manager: Optional[AsyncCallbackManagerForLLMRun],
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        started = time.perf_counter()
+        first_at: float | None = None
+        usage = {"input_tokens": 0, "output_tokens": 0}
+        outcome = "error"
+        try:
+            source = super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            async for chunk in replay.llm_stream(messages, source, run_manager):
+                if first_at is None:
+                    first_at = time.perf_counter()
+                meta = getattr(chunk.message, "usage_metadata", None)
+                if meta:
+                    usage["input_tokens"] += meta.get("input_tokens") or 0
+                    usage["output_tokens"] += meta.get("output_tokens") or 0
+                yield chunk
+            outcome = "ok"
+        finally:
+            ttft = first_at - started if first_at is not None else None
+            metrics.observe_llm(self.model_name, time.perf_counter() - started, outcome, usage, ttft)
@@ -0,0 +1,452 @@
+from __future__ import annotations
+
+import asyncio
+import difflib
+import math
+import re
+import time
+import warnings
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from .settings import settings
+
+
+_TOKEN = re.compile(
+    r"""
+    (?P<ws>\s+)
+  | (?P<str>"(?:[^"\\\n]|\\.)*"|`[^`]*`)
+  | (?P<op>=~|!~|!=|\|=|\|~|==|>=|<=|=|\||,|\{|\}|\(|\)|\[|\]|>|<)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_.:]*)
+  | (?P<num>[0-9][0-9A-Za-z.]*)
+  | (?P<other>.)
+    """,
+    re.X | re.S,
+)
+_GO_ESCAPE = re.compile(r"""\\(?:[abfnrtv\\'"]|x[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|[0-7]{3})""")
+_GO_ESCAPE_CHARS = {"a": "\a", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v", "\\": "\\", "'": "'", '"': '"'}
+# Loki 使用 RE2：不支持环视、反向引用、原子组与占有量词
+_RE2_GROUP_UNSUPPORTED = ("(?=", "(?!", "(?<=", "(?<!", "(?>")
+_RE2_COUNTED = re.compile(r"\{\d+(?:,\d*)?\}")
+# RE2 支持而 Python re 不认识的写法：\z、\Q...\E、\C、\pL 等
+_RE2_ONLY_ESCAPE = re.compile(r"\\[zQECpP]")
+_DURATION = re.compile(r"^(?:\d+(?:ms|s|m|h|d|w|y))+$")
+_DURATION_PART = re.compile(r"(\d+)(ms|s|m|h|d|w|y)")
+_DURATION_S = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800, "y": 31536000}
+_LINE_FILTERS = {"|=", "|~", "!~", "!="}
+
+
+class LogQLError(ValueError):
+    def __init__(self, message: str, position: int | None = None, hint: str | None = None, **extra):
+        super().__init__(message)
+        self.position = position
+        self.hint = hint
+        self.extra = extra
+
+    def observation(self) -> dict:
+        out = {"error": "invalid_logql", "message": str(self), "position": self.position}
+        if self.hint:
+            out["hint"] = self.hint
+        out.update(self.extra)
+        return out
+
+
+def unquote(raw: str, position: int = 0) -> str:
+    """按 Go 字符串规则解析 LogQL 字符串字面量（双引号转义或反引号原样）。"""
+    if raw.startswith("`"):
+        return raw[1:-1]
+    body = raw[1:-1]
+    out: list[str] = []
+    i = 0
+    while i < len(body):
+        ch = body[i]
+        if ch != "\\":
+            out.append(ch)
+            i += 1
+            continue
+        m = _GO_ESCAPE.match(body, i)
+        if m is None:
+            bad = body[i : i + 2]
+            raise LogQLError(
+                f"字符串中的转义 {bad} 无效",
+                position + 1 + i,
+                hint=f"双引号字符串中正则的反斜杠要写两次（如 \\\\{bad[1:]}），或改用反引号包裹：`...{bad}...`",
+            )
+        esc = m.group(0)
+        if esc[1] in _GO_ESCAPE_CHARS:
+            out.append(_GO_ESCAPE_CHARS[esc[1]])
+        elif esc[1] in "xuU":
+            out.append(chr(int(esc[2:], 16)))
+        else:
+            out.append(chr(int(esc[1:], 8)))
+        i = m.end()
+    return "".join(out)
+
+
+def quote(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _re2_unsupported(pattern: str) -> str | None:
+    """逐字符扫描正则，返回第一个 RE2 不支持的写法；转义字符、字符类与 \\Q...\\E 中的内容按字面处理。"""
+    i, n = 0, len(pattern)
+    while i < n:
+        ch = pattern[i]
+        if ch == "\\":
+            nxt = pattern[i + 1 : i + 2]
+            if nxt == "Q":
+                end = pattern.find("\\E", i + 2)
+                i = n if end < 0 else end + 2
+                continue
+            if nxt and nxt in "123456789":
+                return pattern[i : i + 2]
+            i += 2
+            continue
+        if ch == "[":
+            j = i + 1
+            if pattern[j : j + 1] == "^":
+                j += 1
+            if pattern[j : j + 1] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                if pattern[j] == "[" and pattern[j + 1 : j + 2] == ":":
+                    close = pattern.find(":]", j + 2)
+                    j = j + 1 if close < 0 else close + 2
+                    continue
+                j += 2 if pattern[j] == "\\" else 1
+            i = j + 1
+            continue
+        if ch == "(":
+            for group in _RE2_GROUP_UNSUPPORTED:
+                if pattern.startswith(group, i):
+                    return group
+            i += 1
+            continue
+        end = i + 1 if ch in "*+?" else 0
+        if ch == "{":
+            m = _RE2_COUNTED.match(pattern, i)
+            end = m.end() if m else 0
+        if end:
+            if pattern[end : end + 1] == "+":
+                return pattern[i : end + 1]
+            if pattern[end : end + 1] == "?":
+                end += 1
+            i = end
+            continue
+        i += 1
+    return None
+
+
+def regex_error(pattern: str) -> str | None:
+    """检查正则能否被 Loki（RE2）接受，返回错误说明；合法时返回 None。"""
+    found = _re2_unsupported(pattern)
+    if found is not None:
+        return f"Loki 使用 RE2 正则，不支持 {found}（环视、反向引用、原子组或占有量词）"
+    try:
+        with warnings.catch_warnings():
+            # [[:alpha:]] 等 POSIX 字符类在 Python 中会触发 FutureWarning
+            warnings.simplefilter("ignore", FutureWarning)
+            re.compile(pattern)
+    except re.error as exc:
+        # Python re 只作参考：含 RE2 独有转义时不据此拒绝
+        if _RE2_ONLY_ESCAPE.search(pattern):
+            return None
+        return f"正则语法错误：{exc}"
+    return None
+
+
+def duration_s(text: str) -> float | None:
+    if not _DURATION.match(text):
+        return None
+    return sum(int(n) * _DURATION_S[u] for n, u in _DURATION_PART.findall(text))
+
+
+@dataclass
+class Matcher:
+    name: str
+    op: str
+    raw: str
+    value: str
+    position: int
+
+    def render(self) -> str:
+        return f"{self.name}{self.op}{self.raw}"
+
+
+@dataclass
+class Selector:
+    start: int
+    end: int
+    matchers: list[Matcher]
+
+
+@dataclass
+class Parsed:
+    query: str
+    selectors: list[Selector] = field(default_factory=list)
+
+
+def _tokens(query: str) -> list[tuple[str, str, int]]:
+    tokens = []
+    for m in _TOKEN.finditer(query):
+        kind = m.lastgroup
+        if kind == "ws":
+            continue
+        if kind == "other":
+            if m.group(0) in "\"`":
+                raise LogQLError("字符串没有闭合", m.start(), hint="检查引号是否成对，字符串内的双引号要写成 \\\"")
+        tokens.append((kind, m.group(0), m.start()))
+    return tokens
+
+
+def parse(query: str) -> Parsed:
+    """解析 LogQL 中与校验有关的部分：流选择器、行过滤与 regexp 阶段中的字符串、区间向量时长，以及括号配对。"""
+    if not query.strip():
+        raise LogQLError("查询为空", 0, hint='至少需要一个流选择器，例如 {app="user-service"}')
+    tokens = _tokens(query)
+    parsed = Parsed(query)
+    stack: list[tuple[str, int]] = []
+    pairs = {")": "(", "]": "["}
+    i = 0
+    while i < len(tokens):
+        kind, text, pos = tokens[i]
+        prev = tokens[i - 1] if i else None
+        if text == "{":
+            i = _parse_selector(tokens, i, parsed)
+            continue
+        if text == "}":
+            raise LogQLError("多余的 }", pos)
+        if text in ("(", "["):
+            stack.append((text, pos))
+            if text == "[":
+                dur = tokens[i + 1] if i + 1 < len(tokens) else None
+                if dur is None or dur[0] not in ("num", "word") or duration_s(dur[1]) is None:
+                    raise LogQLError("区间向量的时长无效", pos, hint="写成 [5m]、[1h] 这样的时长")
+                if duration_s(dur[1]) > settings.logql_max_range_h * 3600:
+                    raise LogQLError(
+                        f"区间 [{dur[1]}] 超过上限 {settings.logql_max_range_h:g}h", dur[2], hint="缩短区间或分段查询"
+                    )
+        elif text in pairs:
+            if not stack or stack[-1][0] != pairs[text]:
+                raise LogQLError(f"多余的 {text}", pos)
+            stack.pop()
+        elif text in _LINE_FILTERS and not (text == "!=" and prev is not None and prev[0] == "word"):
+            nxt = tokens[i + 1] if i + 1 < len(tokens) else None
+            if nxt is None or nxt[0] != "str":
+                if nxt is not None and nxt[1] == "ip":
+                    i += 1
+                    continue
+                raise LogQLError(f"{text} 之后需要一个字符串", pos, hint=f'例如 {text} "timeout"')
+            value = unquote(nxt[1], nxt[2])
+            if text in ("|~", "!~"):
+                err = regex_error(value)
+                if err:
+                    raise LogQLError(err, nxt[2], hint="修正正则，或改用 |= 做普通子串匹配")
+            i += 2
+            continue
+        elif kind == "word" and text == "regexp" and prev is not None and prev[1] == "|":
+            nxt = tokens[i + 1] if i + 1 < len(tokens) else None
+            if nxt is None or nxt[0] != "str":
+                raise LogQLError("regexp 阶段之后需要一个正则字符串", pos)
+            err = regex_error(unquote(nxt[1], nxt[2]))
+            if err:
+                raise LogQLError(err, nxt[2])
+            i += 2
+            continue
+        elif kind == "str":
+            unquote(text, pos)
+        i += 1
+    if stack:
+        raise LogQLError(f"{stack[-1][0]} 没有闭合", stack[-1][1])
+    if not parsed.selectors:
+        raise LogQLError("缺少流选择器", 0, hint='LogQL 必须以 {label="value"} 形式的选择器开头，例如 {app="user-service"}')
+    return parsed
+
+
+def _parse_selector(tokens: list[tuple[str, str, int]], i: int, parsed: Parsed) -> int:
+    start = tokens[i][2]
+    matchers: list[Matcher] = []
+    i += 1
+    while True:
+        if i >= len(tokens):
+            raise LogQLError("{ 没有闭合", start)
+        kind, text, pos = tokens[i]
+        if text == "}":
+            parsed.selectors.append(Selector(start, pos + 1, matchers))
+            return i + 1
+        if matchers:
+            if text != ",":
+                raise LogQLError("选择器中的匹配条件之间需要逗号", pos)
+            i += 1
+            kind, text, pos = tokens[i] if i < len(tokens) else ("", "", start)
+        if kind != "word" or not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", text):
+            raise LogQLError("选择器中需要标签名", pos, hint='例如 {app="user-service"}')
+        if i + 2 >= len(tokens) or tokens[i + 1][1] not in ("=", "!=", "=~", "!~") or tokens[i + 2][0] != "str":
+            raise LogQLError(f"标签 {text} 之后需要 =、!=、=~ 或 !~ 以及一个字符串", pos)
+        op, (_, raw, raw_pos) = tokens[i + 1][1], tokens[i + 2]
+        value = unquote(raw, raw_pos)
+        if op in ("=~", "!~"):
+            err = regex_error(value)
+            if err:
+                raise LogQLError(err, raw_pos)
+        matchers.append(Matcher(text, op, raw, value, pos))
+        i += 3
+
+
+class LabelCatalog:
+    """Loki 标签名与标签值的本地缓存（TTL），供选择器校验使用；查询失败时返回 None，校验跳过相应检查。"""
+
+    def __init__(self, loki) -> None:
+        self._loki = loki
+        self._labels: tuple[float, set[str]] | None = None
+        self._values: dict[str, tuple[float, set[str]]] = {}
+        self._lock = asyncio.Lock()
+
+    def _fresh(self, entry: tuple[float, set[str]] | None) -> bool:
+        return entry is not None and time.monotonic() - entry[0] <= settings.logql_catalog_ttl_s
+
+    async def labels(self) -> set[str] | None:
+        if self._fresh(self._labels):
+            return self._labels[1]
+        async with self._lock:
+            if not self._fresh(self._labels):
+                try:
+                    self._labels = (time.monotonic(), set(await self._loki.labels()))
+                except Exception:
+                    return self._labels[1] if self._labels else None
+        return self._labels[1]
+
+    async def values(self, name: str) -> set[str] | None:
+        entry = self._values.get(name)
+        if self._fresh(entry):
+            return entry[1]
+        try:
+            values = set(await self._loki.label_values(name))
+        except Exception:
+            return entry[1] if entry else None
+        self._values[name] = (time.monotonic(), values)
+        return values
+
+
+_catalogs: dict[int, LabelCatalog] = {}
+
+
+def get_catalog(loki) -> LabelCatalog:
+    catalog = _catalogs.get(id(loki))
+    if catalog is None:
+        catalog = _catalogs[id(loki)] = LabelCatalog(loki)
+    return catalog
+
+
+@dataclass
+class Checked:
+    query: str
+    rewrites: list[str] = field(default_factory=list)
+
+
+def _empty_compatible(m: Matcher) -> bool:
+    if m.op == "=":
+        return m.value == ""
+    if m.op == "=~":
+        try:
+            return re.fullmatch(m.value, "") is not None
+        except re.error:
+            return False
+    return True
+
+
+def _closest(value: str, known: set[str]) -> list[str]:
+    contains = [k for k in known if value and value.lower() in k.lower()]
+    if len(contains) == 1:
+        return contains
+    scored = sorted(
+        ((difflib.SequenceMatcher(None, value, k).ratio(), k) for k in known), reverse=True
+    )
+    close = [k for score, k in scored[:5] if score >= 0.6 and score >= scored[0][0] - 0.1]
+    return close or sorted(contains)[:5]
+
+
+def rewrite(parsed: Parsed, labels: set[str] | None, values: dict[str, set[str] | None]) -> Checked:
+    """对照标签目录修正选择器：
+
+    - 目录中没有的标签：值恰好是服务标签的已知取值时改用服务标签，否则改写为 |= "name=value" 行过滤（业务字段只存在于日志文本中）；
+    - 标签值不在目录中但只有一个相近的已知值：替换为该值；有多个相近值时报错并给出候选。
+    """
+    service_key = settings.loki_service_label_key
+    service_values = values.get(service_key) or set()
+    query = parsed.query
+    notes: list[str] = []
+    for sel in reversed(parsed.selectors):
+        kept: list[Matcher] = []
+        filters: list[str] = []
+        changed = False
+        for m in sel.matchers:
+            if labels is not None and m.name not in labels:
+                if m.op == "=" and m.value in service_values and not any(k.name == service_key for k in sel.matchers):
+                    notes.append(f"标签 {m.name} 不存在，{m.render()} 改为 {service_key}={m.raw}")
+                    kept.append(Matcher(service_key, m.op, m.raw, m.value, m.position))
+                    changed = True
+                    continue
+                line_op = {"=": "|=", "!=": "!=", "=~": "|~", "!~": "!~"}[m.op]
+                text = f"{m.name}={m.value}" if m.op in ("=", "!=") else f"{m.name}=({m.value})"
+                filters.append(f"{line_op} {quote(text)}")
+                notes.append(f"标签 {m.name} 不存在（业务字段只在日志文本中），{m.render()} 改为行过滤 {filters[-1]}")
+                changed = True
+                continue
+            known = values.get(m.name)
+            if m.op == "=" and known and m.value not in known:
+                candidates = _closest(m.value, known)
+                if len(candidates) == 1:
+                    notes.append(f"{m.name} 没有取值 {m.raw}，改为最接近的 {quote(candidates[0])}")
+                    kept.append(Matcher(m.name, m.op, quote(candidates[0]), candidates[0], m.position))
+                    changed = True
+                    continue
+                if candidates:
+                    raise LogQLError(
+                        f"{m.name} 没有取值 {m.raw}",
+                        m.position,
+                        hint=f"从候选中选择一个：{', '.join(candidates)}",
+                        candidates=candidates,
+                    )
+            kept.append(m)
+        if all(_empty_compatible(m) for m in kept):
+            hint = f'至少需要一个非空的 = 或 =~ 标签匹配，例如 {{{service_key}="<服务名>"}}'
+            extra = {"available_labels": sorted(labels)[:30]} if labels else {}
+            raise LogQLError("选择器中没有可用的标签匹配", sel.start, hint=hint, **extra)
+        if changed:
+            rendered = "{" + ", ".join(m.render() for m in kept) + "}"
+            if filters:
+                rendered += " " + " ".join(filters)
+            query = query[: sel.start] + rendered + query[sel.end :]
+    notes.reverse()
+    return Checked(query, notes)
+
+
+async def validate(loki, query: str) -> Checked:
+    """校验并在可能时自动修正 LogQL；无法修正时抛出 LogQLError。"""
+    parsed = parse(query)
+    catalog = get_catalog(loki)
+    labels = await catalog.labels()
+    names = {settings.loki_service_label_key} | {
+        m.name for sel in parsed.selectors for m in sel.matchers if m.op == "=" and (labels is None or m.name in labels)
+    }
+    fetched = await asyncio.gather(*(catalog.values(n) for n in names))
+    return rewrite(parsed, labels, dict(zip(names, fetched)))
+
+
+def validate_window(start: datetime, end: datetime, step_seconds: int | None) -> tuple[int | None, list[str]]:
+    """检查时间范围与步长；步长导致点数超过上限时放大步长。"""
+    window_s = (end - start).total_seconds()
+    if window_s <= 0:
+        raise LogQLError("结束时间必须晚于开始时间", hint="检查 start_iso 与 end_iso 是否写反")
+    if window_s > settings.logql_max_range_h * 3600:
+        raise LogQLError(
+            f"时间范围 {window_s / 3600:.1f}h 超过上限 {settings.logql_max_range_h:g}h", hint="缩短时间范围或分段查询"
+        )
+    notes: list[str] = []
+    if step_seconds is not None:
+        min_step = max(1, math.ceil(window_s / settings.logql_max_points))
+        if step_seconds < min_step:
+            notes.append(f"step_seconds={step_seconds} 会产生超过 {settings.logql_max_points} 个点，已改为 {min_step}")
+            step_seconds = min_step
+    return step_seconds, notes
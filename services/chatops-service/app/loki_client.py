@@ -5,6 +5,9 @@ from datetime import datetime, timezone
 
 import httpx
 
+from . import backpressure, metrics, replay, resilience
+from .singleflight import align_range, get_group, normalize_query
+
 
 def _dt_to_ns(dt: datetime) -> int:
     if dt.tzinfo is None:
@@ -30,6 +33,19 @@ class LokiQueryResult:
             return lines[:limit]
         return lines
 
+    def vector(self) -> list[tuple[dict, float]]:
+        """即时查询结果中的每个样本：(标签, 数值)，无法解析的数值跳过。"""
+        samples: list[tuple[dict, float]] = []
+        for item in (self.raw.get("data", {}) or {}).get("result", []) or []:
+            value = item.get("value")
+            if not value or len(value) < 2:
+                continue
+            try:
+                samples.append((item.get("metric", {}) or {}, float(value[1])))
+            except Exception:
+                continue
+        return samples
+
     def extract_instant_number(self) -> float | None:
         data = self.raw.get("data", {})
         results = data.get("result", []) or []
@@ -48,27 +64,48 @@ class LokiQueryResult:
 
 
 class LokiClient:
-    def __init__(self, base_url: str, tenant_id: str | None, timeout_s: float):
+    def __init__(self, base_url: str, tenant_id: str | None, timeout_s: float, align_s: float = 0.0):
         self._base_url = base_url.rstrip("/")
         self._tenant_id = tenant_id
         self._timeout_s = timeout_s
+        self._align_s = align_s
+        self._flight = get_group("loki")
 
     def _headers(self) -> dict[str, str]:
         if self._tenant_id:
             return {"X-Scope-OrgID": self._tenant_id}
         return {}
 
+    async def _get(self, path: str, params: dict[str, str | int] | None = None) -> dict:
+        items = tuple(sorted((k, normalize_query(v) if k == "query" else v) for k, v in (params or {}).items()))
+        return await replay.upstream(
+            "loki", path, params, lambda: self._flight.do((self._tenant_id, path, items), lambda: self._fetch(path, params))
+        )
+
+    async def _fetch(self, path: str, params: dict[str, str | int] | None) -> dict:
+        endpoint = "loki.label_values" if "/label/" in path else f"loki.{path.rsplit('/', 1)[-1]}"
+        return await resilience.call(
+            endpoint,
+            lambda timeout_s: self._attempt(endpoint, path, params, timeout_s),
+            self._timeout_s,
+        )
+
+    async def _attempt(self, endpoint: str, path: str, params: dict[str, str | int] | None, timeout_s: float) -> dict:
+        async with backpressure.get_guard("loki").slot():
+            with metrics.upstream_call("loki", endpoint) as call:
+                async with httpx.AsyncClient(timeout=timeout_s) as client:
+                    r = await client.get(f"{self._base_url}{path}", params=params, headers=self._headers())
+                call["bytes"] = len(r.content)
+                r.raise_for_status()
+                return r.json()
+
     async def labels(self) -> list[str]:
-        async with httpx.AsyncClient(timeout=self._timeout_s) as client:
-            r = await client.get(f"{self._base_url}/loki/api/v1/labels", headers=self._headers())
-        r.raise_for_status()
-        return (r.json().get("data") or [])[:]
+        data = await self._get("/loki/api/v1/labels")
+        return (data.get("data") or [])[:]
 
     async def label_values(self, label: str) -> list[str]:
-        async with httpx.AsyncClient(timeout=self._timeout_s) as client:
-            r = await client.get(f"{self._base_url}/loki/api/v1/label/{label}/values", headers=self._headers())
-        r.raise_for_status()
-        return (r.json().get("data") or [])[:]
+        data = await self._get(f"/loki/api/v1/label/{label}/values")
+        return (data.get("data") or [])[:]
 
     async def query_range(
         self,
@@ -79,6 +116,7 @@ class LokiClient:
         direction: str = "BACKWARD",
         step_seconds: int | None = None,
     ) -> LokiQueryResult:
+        start, end = align_range(start, end, self._align_s)
         params: dict[str, str | int] = {
             "query": query,
             "start": _dt_to_ns(start),
@@ -88,15 +126,9 @@ class LokiClient:
         }
         if step_seconds is not None:
             params["step"] = step_seconds
-        async with httpx.AsyncClient(timeout=self._timeout_s) as client:
-            r = await client.get(f"{self._base_url}/loki/api/v1/query_range", params=params, headers=self._headers())
-        r.raise_for_status()
-        return LokiQueryResult(raw=r.json())
+        return LokiQueryResult(raw=await self._get("/loki/api/v1/query_range", params))
 
     async def query_instant(self, query: str, at: datetime) -> LokiQueryResult:
         params: dict[str, str | int] = {"query": query, "time": _dt_to_ns(at)}
-        async with httpx.AsyncClient(timeout=self._timeout_s) as client:
-            r = await client.get(f"{self._base_url}/loki/api/v1/query", params=params, headers=self._headers())
-        r.raise_for_status()
-        return LokiQueryResult(raw=r.json())
+        return LokiQueryResult(raw=await self._get("/loki/api/v1/query", params))
 
@@ -4,20 +4,34 @@ import logging
 from datetime import datetime, timedelta, timezone
 import asyncio
 import json
+import time
 import uuid
 from typing import AsyncIterator
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 from .llm import get_llm
 from .loki_client import LokiClient
-from .models import AgentTrace, ChatOpsQueryRequest, ChatOpsQueryResponse, TimeRange, TraceStep
+from .models import (
+    AgentTrace,
+    IterationTiming,
+    ChatOpsQueryRequest,
+    ChatOpsQueryResponse,
+    QueryPlan,
+    TimeRange,
+    TraceBreakdown,
+    TraceStep,
+)
 from .settings import settings
+from . import backpressure, deadline, metrics, plan_cache, replay, resilience, singleflight
 from .agent.executor import build_executor
 from .memory.store import get_memory
 from .tools import build_tools
+from .tools import memo as tool_memo
+from .tools.loki_count_logs import describe_counts
+from .tools.memo import ToolMemo, current_tool_memo
 
 from langchain_core.callbacks import AsyncCallbackHandler
 
@@ -28,10 +42,10 @@ class _HealthzAccessFilter(logging.Filter):
             args = record.args
             if isinstance(args, tuple) and len(args) >= 2:
                 req = args[1]
-                if isinstance(req, str) and "/healthz" in req:
+                if isinstance(req, str) and ("/healthz" in req or "/metrics" in req):
                     return False
             msg = record.getMessage()
-            if "/healthz" in msg:
+            if "/healthz" in msg or "/metrics" in msg:
                 return False
         except Exception:
             return True
@@ -39,6 +53,7 @@ class _HealthzAccessFilter(logging.Filter):
 
 
 logging.getLogger("uvicorn.access").addFilter(_HealthzAccessFilter())
+logger = logging.getLogger(__name__)
 
 
 app = FastAPI(title="ChatOps Service", version="0.1.0")
@@ -48,7 +63,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-loki = LokiClient(settings.loki_base_url, settings.loki_tenant_id, settings.request_timeout_s)
+app.add_middleware(metrics.MetricsMiddleware)
+loki = LokiClient(settings.loki_base_url, settings.loki_tenant_id, settings.request_timeout_s, settings.upstream_align_s)
+
+
+@app.exception_handler(backpressure.BackendUnavailable)
+async def backend_unavailable(request: Request, exc: backpressure.BackendUnavailable) -> JSONResponse:
+    headers = {"Retry-After": str(int(exc.retry_after_s) + 1)} if exc.retry_after_s is not None else None
+    return JSONResponse(status_code=503, content={"detail": str(exc), **exc.observation()}, headers=headers)
 
 
 @app.get("/healthz")
@@ -56,6 +78,23 @@ def healthz() -> dict[str, str]:
     return {"status": "ok", "service": settings.service_name}
 
 
+@app.get("/metrics")
+def prometheus_metrics() -> Response:
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
+
+
+@app.get("/debug/upstream")
+def debug_upstream() -> dict:
+    return {
+        "singleflight": singleflight.stats(),
+        "tool_memo": tool_memo.stats(),
+        "plan_cache": plan_cache.stats(),
+        "endpoints": resilience.stats(),
+        "backends": backpressure.stats(),
+    }
+
+
 def _ensure_utc(dt: datetime) -> datetime:
     if dt.tzinfo is None:
         return dt.replace(tzinfo=timezone.utc)
@@ -75,6 +114,15 @@ def _resolve_timerange(time_range: TimeRange | None) -> tuple[datetime, datetime
         raise HTTPException(status_code=400, detail="必须指定time_range.start与time_range.end，或者last_minutes。")
     return _ensure_utc(time_range.start), _ensure_utc(time_range.end)
 
+
+def _request_window(req: ChatOpsQueryRequest) -> tuple[datetime, datetime]:
+    # 未显式指定时间范围时，问题中的“最近 2 天”等表述优先于默认的 30 分钟
+    window = plan_cache.question_window(req.question) if req.time_range is None else None
+    start, end = window or _resolve_timerange(req.time_range)
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end必须大于start。")
+    return start, end
+
 def _to_cst(dt: datetime) -> datetime:
     return _ensure_utc(dt).astimezone(timezone(timedelta(hours=8)))
 
@@ -99,10 +147,15 @@ def _extract_used_logql(intermediate_steps) -> str | None:
         except Exception:
             continue
         tool = getattr(action, "tool", "") or ""
-        if tool != "loki_query_range_lines":
+        if tool not in ("loki_query_range_lines", "loki_count_logs"):
             continue
         tool_input = getattr(action, "tool_input", None)
         logql = None
+        # 优先取实际执行的查询（可能已被本地校验改写）
+        if isinstance(observation, dict) and not observation.get("error"):
+            logql = observation.get("logql")
+        if logql:
+            return str(logql).strip()
         if isinstance(tool_input, dict):
             logql = tool_input.get("logql")
         elif isinstance(tool_input, str):
@@ -119,7 +172,23 @@ def _extract_used_logql(intermediate_steps) -> str | None:
     return None
 
 
-def _build_trace(intermediate_steps) -> AgentTrace:
+def _llm_usage(response) -> dict:
+    usage = None
+    try:
+        message = getattr(response.generations[0][0], "message", None)
+        usage = getattr(message, "usage_metadata", None)
+    except Exception:
+        usage = None
+    if usage:
+        return {"prompt_tokens": usage.get("input_tokens"), "completion_tokens": usage.get("output_tokens")}
+    token_usage = (getattr(response, "llm_output", None) or {}).get("token_usage") or {}
+    if token_usage:
+        return {"prompt_tokens": token_usage.get("prompt_tokens"), "completion_tokens": token_usage.get("completion_tokens")}
+    return {}
+
+
+def _build_trace(intermediate_steps, executor=None) -> AgentTrace:
+    iterations, tool_timings = executor.step_timings() if executor is not None else ([], {})
     steps: list[TraceStep] = []
     for idx, pair in enumerate(intermediate_steps or []):
         try:
@@ -130,11 +199,15 @@ def _build_trace(intermediate_steps) -> AgentTrace:
         tool_input = getattr(action, "tool_input", None)
         log = getattr(action, "log", None)
         obs_text = _stringify(observation)
+        obs_raw_chars = len(obs_text)
         if len(obs_text) > 8000:
             obs_text = obs_text[:8000] + "\n...(truncated)"
         inp_text = _stringify(tool_input)
         if len(inp_text) > 4000:
             inp_text = inp_text[:4000] + "\n...(truncated)"
+        timing = tool_timings.get(id(action), {})
+        iteration = timing.get("iteration")
+        planned_by = iterations[iteration] if iteration is not None and iteration < len(iterations) else {}
         steps.append(
             TraceStep(
                 index=idx,
@@ -142,9 +215,30 @@ def _build_trace(intermediate_steps) -> AgentTrace:
                 tool_input=inp_text or None,
                 observation=obs_text or None,
                 log=str(log) if log else None,
+                iteration=iteration,
+                started_at=timing.get("started_at"),
+                ended_at=timing.get("ended_at"),
+                started_ms=timing.get("started_ms"),
+                wait_ms=timing.get("wait_ms"),
+                duration_ms=timing.get("duration_ms"),
+                llm_ms=planned_by.get("llm_ms"),
+                observation_raw_chars=obs_raw_chars,
+                observation_chars=len(obs_text),
             )
         )
-    return AgentTrace(steps=steps)
+    breakdown = None
+    if executor is not None and hasattr(executor, "breakdown"):
+        breakdown = TraceBreakdown(
+            **executor.breakdown(),
+            observation_raw_chars=sum(s.observation_raw_chars or 0 for s in steps),
+            observation_chars=sum(s.observation_chars or 0 for s in steps),
+        )
+    return AgentTrace(
+        steps=steps,
+        iterations=[IterationTiming(**it) for it in iterations],
+        stopped_reason=getattr(executor, "stopped_reason", None),
+        breakdown=breakdown,
+    )
 
 
 class ChatOpsStreamHandler(AsyncCallbackHandler):
@@ -154,6 +248,9 @@ class ChatOpsStreamHandler(AsyncCallbackHandler):
         self.step_counter = 0
         self.current_workflow_stage = "thinking"
         self.current_step_id: str | None = None
+        self.tool_step_ids: dict = {}
+        self.run_timings: dict = {}
+        self._started = time.perf_counter()
 
     def _next_step_id(self) -> str:
         self.step_counter += 1
@@ -166,13 +263,33 @@ class ChatOpsStreamHandler(AsyncCallbackHandler):
             "workflow_stage": workflow_stage or self.current_workflow_stage,
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "session_id": self.session_id,
+            "elapsed_ms": round((time.perf_counter() - self._started) * 1000.0, 1),
         }
         payload.update(data)
         await self.queue.put(payload)
 
+    def _begin_run(self, run_id) -> None:
+        if run_id is not None:
+            self.run_timings[run_id] = {
+                "started": time.perf_counter(),
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "ttft_ms": None,
+            }
+
+    def _end_run(self, run_id) -> dict:
+        timing = self.run_timings.pop(run_id, None)
+        if timing is None:
+            return {}
+        return {
+            "started_at": timing["started_at"],
+            "duration_ms": round((time.perf_counter() - timing["started"]) * 1000.0, 1),
+            "ttft_ms": timing["ttft_ms"],
+        }
+
     async def on_llm_start(self, serialized, prompts, **kwargs):
         self.current_workflow_stage = "thinking"
         self.current_step_id = self._next_step_id()
+        self._begin_run(kwargs.get("run_id"))
         prompt = prompts[0] if prompts else ""
         model_name = None
         if isinstance(serialized, dict):
@@ -187,6 +304,9 @@ class ChatOpsStreamHandler(AsyncCallbackHandler):
         )
 
     async def on_llm_new_token(self, token: str, **kwargs):
+        timing = self.run_timings.get(kwargs.get("run_id"))
+        if timing is not None and timing["ttft_ms"] is None:
+            timing["ttft_ms"] = round((time.perf_counter() - timing["started"]) * 1000.0, 1)
         await self._send_event(
             "llm_token",
             {
@@ -211,6 +331,8 @@ class ChatOpsStreamHandler(AsyncCallbackHandler):
             {
                 "response": text,
                 "step_id": self.current_step_id,
+                **self._end_run(kwargs.get("run_id")),
+                **_llm_usage(response),
             },
         )
 
@@ -262,6 +384,10 @@ class ChatOpsStreamHandler(AsyncCallbackHandler):
             return
         self.current_workflow_stage = "executing"
         self.current_step_id = self._next_step_id()
+        run_id = kwargs.get("run_id")
+        if run_id is not None:
+            self.tool_step_ids[run_id] = self.current_step_id
+        self._begin_run(run_id)
         await self._send_event(
             "tool_start",
             {
@@ -274,18 +400,23 @@ class ChatOpsStreamHandler(AsyncCallbackHandler):
     async def on_tool_end(self, output, **kwargs):
         self.current_workflow_stage = "observing"
         observation = _stringify(output)
+        step_id = self.tool_step_ids.pop(kwargs.get("run_id"), None) or self.current_step_id
+        timing = self._end_run(kwargs.get("run_id"))
+        timing.pop("ttft_ms", None)
         await self._send_event(
             "tool_end",
             {
                 "observation": observation,
-                "step_id": self.current_step_id,
+                "step_id": step_id,
+                "observation_chars": len(observation),
+                **timing,
             },
         )
         await self._send_event(
             "agent_observation",
             {
                 "observation": observation,
-                "step_id": self.current_step_id,
+                "step_id": step_id,
             },
         )
 
@@ -300,10 +431,103 @@ class ChatOpsStreamHandler(AsyncCallbackHandler):
         )
 
 
-async def _run_chatops(req: ChatOpsQueryRequest, callbacks: list | None = None) -> ChatOpsQueryResponse:
-    start, end = _resolve_timerange(req.time_range)
-    if end <= start:
-        raise HTTPException(status_code=400, detail="end必须大于start。")
+_SYNTHESIS_PROMPT = (
+    "你是一个面向 Todo_List 项目的 SRE ChatOps 助手。下面给出已按用户问题执行的 Loki 查询及其结果，"
+    "请只基于这些结果用简洁的中文回答问题；结果为空或不足以回答时如实说明，不能编造。"
+)
+
+
+async def _has_history(memory) -> bool:
+    if memory is None:
+        return False
+    try:
+        data = await memory.aload_memory_variables({})
+    except Exception:
+        return True
+    return bool(data.get("chat_history"))
+
+
+async def _run_planned(
+    req: ChatOpsQueryRequest,
+    plan: QueryPlan,
+    plan_key: tuple[str, str | None],
+    start: datetime,
+    end: datetime,
+    agent_input: str,
+    memory,
+    callbacks: list | None,
+) -> ChatOpsQueryResponse | None:
+    """按缓存的查询计划直接查询 Loki：计数、速率、排名类（instant）计划直接给出答案，其余只做一次不带工具的 LLM 总结。
+    计划无法绑定或查询失败时删除该计划并返回 None，由 Agent 接手。"""
+    key, service = plan_key
+    t0 = time.perf_counter()
+    started_at = datetime.now(timezone.utc)
+    try:
+        bound = plan_cache.bind(plan, service)
+        observation = await plan_cache.execute(loki, bound, start, end)
+        if observation.get("error"):
+            raise RuntimeError(observation.get("message") or observation["error"])
+    except Exception:
+        logger.warning("planned query failed, falling back to agent key=%s", key, exc_info=True)
+        await plan_cache.drop(key)
+        return None
+    query_ms = (time.perf_counter() - t0) * 1000.0
+    ended_at = datetime.now(timezone.utc)
+    start_cst = _to_cst(start)
+    end_cst = _to_cst(end)
+    obs_text = plan_cache.describe(observation)
+    if bound.query_kind == "instant":
+        answer = describe_counts(observation, start_cst, end_cst)
+    else:
+        llm = get_llm(streaming=callbacks is not None)
+        config = {"callbacks": callbacks} if callbacks else None
+        message = await llm.ainvoke(
+            [
+                ("system", _SYNTHESIS_PROMPT),
+                (
+                    "human",
+                    f"用户问题：{req.question}\n"
+                    f"时间范围（CST）：{start_cst.isoformat()} ~ {end_cst.isoformat()}\n"
+                    f"LogQL：{bound.logql}\n"
+                    f"查询结果：\n{obs_text}",
+                ),
+            ],
+            config=config,
+        )
+        answer = str(message.content or "").strip()
+    if memory is not None:
+        await memory.asave_context({"input": agent_input}, {"output": answer})
+    step = TraceStep(
+        index=0,
+        tool="plan_cache",
+        tool_input=bound.model_dump_json(),
+        observation=obs_text,
+        started_at=started_at,
+        ended_at=ended_at,
+        started_ms=0.0,
+        duration_ms=round(query_ms, 1),
+        observation_raw_chars=len(obs_text),
+        observation_chars=len(obs_text),
+    )
+    return ChatOpsQueryResponse(
+        answer=answer,
+        used_logql=bound.logql,
+        start=start_cst,
+        end=end_cst,
+        trace=AgentTrace(steps=[step], stopped_reason="plan_cache"),
+        plan=bound,
+    )
+
+
+@metrics.tracked_session
+@replay.session
+@deadline.budgeted
+async def _run_chatops(
+    req: ChatOpsQueryRequest,
+    callbacks: list | None = None,
+    window: tuple[datetime, datetime] | None = None,
+) -> ChatOpsQueryResponse:
+    start, end = window or _request_window(req)
 
     start_cst = _to_cst(start)
     end_cst = _to_cst(end)
@@ -313,11 +537,7 @@ async def _run_chatops(req: ChatOpsQueryRequest, callbacks: list | None = None)
     except Exception:
         service_values = []
 
-    llm = get_llm(streaming=callbacks is not None)
-    tools = build_tools(loki)
     memory = get_memory(req.session_id)
-    executor = build_executor(llm, tools, memory)
-
     services_hint = "、".join(service_values[:50]) if service_values else "未知"
     agent_input = (
         f"用户问题：{req.question}\n"
@@ -325,13 +545,45 @@ async def _run_chatops(req: ChatOpsQueryRequest, callbacks: list | None = None)
         f"已知服务列表（可能不完整）：{services_hint}\n"
         "请在必要时调用工具查询Loki，然后给出最终答案。"
     )
+
+    # 追问依赖上下文，只对会话中的第一个问题查找与学习查询计划
+    plan_key = None
+    if plan_cache.get_store() is not None and not await _has_history(memory):
+        plan_key = plan_cache.question_key(req.question, service_values)
+    if plan_key is not None:
+        plan = await plan_cache.lookup(plan_key[0])
+        if plan is not None:
+            planned = await _run_planned(req, plan, plan_key, start, end, agent_input, memory, callbacks)
+            if planned is not None:
+                return planned
+
+    llm = get_llm(streaming=callbacks is not None)
+    tools = build_tools(loki)
+    executor = build_executor(llm, tools, memory)
     config = {"callbacks": callbacks} if callbacks else None
-    out = await executor.ainvoke({"input": agent_input}, config=config)
+    memo = ToolMemo(req.session_id)
+    memo_token = current_tool_memo.set(memo)
+    try:
+        out = await executor.ainvoke({"input": agent_input}, config=config)
+    finally:
+        memo.cancel_pending()
+        current_tool_memo.reset(memo_token)
     answer = str(out.get("output") or "").strip()
     intermediate_steps = out.get("intermediate_steps")
-    trace = _build_trace(intermediate_steps)
+    trace = _build_trace(intermediate_steps, executor)
     used_logql = _extract_used_logql(intermediate_steps)
-    return ChatOpsQueryResponse(answer=answer, used_logql=used_logql, start=start_cst, end=end_cst, trace=trace)
+    if plan_key is not None and answer and executor.stopped_reason is None:
+        learned = plan_cache.learn_plan(intermediate_steps, req.question, plan_key[1], start, end)
+        if learned is not None:
+            await plan_cache.learn(plan_key[0], learned)
+    return ChatOpsQueryResponse(
+        answer=answer,
+        used_logql=used_logql,
+        start=start_cst,
+        end=end_cst,
+        trace=trace,
+        tool_memo=memo.info(),
+    )
 
 
 @app.post("/api/chatops/query", response_model=ChatOpsQueryResponse)
@@ -341,12 +593,12 @@ async def query(req: ChatOpsQueryRequest) -> ChatOpsQueryResponse:
 
 @app.post("/api/chatops/query/stream")
 async def query_stream(req: ChatOpsQueryRequest):
-    queue: asyncio.Queue = asyncio.Queue()
+    queue: asyncio.Queue = metrics.track_queue(asyncio.Queue())
 
     async def runner():
         try:
             handler = ChatOpsStreamHandler(queue)
-            start, end = _resolve_timerange(req.time_range)
+            start, end = _request_window(req)
             start_cst = _to_cst(start)
             end_cst = _to_cst(end)
             await queue.put(
@@ -356,7 +608,7 @@ async def query_stream(req: ChatOpsQueryRequest):
                     "end": end_cst.isoformat(),
                 }
             )
-            res = await _run_chatops(req, callbacks=[handler])
+            res = await _run_chatops(req, callbacks=[handler], window=(start, end))
             meta = {
                 "event": "final",
                 "answer": res.answer,
@@ -364,6 +616,7 @@ async def query_stream(req: ChatOpsQueryRequest):
                 "start": res.start.isoformat() if res.start else None,
                 "end": res.end.isoformat() if res.end else None,
                 "trace": res.trace.dict() if res.trace else None,
+                "plan": res.plan.dict() if res.plan else None,
             }
             await queue.put(meta)
         except Exception as exc:
@@ -376,7 +629,7 @@ async def query_stream(req: ChatOpsQueryRequest):
     async def iterator() -> AsyncIterator[bytes]:
         while True:
             item = await queue.get()
-            data = json.dumps(item, ensure_ascii=False) + "\n"
+            data = json.dumps(item, ensure_ascii=False, default=str) + "\n"
             yield data.encode("utf-8")
             if item.get("event") == "end":
                 break
@@ -12,10 +12,52 @@ class TraceStep(BaseModel):
     tool_input: str | None = None
     observation: str | None = None
     log: str | None = None
+    iteration: int | None = None
+    started_at: datetime | None = None
+    ended_at: datetime | None = None
+    started_ms: float | None = None
+    wait_ms: float | None = None
+    duration_ms: float | None = None
+    llm_ms: float | None = None
+    observation_raw_chars: int | None = None
+    observation_chars: int | None = None
+
+
+class IterationTiming(BaseModel):
+    index: int
+    started_at: datetime | None = None
+    ended_at: datetime | None = None
+    started_ms: float | None = None
+    llm_ms: float | None = None
+    ttft_ms: float | None = None
+    tools_ms: float | None = None
+    wall_ms: float | None = None
+    tool_calls: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+
+
+class TraceBreakdown(BaseModel):
+    wall_ms: float | None = None
+    llm_ms: float | None = None
+    tool_wall_ms: float | None = None
+    tool_ms: float | None = None
+    other_ms: float | None = None
+    iterations: int = 0
+    tool_calls: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    observation_raw_chars: int = 0
+    observation_chars: int = 0
 
 
 class AgentTrace(BaseModel):
     steps: list[TraceStep] = []
+    iterations: list[IterationTiming] = []
+    stopped_reason: str | None = None
+    breakdown: TraceBreakdown | None = None
 
 
 class TimeRange(BaseModel):
@@ -30,16 +72,31 @@ class ChatOpsQueryRequest(BaseModel):
     session_id: str | None = Field(default=None, max_length=200)
 
 
+class QueryPlan(BaseModel):
+    query_kind: Literal["instant", "range"]
+    logql: str
+    intent: str
+    step_seconds: int | None = Field(default=None, ge=1, le=3600)
+    group_by: list[str] = []
+    top_n: int | None = Field(default=None, ge=1)
+    per_second: bool = False
+
+
+class ToolMemoInfo(BaseModel):
+    session_id: str
+    hits: int = 0
+    misses: int = 0
+    session_hits: int = 0
+    session_misses: int = 0
+    session_hit_rate: float | None = None
+
+
 class ChatOpsQueryResponse(BaseModel):
     answer: str
     used_logql: str | None = None
     start: datetime | None = None
     end: datetime | None = None
     trace: AgentTrace | None = None
+    tool_memo: ToolMemoInfo | None = None
+    plan: QueryPlan | None = None
 
-
-class QueryPlan(BaseModel):
-    query_kind: Literal["instant", "range"]
-    logql: str
-    intent: str
-    step_seconds: int | None = Field(default=None, ge=1, le=3600)
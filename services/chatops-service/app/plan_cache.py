@@ -0,0 +1,324 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from .loki_client import LokiClient
+from .models import QueryPlan
+from .settings import settings
+from .tools.loki_count_logs import count_logs
+
+
+logger = logging.getLogger(__name__)
+
+SERVICE_VAR = "$__service"
+_SERVICE_TOKEN = "__svc__"
+_DURATION = re.compile(
+    r"(?:最近|过去|近|last|past)?\s*(\d+(?:\.\d+)?)\s*"
+    r"(?:(秒|分钟|小时|天)|(secs?|seconds?|mins?|minutes?|hours?|hrs?|days?|[smhd])\b)"
+)
+_TODAY = re.compile(r"今天|\btoday\b")
+_VAGUE_TIME = re.compile(r"最近|过去|刚才|刚刚|目前|当前|现在|\brecently\b|\brecent\b|\bnow\b")
+_UNIT_S = {"秒": 1, "分钟": 60, "小时": 3600, "天": 86400, "s": 1, "m": 60, "h": 3600, "d": 86400}
+_CST = timezone(timedelta(hours=8))
+# Agent 实际查询的时间范围与请求时间范围的允许偏差，超出则不学习
+_WINDOW_SLACK_S = 120
+_COUNT = re.compile(r"多少|几次|几条|几个|次数|数量|总数|how many|\bcount\b")
+
+
+def _duration_s(m: re.Match) -> int:
+    unit = m.group(2) or m.group(3)[0]
+    return round(float(m.group(1)) * _UNIT_S[unit])
+
+
+def question_window(question: str, now: datetime | None = None) -> tuple[datetime, datetime] | None:
+    """解析问题中的相对时间表述（“最近 2 天”“past 30 minutes”“今天”），返回对应的 UTC 时间范围；没有时返回 None。"""
+    end = now or datetime.now(timezone.utc)
+    text = question.lower()
+    m = _DURATION.search(text)
+    if m is not None:
+        seconds = _duration_s(m)
+        return (end - timedelta(seconds=seconds), end) if seconds > 0 else None
+    if _TODAY.search(text):
+        midnight = end.astimezone(_CST).replace(hour=0, minute=0, second=0, microsecond=0)
+        return midnight.astimezone(timezone.utc), end
+    return None
+
+
+def question_key(question: str, services: list[str]) -> tuple[str, str | None] | None:
+    """把问题归一化为缓存键：服务名替换为占位符，相对时间表述按时长归一（“最近 2 天”与“过去 48 小时”同键，
+    与“最近 30 分钟”不同键），去掉不指定时长的时间词与标点空白。
+
+    提到多个不同服务的问题无法用单个服务参数化，返回 None。
+    """
+    text = question.lower()
+    found: set[str] = set()
+    for service in sorted(services, key=len, reverse=True):
+        name = service.lower()
+        if name and name in text:
+            found.add(service)
+            text = text.replace(name, _SERVICE_TOKEN)
+    if len(found) > 1:
+        return None
+    text = _DURATION.sub(lambda m: f"__{_duration_s(m)}s__", text)
+    text = _TODAY.sub("__today__", text)
+    text = _VAGUE_TIME.sub("", text)
+    text = re.sub(r"[^\w]+", "", text)
+    if not text:
+        return None
+    return text[:500], next(iter(found), None)
+
+
+def _parse_iso(value) -> datetime | None:
+    try:
+        dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+
+def _same_window(tool_input: dict, start: datetime, end: datetime) -> bool:
+    q_start, q_end = _parse_iso(tool_input.get("start_iso")), _parse_iso(tool_input.get("end_iso"))
+    if q_start is None or q_end is None:
+        return False
+    return abs((q_start - start).total_seconds()) <= _WINDOW_SLACK_S and abs((q_end - end).total_seconds()) <= _WINDOW_SLACK_S
+
+
+def learn_plan(
+    intermediate_steps, question: str, service: str | None, start: datetime, end: datetime
+) -> QueryPlan | None:
+    """从一次成功的 Agent 运行中提取查询计划：只在全部数据来自同一条 Loki 查询、且查询的时间范围就是
+    请求的时间范围 [start, end] 时才学习（计划执行时按请求的时间范围绑定）。
+
+    用 loki_count_logs 计数的学成 instant 计划；用 loki_query_range_lines 拉日志回答计数类问题的，
+    同样学成 instant 计划，以后改为在 Loki 侧计数。记录的是实际执行（经本地校验改写后）的查询。
+    """
+    calls: dict[str, tuple[str, dict, str]] = {}
+    for pair in intermediate_steps or []:
+        try:
+            action, observation = pair
+        except Exception:
+            return None
+        tool = getattr(action, "tool", "") or ""
+        if tool == "trace_note":
+            continue
+        tool_input = getattr(action, "tool_input", None)
+        if tool not in ("loki_query_range_lines", "loki_count_logs") or not isinstance(tool_input, dict):
+            return None
+        if not isinstance(observation, dict) or observation.get("error"):
+            return None
+        if not _same_window(tool_input, start, end):
+            return None
+        args = {k: v for k, v in tool_input.items() if k not in ("start_iso", "end_iso")}
+        executed = str(observation.get("logql") or args.get("logql") or "")
+        calls[json.dumps([tool, args], sort_keys=True, ensure_ascii=False, default=str)] = (tool, args, executed)
+    if len(calls) != 1:
+        return None
+    tool, args, logql = next(iter(calls.values()))
+    logql = logql.strip()
+    if not logql:
+        return None
+    if service is not None:
+        quoted = f'"{service}"'
+        if quoted not in logql:
+            return None
+        logql = logql.replace(quoted, f'"{SERVICE_VAR}"')
+    try:
+        if tool == "loki_count_logs":
+            top_n = args.get("top_n")
+            per_second = bool(args.get("per_second"))
+            return QueryPlan(
+                query_kind="instant",
+                logql=logql,
+                intent="topk" if top_n else ("rate" if per_second else "count"),
+                group_by=list(args.get("by") or []),
+                top_n=top_n,
+                per_second=per_second,
+            )
+        step_seconds = args.get("step_seconds")
+        is_log_query = logql.lstrip().startswith("{")
+        if bool(_COUNT.search(question.lower())) and is_log_query and step_seconds is None:
+            return QueryPlan(query_kind="instant", logql=logql, intent="count")
+        return QueryPlan(
+            query_kind="range",
+            logql=logql,
+            intent="lines" if is_log_query else "metric",
+            step_seconds=step_seconds,
+        )
+    except ValueError:
+        return None
+
+
+def bind(plan: QueryPlan, service: str | None) -> QueryPlan:
+    logql = plan.logql
+    if SERVICE_VAR in logql:
+        if service is None:
+            raise ValueError("计划需要服务名，但问题中未提到已知服务")
+        logql = logql.replace(SERVICE_VAR, service)
+    return plan.model_copy(update={"logql": logql})
+
+
+async def execute(loki: LokiClient, plan: QueryPlan, start: datetime, end: datetime) -> dict:
+    """执行已绑定的计划，返回与对应工具相同结构的观测结果。"""
+    if plan.query_kind == "instant":
+        return await count_logs(loki, plan.logql, start, end, plan.group_by, plan.top_n, plan.per_second)
+    limit = settings.plan_cache_line_limit
+    res = await loki.query_range(plan.logql, start=start, end=end, limit=limit, step_seconds=plan.step_seconds)
+    lines = res.flatten_log_lines(limit=limit)
+    return {
+        "logql": plan.logql,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "limit": limit,
+        "step_seconds": plan.step_seconds,
+        "line_count": len(lines),
+        "lines": lines,
+    }
+
+
+class PlanStore:
+    """问题模板 → QueryPlan 的本地存储（SQLite）。
+
+    同一键连续学到相同计划的次数记为 successes，达到 PLAN_CACHE_MIN_SUCCESSES 才会被直接执行；
+    学到不同计划时替换并重新计数，执行失败时删除。命中不刷新 updated_at，过期后需要 Agent 重新验证。
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_plans ("
+            " question_key TEXT PRIMARY KEY,"
+            " plan TEXT NOT NULL,"
+            " successes INTEGER NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0,"
+            " updated_at REAL NOT NULL)"
+        )
+        self.lookups = 0
+        self.hits = 0
+        self.learned = 0
+        self.dropped = 0
+
+    def lookup(self, key: str) -> QueryPlan | None:
+        cutoff = time.time() - settings.plan_cache_ttl_h * 3600
+        with self._lock:
+            self.lookups += 1
+            row = self._conn.execute(
+                "SELECT plan FROM query_plans WHERE question_key = ? AND successes >= ? AND updated_at >= ?",
+                (key, settings.plan_cache_min_successes, cutoff),
+            ).fetchone()
+            if row is None:
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE query_plans SET hits = hits + 1 WHERE question_key = ?", (key,))
+        return QueryPlan.model_validate_json(row[0])
+
+    def learn(self, key: str, plan: QueryPlan) -> None:
+        payload = plan.model_dump_json()
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT plan FROM query_plans WHERE question_key = ?", (key,)).fetchone()
+                if row is not None and row[0] == payload:
+                    self._conn.execute(
+                        "UPDATE query_plans SET successes = successes + 1, updated_at = ? WHERE question_key = ?",
+                        (now, key),
+                    )
+                else:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO query_plans (question_key, plan, successes, hits, updated_at)"
+                        " VALUES (?, ?, 1, 0, ?)",
+                        (key, payload, now),
+                    )
+                self._conn.execute(
+                    "DELETE FROM query_plans WHERE question_key NOT IN ("
+                    " SELECT question_key FROM query_plans ORDER BY updated_at DESC LIMIT ?)",
+                    (settings.plan_cache_max_entries,),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.learned += 1
+
+    def drop(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM query_plans WHERE question_key = ?", (key,))
+            self.dropped += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            plans, ready = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(successes >= ?), 0) FROM query_plans",
+                (settings.plan_cache_min_successes,),
+            ).fetchone()
+        return {
+            "plans": plans,
+            "ready": ready,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "learned": self.learned,
+            "dropped": self.dropped,
+        }
+
+
+_store: PlanStore | None = None
+
+
+def get_store() -> PlanStore | None:
+    global _store
+    if not settings.plan_cache_enabled or settings.replay_mode != "off":
+        return None
+    if _store is None:
+        _store = PlanStore(settings.plan_cache_path)
+    return _store
+
+
+async def lookup(key: str) -> QueryPlan | None:
+    store = get_store()
+    if store is None:
+        return None
+    try:
+        return await asyncio.to_thread(store.lookup, key)
+    except (sqlite3.Error, ValueError):
+        logger.warning("plan cache lookup failed", exc_info=True)
+        return None
+
+
+async def learn(key: str, plan: QueryPlan) -> None:
+    store = get_store()
+    if store is None:
+        return
+    try:
+        await asyncio.to_thread(store.learn, key, plan)
+    except sqlite3.Error:
+        logger.warning("plan cache learn failed", exc_info=True)
+
+
+async def drop(key: str) -> None:
+    store = get_store()
+    if store is None:
+        return
+    try:
+        await asyncio.to_thread(store.drop, key)
+    except sqlite3.Error:
+        logger.warning("plan cache drop failed", exc_info=True)
+
+
+def stats() -> dict | None:
+    store = get_store()
+    return store.stats() if store is not None else None
+
+
+def describe(observation: dict) -> str:
+    text = json.dumps(observation, ensure_ascii=False, default=str)
+    return text if len(text) <= 8000 else text[:8000] + "\n...(truncated)"
@@ -13,7 +13,63 @@ class Settings(BaseSettings):
     prometheus_base_url: str = "http://prometheus-server.observability.svc.cluster.local:80"
 
     request_timeout_s: float = 60.0
+    request_budget_s: float = 90.0
+    deadline_reserve_s: float = 8.0
+    upstream_align_s: float = 5.0
+    upstream_max_retries: int = 2
+    upstream_retry_base_s: float = 0.2
+    upstream_retry_max_s: float = 2.0
+    upstream_hedge_enabled: bool = True
+    upstream_hedge_quantile: float = 0.95
+    upstream_hedge_min_samples: int = 20
+    upstream_hedge_min_delay_s: float = 0.05
+    backend_limit_initial: int = 8
+    backend_limit_min: int = 1
+    backend_limit_max: int = 64
+    backend_limit_tolerance: float = 2.0
+    backend_limit_backoff: float = 0.75
+    backend_limit_baseline_alpha: float = 0.05
+    backend_queue_timeout_s: float = 10.0
+    backend_breaker_failures: int = 5
+    backend_breaker_cooldown_s: float = 15.0
     max_log_lines: int = 500
+    logql_validate_enabled: bool = True
+    logql_catalog_ttl_s: float = 300.0
+    logql_max_range_h: float = 721.0
+    logql_max_points: int = 11000
+
+    session_backend: str = "memory"
+    session_ttl_s: float = 3600.0
+    session_max_turns: int = 50
+    session_sqlite_path: str = "/tmp/aegis-chatops-sessions.db"
+    session_redis_url: str = "redis://localhost:6379/0"
+    session_key_prefix: str = "aegis:chatops:session:"
+    memory_mode: str = "buffer"
+    memory_recent_turns: int = 3
+    memory_token_budget: int = 1500
+    memory_fold_batch_turns: int = 2
+    memory_summary_max_tokens: int = 400
+
+    tool_memo_enabled: bool = True
+    tool_memo_fresh_s: float = 30.0
+    tool_memo_settle_s: float = 300.0
+    tool_memo_max_sessions: int = 64
+    tool_memo_max_entries: int = 32
+
+    plan_cache_enabled: bool = True
+    plan_cache_path: str = "/tmp/aegis-chatops-plans.db"
+    plan_cache_min_successes: int = 2
+    plan_cache_ttl_h: float = 168.0
+    plan_cache_max_entries: int = 1000
+    plan_cache_line_limit: int = 200
+
+    agent_max_tool_concurrency: int = 4
+
+    replay_mode: str = "off"
+    replay_dir: str = "/tmp/aegis-chatops-replay"
+    replay_fixture: str | None = None
+    replay_speed: float = 1.0
+    replay_latency_ms: float = 0.0
 
     llm_model: str = "doubao-seed-1-6-251015"
     ark_api_key: str | None = None
@@ -3,9 +3,11 @@ from __future__ import annotations
 from ..loki_client import LokiClient
 from .trace_note import trace_note
 from .loki_query_range_lines import make_loki_query_range_lines
+from .loki_count_logs import make_loki_count_logs
 from .prometheus_query_range import prometheus_query_range
 
 
 def build_tools(loki: LokiClient):
     loki_query_tool = make_loki_query_range_lines(loki)
-    return [trace_note, loki_query_tool, prometheus_query_range]
+    loki_count_tool = make_loki_count_logs(loki)
+    return [trace_note, loki_query_tool, loki_count_tool, prometheus_query_range]
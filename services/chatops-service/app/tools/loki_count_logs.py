@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import asyncio
+import re
+from datetime import datetime, timezone
+
+from langchain_core.tools import tool
+
+from ..backpressure import BackendUnavailable
+from ..logql import LogQLError, validate, validate_window
+from ..loki_client import LokiClient
+from ..settings import settings
+from ..singleflight import align_range
+from .memo import memo_key, memoized
+
+
+_LABEL = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def _parse_dt(iso: str) -> datetime:
+    dt = datetime.fromisoformat(iso.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def build_query(
+    logql: str,
+    range_s: int,
+    by: list[str] | None = None,
+    top_n: int | None = None,
+    per_second: bool = False,
+) -> str:
+    inner = f"{'rate' if per_second else 'count_over_time'}({logql} [{range_s}s])"
+    if not by:
+        return f"sum({inner})"
+    grouped = f"sum by ({', '.join(by)}) ({inner})"
+    return f"topk({top_n}, {grouped})" if top_n else grouped
+
+
+async def count_logs(
+    loki: LokiClient,
+    logql: str,
+    start: datetime,
+    end: datetime,
+    by: list[str] | None = None,
+    top_n: int | None = None,
+    per_second: bool = False,
+) -> dict:
+    """在 Loki 侧用 count_over_time / rate 聚合整个时间窗口，只返回总数与各分组的数值。"""
+    by = [b.strip() for b in by or [] if b and b.strip()]
+    original = logql
+    notes: list[str] = []
+    try:
+        validate_window(start, end, None)
+        if settings.logql_validate_enabled:
+            checked = await validate(loki, logql)
+            logql = checked.query
+            notes = checked.rewrites
+    except LogQLError as exc:
+        return {**exc.observation(), "logql": original, "start": start.isoformat(), "end": end.isoformat()}
+    q_start, q_end = align_range(start, end, settings.upstream_align_s)
+    range_s = max(1, round((q_end - q_start).total_seconds()))
+    query = build_query(logql, range_s, by, top_n, per_second)
+    info = {
+        "logql": logql,
+        "query": query,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "range_s": range_s,
+        "per_second": per_second,
+        "by": by,
+        "top_n": top_n,
+    }
+    if notes:
+        info["rewritten_from"] = original
+        info["rewrites"] = notes
+    bad = [b for b in by if not _LABEL.match(b)]
+    if bad:
+        return {**info, "error": "invalid_label", "message": f"非法的分组标签：{', '.join(bad)}"}
+    if top_n is not None and top_n < 1:
+        return {**info, "error": "invalid_top_n", "message": "top_n 必须为正整数"}
+    jobs = [loki.query_instant(query, q_end)]
+    if by and top_n:
+        jobs.append(loki.query_instant(build_query(logql, range_s, per_second=per_second), q_end))
+    try:
+        results = await asyncio.gather(*jobs)
+    except BackendUnavailable as exc:
+        return {**info, **exc.observation()}
+    except Exception as exc:
+        return {**info, "error": "loki_query_failed", "message": str(exc)[:500]}
+    samples = sorted(results[0].vector(), key=lambda s: -s[1])[: top_n or None]
+    total = results[1].extract_instant_number() if len(results) > 1 else sum(v for _, v in samples)
+    return {
+        **info,
+        "total": round(total or 0.0, 4),
+        "groups": [{"labels": labels, "value": round(value, 4)} for labels, value in samples] if by else [],
+    }
+
+
+def describe_counts(result: dict, start_cst: datetime, end_cst: datetime) -> str:
+    """把 count_logs 的结果写成一句可直接返回给用户的中文回答。"""
+    window = f"{start_cst:%Y-%m-%d %H:%M} ~ {end_cst:%Y-%m-%d %H:%M}（CST）期间"
+    unit = "条/秒" if result.get("per_second") else "条"
+    head = "平均速率" if result.get("per_second") else "共"
+    text = f"{window}，匹配 {result['logql']} 的日志{head} {result['total']:g} {unit}"
+    groups = result.get("groups") or []
+    if groups:
+        by = "、".join(result.get("by") or [])
+        label = f"前 {result['top_n']} 个" if result.get("top_n") else "各分组"
+        items = "，".join(
+            f"{'/'.join(str(v) for v in g['labels'].values()) or '（无标签）'} {g['value']:g}" for g in groups
+        )
+        text += f"；按 {by} 统计，{label}：{items}"
+    return text + "。"
+
+
+def make_loki_count_logs(loki: LokiClient):
+    @tool(
+        "loki_count_logs",
+        description=(
+            "统计时间范围内匹配 LogQL 日志查询的日志条数，在 Loki 侧用 count_over_time（per_second=true 时为 rate）聚合，"
+            "只返回总数与分组数值而不返回原始日志。适用于“有多少条 / 发生几次 / 每秒多少 / 哪个服务或 Pod 最多”类问题："
+            "logql 只写日志查询（选择器与过滤，如 {app=\"ai-service\"} |~ \" 5\\\\d\\\\d \"），"
+            "by 为分组标签（如 ['app']、['pod']），top_n 只保留数值最大的前 N 组。"
+        ),
+    )
+    async def loki_count_logs(
+        logql: str,
+        start_iso: str,
+        end_iso: str,
+        by: list[str] | None = None,
+        top_n: int | None = None,
+        per_second: bool = False,
+    ) -> dict:
+        start = _parse_dt(start_iso)
+        end = _parse_dt(end_iso)
+        return await memoized(
+            memo_key("loki_count_logs", start, end, logql, by or [], top_n, per_second),
+            lambda: count_logs(loki, logql, start, end, by, top_n, per_second),
+        )
+
+    return loki_count_logs
@@ -1,10 +1,19 @@
 from __future__ import annotations
 
+import re
 from datetime import datetime, timezone
 
 from langchain_core.tools import tool
 
+from ..backpressure import BackendUnavailable
+from ..logql import LogQLError, validate, validate_window
 from ..loki_client import LokiClient
+from ..settings import settings
+from ..singleflight import align_range
+from .memo import memo_key, memoized
+
+
+_LINE_TS = re.compile(r"^(\d{19}) ")
 
 
 def _parse_dt(iso: str) -> datetime:
@@ -14,28 +23,59 @@ def _parse_dt(iso: str) -> datetime:
     return dt.astimezone(timezone.utc)
 
 
+def narrow_lines(result: dict, start: datetime, end: datetime) -> dict | None:
+    """从覆盖更大时间范围、且未被 limit 截断的日志查询结果中截取 [start, end] 内的行。"""
+    lines = result.get("lines")
+    if lines is None or result.get("step_seconds") is not None or result.get("line_count", 0) >= result.get("limit", 0):
+        return None
+    q_start, q_end = align_range(start, end, settings.upstream_align_s)
+    lo, hi = int(q_start.timestamp() * 1_000_000_000), int(q_end.timestamp() * 1_000_000_000)
+    kept = []
+    for line in lines:
+        m = _LINE_TS.match(line)
+        if m is None:
+            return None
+        if lo <= int(m.group(1)) <= hi:
+            kept.append(line)
+    return {**result, "start": start.isoformat(), "end": end.isoformat(), "line_count": len(kept), "lines": kept}
+
+
 def make_loki_query_range_lines(loki: LokiClient):
-    @tool("loki_query_range_lines", description="按时间范围执行 LogQL 查询，返回日志行及元信息。")
-    async def loki_query_range_lines(
+    async def run(
         logql: str,
-        start_iso: str,
-        end_iso: str,
-        limit: int = 200,
-        direction: str = "BACKWARD",
-        step_seconds: int | None = None,
+        start: datetime,
+        end: datetime,
+        limit: int,
+        direction: str,
+        step_seconds: int | None,
     ) -> dict:
-        start = _parse_dt(start_iso)
-        end = _parse_dt(end_iso)
-        res = await loki.query_range(
-            logql,
-            start=start,
-            end=end,
-            limit=limit,
-            direction=direction,
-            step_seconds=step_seconds,
-        )
+        original = logql
+        notes: list[str] = []
+        try:
+            step_seconds, notes = validate_window(start, end, step_seconds)
+            if settings.logql_validate_enabled:
+                checked = await validate(loki, logql)
+                logql = checked.query
+                notes += checked.rewrites
+        except LogQLError as exc:
+            return {**exc.observation(), "logql": original, "start": start.isoformat(), "end": end.isoformat()}
+        if not 1 <= limit <= settings.max_log_lines:
+            clamped = min(max(1, limit), settings.max_log_lines)
+            notes.append(f"limit={limit} 超出范围 [1, {settings.max_log_lines}]，已改为 {clamped}")
+            limit = clamped
+        try:
+            res = await loki.query_range(
+                logql,
+                start=start,
+                end=end,
+                limit=limit,
+                direction=direction,
+                step_seconds=step_seconds,
+            )
+        except BackendUnavailable as exc:
+            return {**exc.observation(), "logql": logql, "start": start.isoformat(), "end": end.isoformat()}
         lines = res.flatten_log_lines(limit=limit)
-        return {
+        out = {
             "logql": logql,
             "start": start.isoformat(),
             "end": end.isoformat(),
@@ -45,6 +85,26 @@ def make_loki_query_range_lines(loki: LokiClient):
             "line_count": len(lines),
             "lines": lines,
         }
+        if notes:
+            out["rewritten_from"] = original
+            out["rewrites"] = notes
+        return out
 
-    return loki_query_range_lines
+    @tool("loki_query_range_lines", description="按时间范围执行 LogQL 查询，返回日志行及元信息。")
+    async def loki_query_range_lines(
+        logql: str,
+        start_iso: str,
+        end_iso: str,
+        limit: int = 200,
+        direction: str = "BACKWARD",
+        step_seconds: int | None = None,
+    ) -> dict:
+        start = _parse_dt(start_iso)
+        end = _parse_dt(end_iso)
+        return await memoized(
+            memo_key("loki_query_range_lines", start, end, logql, limit, direction, step_seconds),
+            lambda: run(logql, start, end, limit, direction, step_seconds),
+            narrow_lines,
+        )
 
+    return loki_query_range_lines
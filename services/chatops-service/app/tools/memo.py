@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+
+from ..settings import settings
+from ..singleflight import normalize_query
+
+
+Narrow = Callable[[Any, datetime, datetime], Any]
+
+
+def _epoch(dt: datetime) -> int:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def memo_key(tool: str, start: datetime, end: datetime, *args: Any) -> tuple:
+    parts: list[Any] = [tool, _epoch(start), _epoch(end)]
+    for arg in args:
+        if isinstance(arg, str):
+            parts.append(normalize_query(arg))
+        elif isinstance(arg, (list, tuple)):
+            parts.append(tuple(sorted(str(a) for a in arg)))
+        else:
+            parts.append(arg)
+    return tuple(parts)
+
+
+def _complete(result: Any) -> bool:
+    return isinstance(result, dict) and not result.get("error") and not result.get("failed_queries")
+
+
+@dataclass
+class _Entry:
+    start: int
+    end: int
+    settled_end: int
+    fetched_at: float
+    result: Any
+
+
+class SessionMemo:
+    """同一 session_id 跨轮次的工具结果：键为工具名与除时间范围外的参数，时间范围单独比较。
+
+    - 时间范围完全相同：查询时窗口已稳定，或结果获取不超过 TOOL_MEMO_FRESH_S，即可复用；
+    - 被已有结果的时间范围包含：由工具提供的 narrow 从已有结果中截取，只使用查询时已稳定的那一段。
+
+    结果只保存在本进程内存中，不写入 SESSION_BACKEND：会话历史可以跨副本共享，但后续轮次落到其它副本时
+    不会命中，只是照常查询上游（需要跨轮复用时，应让同一会话的请求粘滞到同一副本）。
+    """
+
+    def __init__(self) -> None:
+        self._entries: OrderedDict[tuple, list[_Entry]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.touched = time.monotonic()
+
+    def lookup(self, key: tuple, narrow: Narrow | None) -> tuple[bool, Any]:
+        scope, start, end = (key[0], *key[3:]), key[1], key[2]
+        now = time.time()
+        for entry in reversed(self._entries.get(scope) or []):
+            if entry.start == start and entry.end == end:
+                if entry.settled_end >= end or now - entry.fetched_at <= settings.tool_memo_fresh_s:
+                    self._entries.move_to_end(scope)
+                    return True, entry.result
+            elif narrow is not None and entry.start <= start and end <= entry.settled_end:
+                narrowed = narrow(
+                    entry.result,
+                    datetime.fromtimestamp(start, tz=timezone.utc),
+                    datetime.fromtimestamp(end, tz=timezone.utc),
+                )
+                if narrowed is not None:
+                    self._entries.move_to_end(scope)
+                    return True, narrowed
+        return False, None
+
+    def record(self, key: tuple, result: Any, fetched_at: float) -> None:
+        if not _complete(result):
+            return
+        scope, start, end = (key[0], *key[3:]), key[1], key[2]
+        settled_end = min(end, int(fetched_at - settings.tool_memo_settle_s))
+        entries = [e for e in self._entries.pop(scope, []) if not (e.start == start and e.end == end)]
+        entries.append(_Entry(start, end, settled_end, fetched_at, result))
+        self._entries[scope] = entries[-4:]
+        while sum(len(v) for v in self._entries.values()) > settings.tool_memo_max_entries:
+            self._entries.popitem(last=False)
+
+    @property
+    def entries(self) -> int:
+        return sum(len(v) for v in self._entries.values())
+
+
+_sessions: OrderedDict[str, SessionMemo] = OrderedDict()
+
+
+def session_memo(session_id: str | None) -> SessionMemo | None:
+    if not session_id or not settings.tool_memo_enabled or settings.replay_mode != "off":
+        return None
+    now = time.monotonic()
+    while _sessions:
+        oldest = next(iter(_sessions.values()))
+        if now - oldest.touched <= settings.session_ttl_s:
+            break
+        _sessions.popitem(last=False)
+    memo = _sessions.pop(session_id, None) or SessionMemo()
+    memo.touched = now
+    _sessions[session_id] = memo
+    while len(_sessions) > settings.tool_memo_max_sessions:
+        _sessions.popitem(last=False)
+    return memo
+
+
+def stats() -> dict:
+    hits = sum(m.hits for m in _sessions.values())
+    misses = sum(m.misses for m in _sessions.values())
+    return {
+        "sessions": len(_sessions),
+        "entries": sum(m.entries for m in _sessions.values()),
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+    }
+
+
+class ToolMemo:
+    """单次请求内的工具结果备忘：Agent 对同一查询的重复调用共享同一个 Task；
+    带 session_id 时，未命中的查询先到该会话此前轮次的结果中查找，完成的结果也记入会话。"""
+
+    def __init__(self, session_id: str | None = None) -> None:
+        self._tasks: dict[tuple, asyncio.Task] = {}
+        self._session = session_memo(session_id)
+        self.session_id = session_id if self._session is not None else None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, key: tuple, factory: Callable[[], Awaitable[Any]], narrow: Narrow | None = None) -> asyncio.Task:
+        task = self._tasks.get(key)
+        if task is not None:
+            return task
+        session = self._session
+        found, value = session.lookup(key, narrow) if session is not None else (False, None)
+        if found:
+            self.hits += 1
+            session.hits += 1
+            task = asyncio.ensure_future(asyncio.sleep(0, value))
+        else:
+            self.misses += 1
+            if session is not None:
+                session.misses += 1
+            task = asyncio.ensure_future(self._run(key, factory))
+        self._tasks[key] = task
+        return task
+
+    async def _run(self, key: tuple, factory: Callable[[], Awaitable[Any]]) -> Any:
+        fetched_at = time.time()
+        result = await factory()
+        if self._session is not None:
+            self._session.record(key, result, fetched_at)
+        return result
+
+    async def get_or_run(self, key: tuple, factory: Callable[[], Awaitable[Any]], narrow: Narrow | None = None) -> Any:
+        if key in self._tasks:
+            self.hits += 1
+        return await asyncio.shield(self.start(key, factory, narrow))
+
+    def cancel_pending(self) -> None:
+        for task in self._tasks.values():
+            if not task.done():
+                task.cancel()
+
+    def info(self) -> dict | None:
+        if self._session is None:
+            return None
+        session = self._session
+        total = session.hits + session.misses
+        return {
+            "session_id": self.session_id,
+            "hits": self.hits,
+            "misses": self.misses,
+            "session_hits": session.hits,
+            "session_misses": session.misses,
+            "session_hit_rate": round(session.hits / total, 3) if total else None,
+        }
+
+
+current_tool_memo: contextvars.ContextVar[ToolMemo | None] = contextvars.ContextVar("current_tool_memo", default=None)
+
+
+async def memoized(key: tuple, factory: Callable[[], Awaitable[Any]], narrow: Narrow | None = None) -> Any:
+    memo = current_tool_memo.get()
+    if memo is None:
+        return await factory()
+    return await memo.get_or_run(key, factory, narrow)
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app import logql
+from app.logql import LogQLError, parse, regex_error, rewrite, validate_window
+
+
+LABELS = {"app", "namespace", "level"}
+VALUES = {"app": {"user-service", "todo-api", "order-service", "order-worker"}, "namespace": {"prod"}}
+NOW = datetime(2026, 6, 1, 4, 0, tzinfo=timezone.utc)
+
+
+def checked(query: str) -> logql.Checked:
+    return rewrite(parse(query), LABELS, VALUES)
+
+
+def test_parse_pipeline_and_label_filters():
+    query = (
+        'sum by (level) (count_over_time({app="user-service", namespace!="dev"} '
+        '|= "error" != `debug` | json | status != "200" | line_format "{{.msg}}" [5m]))'
+    )
+    parsed = parse(query)
+    assert len(parsed.selectors) == 1
+    matchers = parsed.selectors[0].matchers
+    assert [(m.name, m.op, m.value) for m in matchers] == [("app", "=", "user-service"), ("namespace", "!=", "dev")]
+    assert query[parsed.selectors[0].start : parsed.selectors[0].end] == '{app="user-service", namespace!="dev"}'
+
+
+def test_parse_ip_filter_backticks_and_escapes():
+    parse('{app="todo-api"} |= ip("10.0.0.0/8") != ip("10.1.0.0/16")')
+    parsed = parse('{app=~`order-.*`} |~ `\\d+ms` |= "say \\"hi\\""')
+    assert parsed.selectors[0].matchers[0].value == "order-.*"
+
+
+@pytest.mark.parametrize(
+    "query, message",
+    [
+        ("", "查询为空"),
+        ('|= "error"', "缺少流选择器"),
+        ('{app="user-service" |= "error"', "选择器中的匹配条件之间需要逗号"),
+        ('{app="user-service"} |= "error', "字符串没有闭合"),
+        ('{app="user-service"} |= error', "|= 之后需要一个字符串"),
+        ('count_over_time({app="user-service"}[5x])', "区间向量的时长无效"),
+        ('count_over_time({app="user-service"}[800h])', "超过上限"),
+        ('sum(count_over_time({app="user-service"}[5m])', "( 没有闭合"),
+        ('{app="user-service"} |~ "(?=x)"', "不支持 (?="),
+    ],
+)
+def test_parse_errors(query, message):
+    with pytest.raises(LogQLError) as exc:
+        parse(query)
+    assert message in str(exc.value)
+    assert exc.value.observation()["error"] == "invalid_logql"
+
+
+def test_parse_accepts_range_durations():
+    parse('rate({app="user-service"}[1h30m])')
+    parse('count_over_time({app="user-service"}[500ms])')
+
+
+def test_regex_error_only_flags_unsupported_re2_syntax():
+    for ok in [r"\d+\++", r"[+]+", r"a+?", r"x{2,}?", r"\\1", r"foo\z", r"\Qa(?=b\E", r"\pL+", r"[[:alpha:]]+"]:
+        assert regex_error(ok) is None, ok
+    for bad in [r"a++", r"a{2}+", r"(?=x)", r"(?<!x)", r"(?>x)", r"(a)\1"]:
+        assert regex_error(bad) is not None, bad
+    assert "正则语法错误" in regex_error("a(")
+
+
+def test_rewrite_unknown_label_to_service_label_or_line_filter():
+    result = checked('{service="user-service"} |= "error"')
+    assert result.query == '{app="user-service"} |= "error"'
+    result = checked('{app="user-service", user_id="42"}')
+    assert result.query == '{app="user-service"} |= "user_id=42"'
+    assert len(result.rewrites) == 1
+
+
+def test_rewrite_corrects_near_miss_value():
+    result = checked('{app="user-servce"}')
+    assert result.query == '{app="user-service"}'
+    assert checked('{app="todo-api"}').rewrites == []
+
+
+def test_rewrite_rejects_ambiguous_value():
+    with pytest.raises(LogQLError) as exc:
+        checked('{app="order"}')
+    assert exc.value.extra["candidates"] == ["order-service", "order-worker"]
+
+
+def test_rewrite_requires_a_usable_matcher():
+    with pytest.raises(LogQLError) as exc:
+        checked('{trace_id="abc"}')
+    assert exc.value.extra["available_labels"] == sorted(LABELS)
+
+
+def test_validate_window():
+    assert validate_window(NOW - timedelta(hours=1), NOW, 60) == (60, [])
+    step, notes = validate_window(NOW - timedelta(days=30), NOW, 1)
+    assert step == 236 and len(notes) == 1
+    with pytest.raises(LogQLError):
+        validate_window(NOW, NOW, None)
+    with pytest.raises(LogQLError):
+        validate_window(NOW - timedelta(days=31), NOW, None)
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from app import plan_cache
+
+
+SERVICES = ["user-service", "todo-api"]
+NOW = datetime(2026, 6, 1, 4, 0, tzinfo=timezone.utc)
+
+
+def key(question: str) -> str:
+    result = plan_cache.question_key(question, SERVICES)
+    assert result is not None
+    return result[0]
+
+
+def test_time_phrases_with_different_windows_do_not_share_a_plan():
+    assert key("最近2天 user-service 有多少 error 日志") != key("最近30分钟 user-service 有多少 error 日志")
+    assert key("how many errors in todo-api in the last 2 days") != key("how many errors in todo-api in the last 30 minutes")
+
+
+def test_equivalent_windows_and_services_share_a_plan():
+    assert key("最近2天 user-service 有多少 error 日志") == key("过去 48 小时 todo-api 有多少error日志")
+    assert key("最近 user-service 有多少 error 日志") == key("user-service 现在有多少 error 日志")
+    assert key("今天 user-service 有多少 error 日志") != key("user-service 有多少 error 日志")
+
+
+def test_question_window():
+    assert plan_cache.question_window("最近2天 user-service 有多少 error", NOW) == (NOW - timedelta(days=2), NOW)
+    assert plan_cache.question_window("errors in the last 90 mins", NOW) == (NOW - timedelta(minutes=90), NOW)
+    start, end = plan_cache.question_window("今天有多少错误", NOW)
+    assert end == NOW and start == datetime(2026, 5, 31, 16, 0, tzinfo=timezone.utc)
+    assert plan_cache.question_window("user-service 有多少 error 日志", NOW) is None
+
+
+def test_request_window_prefers_question_unless_time_range_given():
+    from app.main import _request_window
+    from app.models import ChatOpsQueryRequest, TimeRange
+
+    start, end = _request_window(ChatOpsQueryRequest(question="最近2天 user-service 有多少 error"))
+    assert end - start == timedelta(days=2)
+    start, end = _request_window(ChatOpsQueryRequest(question="user-service 有多少 error"))
+    assert end - start == timedelta(minutes=30)
+    req = ChatOpsQueryRequest(question="最近2天 user-service 有多少 error", time_range=TimeRange(last_minutes=15))
+    start, end = _request_window(req)
+    assert end - start == timedelta(minutes=15)
+
+
+def _steps(start: datetime, end: datetime) -> list:
+    action = SimpleNamespace(
+        tool="loki_count_logs",
+        tool_input={"logql": '{app="user-service"} |= "error"', "start_iso": start.isoformat(), "end_iso": end.isoformat()},
+    )
+    return [(action, {"logql": '{app="user-service"} |= "error"', "total": 3.0, "groups": []})]
+
+
+def test_learn_plan_requires_the_request_window():
+    start, end = NOW - timedelta(minutes=30), NOW
+    plan = plan_cache.learn_plan(_steps(start, end), "有多少 error", "user-service", start, end)
+    assert plan is not None and plan.logql == '{app="$__service"} |= "error"'
+    # Agent 自行查询了 2 天，而计划会按请求的 30 分钟执行：不学习
+    assert plan_cache.learn_plan(_steps(NOW - timedelta(days=2), end), "有多少 error", "user-service", start, end) is None
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import pytest
+
+from app.memory import backends
+from app.memory.backends import InMemorySessionBackend, RedisSessionBackend, SQLiteSessionBackend
+
+
+TTL_S = 60.0
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1_700_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(backends.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def fake_redis(monkeypatch, clock):
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", classmethod(lambda cls, url: fakeredis.FakeRedis(server=server)))
+    return server
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def make_backend(request, tmp_path, clock):
+    """返回构造函数；同一测试内多次调用得到指向同一存储的不同实例（memory 除外）。"""
+    if request.param == "memory":
+        shared = InMemorySessionBackend(TTL_S, 3)
+        return lambda: shared
+    if request.param == "sqlite":
+        path = str(tmp_path / "sessions.db")
+        return lambda: SQLiteSessionBackend(path, TTL_S, 3)
+    request.getfixturevalue("fake_redis")
+    return lambda: RedisSessionBackend("redis://fake", TTL_S, 3, "test:session:")
+
+
+def turn(i: int) -> list[dict]:
+    return [{"t": "human", "c": f"q{i}"}, {"t": "ai", "c": f"a{i}" * 200}]
+
+
+def test_load_missing_session_is_empty(make_backend):
+    state = make_backend().load("nope")
+    assert state.summary == ""
+    assert state.turns == []
+
+
+def test_append_and_load_round_trip(make_backend):
+    backend = make_backend()
+    backend.append("s1", turn(1))
+    backend.append("s1", [])
+    backend.append("s1", turn(2))
+    state = backend.load("s1")
+    assert state.turns == [turn(1), turn(2)]
+    assert [r["c"] for r in state.records()][:1] == ["q1"]
+    assert backend.load("s2").turns == []
+
+
+def test_append_keeps_last_max_batches(make_backend):
+    backend = make_backend()
+    for i in range(5):
+        backend.append("s1", turn(i))
+    assert backend.load("s1").turns == [turn(2), turn(3), turn(4)]
+
+
+def test_fold_replaces_oldest_turns_with_summary(make_backend):
+    backend = make_backend()
+    for i in range(3):
+        backend.append("s1", turn(i))
+    backend.fold("s1", "摘要：q0 q1", 2)
+    state = backend.load("s1")
+    assert state.summary == "摘要：q0 q1"
+    assert state.turns == [turn(2)]
+    backend.fold("s1", "摘要：q0 q1 q2", 1)
+    state = backend.load("s1")
+    assert state.summary == "摘要：q0 q1 q2"
+    assert state.turns == []
+
+
+def test_clear(make_backend):
+    backend = make_backend()
+    backend.append("s1", turn(1))
+    backend.fold("s1", "摘要", 0)
+    backend.clear("s1")
+    assert backend.load("s1").turns == []
+    assert backend.load("s1").summary == ""
+
+
+def test_session_expires_after_ttl(make_backend, clock):
+    backend = make_backend()
+    backend.append("s1", turn(1))
+    backend.fold("s1", "摘要", 0)
+    clock.now += TTL_S / 2
+    assert backend.load("s1").turns == [turn(1)]
+    clock.now += TTL_S + 1
+    state = backend.load("s1")
+    assert state.turns == []
+    assert state.summary == ""
+
+
+def test_redis_keys_carry_ttl(fake_redis):
+    import redis
+
+    backend = RedisSessionBackend("redis://fake", TTL_S, 3, "test:session:")
+    backend.append("s1", turn(1))
+    backend.fold("s1", "摘要", 0)
+    client = redis.Redis.from_url("redis://fake")
+    assert 0 < client.ttl("test:session:s1") <= TTL_S
+    assert 0 < client.ttl("test:session:s1:summary") <= TTL_S
+    client.delete("test:session:s1", "test:session:s1:summary")
+    assert backend.load("s1").turns == []
+
+
+def test_instances_share_session(make_backend):
+    writer, reader = make_backend(), make_backend()
+    writer.append("s1", turn(1))
+    assert reader.load("s1").turns == [turn(1)]
+    reader.append("s1", turn(2))
+    reader.fold("s1", "摘要", 1)
+    state = writer.load("s1")
+    assert state.summary == "摘要"
+    assert state.turns == [turn(2)]
@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from app.singleflight import SingleFlight
+
+
+async def _burst(group: SingleFlight, fn, callers: int) -> list:
+    return await asyncio.gather(*(group.do("k", fn) for _ in range(callers)), return_exceptions=True)
+
+
+def test_followers_share_one_upstream_call():
+    group = SingleFlight("t")
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        return 42
+
+    results = asyncio.run(_burst(group, fetch, 4))
+    assert results == [42, 42, 42, 42]
+    assert group.stats() == {"upstream_calls": 1, "coalesced_callers": 3, "saved_upstream_calls": 3, "inflight": 0}
+
+
+def test_failed_leader_saves_nothing():
+    group = SingleFlight("t")
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    results = asyncio.run(_burst(group, fetch, 3))
+    assert all(isinstance(r, RuntimeError) for r in results)
+    stats = group.stats()
+    assert stats["coalesced_callers"] == 2
+    assert stats["saved_upstream_calls"] == 0
+    with pytest.raises(RuntimeError):
+        asyncio.run(group.do("k", fetch))
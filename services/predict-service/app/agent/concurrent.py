@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import json
+import time
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Optional
+
+from langchain.agents import AgentExecutor
+from langchain_core.agents import AgentAction, AgentFinish, AgentStep
+from langchain_core.callbacks import AsyncCallbackManagerForChainRun
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.tools import BaseTool
+from pydantic import PrivateAttr
+
+from .. import deadline, metrics
+
+
+_STOPPED_OUTPUT = "Agent stopped due to max iterations."
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000.0, 1)
+
+
+def _short(value: Any, limit: int) -> str:
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    return text if len(text) <= limit else text[:limit] + "...(truncated)"
+
+
+def _digest(intermediate_steps: list[tuple[AgentAction, Any]], limit: int = 12000) -> str:
+    lines: list[str] = []
+    used = 0
+    for action, observation in intermediate_steps:
+        if action.tool == "trace_note":
+            continue
+        line = f"- {action.tool}({_short(action.tool_input, 300)}) -> {_short(observation, 1500)}"
+        if used + len(line) > limit:
+            lines.append("- ...（其余工具结果省略）")
+            break
+        lines.append(line)
+        used += len(line)
+    return "\n".join(lines) or "（尚无工具结果）"
+
+
+class ConcurrentAgentExecutor(AgentExecutor):
+    """同一轮 LLM 返回的多个工具调用并发执行（受 max_tool_concurrency 限制），并记录每轮/每次工具调用的耗时。
+
+    观测结果仍按 LLM 给出的调用顺序回填给 Agent。存在请求级截止时间时，剩余预算不足 deadline_reserve_s
+    即停止迭代，并用 partial_llm 基于已有工具结果生成一个（可能不完整的）最终回答。
+    """
+
+    max_tool_concurrency: int = 4
+    deadline_reserve_s: float = 8.0
+    partial_llm: Optional[Any] = None
+
+    _run_started: float | None = PrivateAttr(default=None)
+    _run_wall_s: float | None = PrivateAttr(default=None)
+    _partial_s: float = PrivateAttr(default=0.0)
+    _llm_calls: list[dict] = PrivateAttr(default_factory=list)
+    _iterations: list[dict] = PrivateAttr(default_factory=list)
+    _tool_timings: dict[int, dict] = PrivateAttr(default_factory=dict)
+    _step_semaphore: asyncio.Semaphore | None = PrivateAttr(default=None)
+    _inputs: dict | None = PrivateAttr(default=None)
+    _stopped_reason: str | None = PrivateAttr(default=None)
+
+    def step_timings(self) -> tuple[list[dict], dict[int, dict]]:
+        return self._iterations, self._tool_timings
+
+    def breakdown(self) -> dict:
+        """整次运行的耗时拆分：llm_ms 为 Agent 主循环等待 LLM 的时间，tool_wall_ms 为等待工具的时间（并发工具只计一次），
+        tool_ms 为各工具耗时之和，other_ms 为其余自身处理时间。"""
+        planning_ms = sum(it["llm_ms"] or 0.0 for it in self._iterations)
+        tool_wall_ms = sum(it["tools_ms"] or 0.0 for it in self._iterations)
+        llm_ms = planning_ms + _ms(self._partial_s)
+        wall_ms = _ms(self._run_wall_s) if self._run_wall_s is not None else None
+        return {
+            "wall_ms": wall_ms,
+            "llm_ms": round(llm_ms, 1),
+            "tool_wall_ms": round(tool_wall_ms, 1),
+            "tool_ms": round(sum(t.get("duration_ms") or 0.0 for t in self._tool_timings.values()), 1),
+            "other_ms": round(max(0.0, wall_ms - llm_ms - tool_wall_ms), 1) if wall_ms is not None else None,
+            "iterations": len(self._iterations),
+            "tool_calls": len(self._tool_timings),
+            "llm_calls": len(self._llm_calls),
+            "prompt_tokens": sum(c["input_tokens"] for c in self._llm_calls),
+            "completion_tokens": sum(c["output_tokens"] for c in self._llm_calls),
+        }
+
+    @property
+    def stopped_reason(self) -> str | None:
+        return self._stopped_reason
+
+    async def _acall(
+        self,
+        inputs: dict[str, str],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> dict[str, str]:
+        self._inputs = inputs
+        self._stopped_reason = None
+        self._run_started = time.perf_counter()
+        with metrics.collect_llm_calls() as calls:
+            self._llm_calls = calls
+            try:
+                return await super()._acall(inputs, run_manager)
+            finally:
+                self._run_wall_s = time.perf_counter() - self._run_started
+
+    def _should_continue(self, iterations: int, time_elapsed: float) -> bool:
+        left = deadline.remaining()
+        if left is not None and left <= self.deadline_reserve_s:
+            self._stopped_reason = "deadline"
+            return False
+        if not super()._should_continue(iterations, time_elapsed):
+            self._stopped_reason = "max_iterations"
+            return False
+        return True
+
+    async def _areturn(
+        self,
+        output: AgentFinish,
+        intermediate_steps: list,
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> dict[str, Any]:
+        if not output.log and output.return_values.get("output") == _STOPPED_OUTPUT:
+            if self._stopped_reason is None:
+                left = deadline.remaining()
+                self._stopped_reason = "deadline" if left is not None and left <= self.deadline_reserve_s else "timeout"
+            answer = await self._partial_answer(intermediate_steps, run_manager)
+            output = AgentFinish({"output": answer}, "")
+        return await super()._areturn(output, intermediate_steps, run_manager)
+
+    async def _partial_answer(
+        self,
+        intermediate_steps: list,
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> str:
+        digest = _digest(intermediate_steps)
+        fallback = f"分析未完成（{self._stopped_reason}），以下为已获得的工具结果，尚未形成完整结论：\n{digest}"
+        left = deadline.remaining()
+        if self.partial_llm is None or (left is not None and left <= 0):
+            return fallback
+        messages = [
+            SystemMessage(
+                content="时间预算即将用尽，不能再调用工具。请仅基于下面已获得的工具结果，按原任务要求的输出格式给出当前最佳答案，"
+                "并明确指出哪些结论尚未核实、还缺少哪些数据。"
+            ),
+            HumanMessage(content=f"原始任务：\n{(self._inputs or {}).get('input', '')}\n\n已获得的工具结果：\n{digest}"),
+        ]
+        callbacks = run_manager.get_child() if run_manager else None
+        started = time.perf_counter()
+        try:
+            msg = await asyncio.wait_for(self.partial_llm.ainvoke(messages, config={"callbacks": callbacks}), left)
+        except Exception:
+            return fallback
+        finally:
+            self._partial_s += time.perf_counter() - started
+        return str(getattr(msg, "content", "") or "").strip() or fallback
+
+    async def _aiter_next_step(
+        self,
+        name_to_tool_map: dict[str, BaseTool],
+        color_mapping: dict[str, str],
+        inputs: dict[str, str],
+        intermediate_steps: list[tuple[AgentAction, str]],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> AsyncIterator[AgentFinish | AgentAction | AgentStep]:
+        now = time.perf_counter()
+        if self._run_started is None:
+            self._run_started = now
+        record = {
+            "index": len(self._iterations),
+            "started_at": datetime.now(timezone.utc),
+            "ended_at": None,
+            "started_ms": _ms(now - self._run_started),
+            "llm_ms": None,
+            "ttft_ms": None,
+            "tools_ms": None,
+            "wall_ms": None,
+            "tool_calls": 0,
+            "llm_calls": 0,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+        }
+        mark = len(self._llm_calls)
+        self._iterations.append(record)
+        self._step_semaphore = asyncio.Semaphore(max(1, self.max_tool_concurrency))
+        planned_at: float | None = None
+        async for item in super()._aiter_next_step(
+            name_to_tool_map,
+            color_mapping,
+            inputs,
+            intermediate_steps,
+            run_manager,
+        ):
+            if planned_at is None:
+                planned_at = time.perf_counter()
+                record["llm_ms"] = _ms(planned_at - now)
+                self._record_llm_usage(record, self._llm_calls[mark:])
+            if isinstance(item, AgentAction):
+                record["tool_calls"] += 1
+            yield item
+        ended = time.perf_counter()
+        record["ended_at"] = datetime.now(timezone.utc)
+        record["wall_ms"] = _ms(ended - now)
+        if planned_at is not None and record["tool_calls"]:
+            record["tools_ms"] = _ms(ended - planned_at)
+
+    @staticmethod
+    def _record_llm_usage(record: dict, calls: list[dict]) -> None:
+        if not calls:
+            return
+        record["llm_calls"] = len(calls)
+        record["prompt_tokens"] = sum(c["input_tokens"] for c in calls)
+        record["completion_tokens"] = sum(c["output_tokens"] for c in calls)
+        if calls[0]["ttft_s"] is not None:
+            record["ttft_ms"] = _ms(calls[0]["ttft_s"])
+
+    async def _aperform_agent_action(
+        self,
+        name_to_tool_map: dict[str, BaseTool],
+        color_mapping: dict[str, str],
+        agent_action: AgentAction,
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> AgentStep:
+        queued = time.perf_counter()
+        run_started = self._run_started if self._run_started is not None else queued
+        timing = {"iteration": self._iterations[-1]["index"] if self._iterations else None}
+        self._tool_timings[id(agent_action)] = timing
+        semaphore = self._step_semaphore
+        async with semaphore if semaphore is not None else contextlib.nullcontext():
+            started = time.perf_counter()
+            timing["started_at"] = datetime.now(timezone.utc)
+            step: AgentStep | None = None
+            error: BaseException | None = None
+            try:
+                step = await super()._aperform_agent_action(
+                    name_to_tool_map,
+                    color_mapping,
+                    agent_action,
+                    run_manager,
+                )
+                return step
+            except BaseException as exc:
+                error = exc
+                raise
+            finally:
+                ended = time.perf_counter()
+                timing["ended_at"] = datetime.now(timezone.utc)
+                metrics.observe_tool(agent_action.tool, ended - started, step.observation if step else None, error)
+                timing["started_ms"] = _ms(started - run_started)
+                timing["wait_ms"] = _ms(started - queued)
+                timing["duration_ms"] = _ms(ended - started)
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
-from langchain.agents import AgentExecutor
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.memory import ConversationBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
+
+from ..settings import settings
+from .concurrent import ConcurrentAgentExecutor
 
 
 try:
@@ -12,7 +14,7 @@ except Exception:
     from langchain.agents import create_openai_functions_agent as create_tool_calling_agent
 
 
-def build_executor(llm: BaseChatModel, tools, memory: ConversationBufferMemory | None) -> AgentExecutor:
+def build_executor(llm: BaseChatModel, tools, memory: BaseChatMemory | None) -> ConcurrentAgentExecutor:
     prompt = ChatPromptTemplate.from_messages(
         [
             (
@@ -31,8 +33,8 @@ def build_executor(llm: BaseChatModel, tools, memory: ConversationBufferMemory |
                 "   注意：在 Todo_List 当前环境中，这两类指标用 service 标签区分 user-service/todo-service/ai-service，"
                 "   你在选择器中必须使用 service=\"user-service\" 这类条件进行过滤，而不是使用 app 或 namespace 标签。"
                 "   尤其是，对于 http_requests_total 和 http_request_duration_seconds_bucket，严禁编造如下写法："
-                "   {app=\"user-service\", namespace=\"todo-list\"} 或 {app=\"user-service\"}，因为这些标签在实际指标上并不存在，会导致查询始终为空。"
-                "   正确示例包括：sum(rate(http_requests_total{service=\"user-service\"}[5m])) by (service)，"
+                "   {{app=\"user-service\", namespace=\"todo-list\"}} 或 {{app=\"user-service\"}}，因为这些标签在实际指标上并不存在，会导致查询始终为空。"
+                "   正确示例包括：sum(rate(http_requests_total{{service=\"user-service\"}}[5m])) by (service)，"
                 "   或者在确认存在 namespace 标签时再额外限定 namespace=\"todo-demo\"。"
                 " - 业务指标：user_registration_*、user_login_*、todo_*、ai_chat_*"
                 " - 服务与进程：up、process_resident_memory_bytes、process_cpu_seconds_total"
@@ -52,18 +54,21 @@ def build_executor(llm: BaseChatModel, tools, memory: ConversationBufferMemory |
                 "使用 prometheus_query_range 时，如果查询不到数据或者指标不存在，必须如实说明限制，不能编造指标或结果。"
                 "你必须只输出JSON对象，不要输出额外文本。每次调用任何工具前，先调用trace_note记录本轮要做什么与原因（不超过80字）。",
             ),
-            MessagesPlaceholder(variable_name="chat_history"),
+            MessagesPlaceholder(variable_name="chat_history", optional=True),
             ("human", "{input}"),
             MessagesPlaceholder(variable_name="agent_scratchpad"),
         ]
     )
     agent = create_tool_calling_agent(llm, tools, prompt)
-    return AgentExecutor(
+    return ConcurrentAgentExecutor(
         agent=agent,
         tools=tools,
         memory=memory,
         verbose=True,
         handle_parsing_errors=True,
         return_intermediate_steps=True,
+        max_tool_concurrency=settings.agent_max_tool_concurrency,
+        deadline_reserve_s=settings.deadline_reserve_s,
+        partial_llm=llm,
         max_iterations=8,
     )
@@ -2,23 +2,42 @@ from __future__ import annotations
 
 import os
 
+import httpx
 from langchain_core.language_models.chat_models import BaseChatModel
 
 from .settings import settings
 
 
+_http_async_client: httpx.AsyncClient | None = None
+
+
+def _shared_http_client() -> httpx.AsyncClient:
+    """进程内所有 LLM 实例共用一个连接池。
+
+    每次请求都会新建 ChatOpenAI；若各自持有一个从不关闭的 httpx 客户端，被回收的旧客户端会让后续请求偶发卡住直到超时。
+    """
+    global _http_async_client
+    if _http_async_client is None or _http_async_client.is_closed:
+        import openai
+
+        _http_async_client = openai.DefaultAsyncHttpxClient()
+    return _http_async_client
+
+
 def get_llm(streaming: bool = False) -> BaseChatModel:
-    from langchain_openai import ChatOpenAI
+    from .llm_guard import GuardedChatOpenAI
 
     api_key = settings.ark_api_key or os.environ.get("ARK_API_KEY")
     base_url = settings.ark_base_url or os.environ.get("ARK_BASE_URL")
 
-    return ChatOpenAI(
+    return GuardedChatOpenAI(
         model=settings.llm_model,
         api_key=api_key,
         base_url=base_url,
         temperature=0,
         streaming=streaming,
+        stream_usage=True,
+        http_async_client=_shared_http_client(),
         request_timeout=settings.request_timeout_s,
         extra_body={"reasoning_effort": "low"},
     )
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import hashlib
+import re
+from datetime import datetime, timedelta, timezone
+
+
+# flatten_log_lines 产出的格式："{ts} [{labels}] {line}"
+_PREFIX_RE = re.compile(r"^(\d+) \[[^\]]*\] ")
+# 状态码是区分故障的关键信号，不能被当作普通数字掩码：先在 status=500、HTTP/1.1" 404 这类位置的
+# 三位状态码前插入标记，数字掩码跳过带标记的数字，最后去掉标记
+_KEEP = "\x01"
+# (必需的字面字符, 模式, 替换)：行内没有该字符时跳过这条正则，省去整行扫描
+_MASKS = [
+    (
+        "",
+        re.compile(r"(?i)(\b(?:status(?:[_-]?code)?|http[_-]?status|code)[\"']?\s*[=:]\s*[\"']?)([1-5]\d\d)\b"),
+        rf"\1{_KEEP}\2",
+    ),
+    ("HTTP/", re.compile(r"(HTTP/\d(?:\.\d)?[\"']?\s+)([1-5]\d\d)\b"), rf"\1{_KEEP}\2"),
+    ("-", re.compile(r"\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b", re.I), "<uuid>"),
+    (
+        "",
+        re.compile(r"(?i)\b((?:x-)?(?:req(?:uest)?|trace|span|correlation)[-_]?id[\"']?\s*[=:]\s*[\"']?)[\w.-]+"),
+        r"\1<id>",
+    ),
+    (".", re.compile(r"\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b"), "<ip>"),
+    ("-", re.compile(r"\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?"), "<time>"),
+    (":", re.compile(r"\b\d{2}:\d{2}:\d{2}(?:[.,]\d+)?\b"), "<time>"),
+    ("", re.compile(r"\b(?:0x)?[0-9a-f]{8,}\b", re.I), "<hex>"),
+    ('"', re.compile(r'"[^"]{0,200}"'), '"<str>"'),
+    ("", re.compile(rf"(?<![{_KEEP}\d])\d+(?:\.\d+)?"), "<num>"),
+]
+_ANNOTATION_RE = re.compile(r"  \[同类日志 ×\d+[^\]]*\]$")
+_CST = timezone(timedelta(hours=8))
+
+
+def message_of(line: str) -> str:
+    """去掉 flatten_log_lines 加上的时间戳与标签前缀，只留日志正文。"""
+    return _PREFIX_RE.sub("", line, count=1)
+
+
+def ts_of(line: str) -> int | None:
+    m = _PREFIX_RE.match(line)
+    return int(m.group(1)) if m else None
+
+
+def normalize(text: str) -> str:
+    """把日志正文中的可变部分（UUID、请求 ID、IP、时间、十六进制串、引号内容、数字）替换为占位符；
+    status / HTTP 版本号之后的三位状态码保留原值。"""
+    for required, pattern, repl in _MASKS:
+        if required in text:
+            text = pattern.sub(repl, text)
+    return text.replace(_KEEP, "")[:300]
+
+
+def fingerprint(text: str) -> int:
+    """归一化文本的 64 位指纹，跨进程稳定，用于去重与计数而不必保留整行。"""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8", "replace"), digest_size=8).digest(), "big")
+
+
+def line_fingerprint(line: str) -> int:
+    return fingerprint(normalize(message_of(line)))
+
+
+def _clock(ts_ns: int) -> str:
+    return datetime.fromtimestamp(ts_ns / 1_000_000_000, tz=_CST).strftime("%m-%d %H:%M:%S")
+
+
+def annotate(line: str, count: int, first_ns: int | None, last_ns: int | None) -> str:
+    """为合并了近似重复的代表行附上出现次数与首末时间（CST）。"""
+    if count <= 1:
+        return line
+    if first_ns is None or last_ns is None:
+        return f"{line}  [同类日志 ×{count}]"
+    return f"{line}  [同类日志 ×{count}，{_clock(first_ns)} ~ {_clock(last_ns)}]"
+
+
+def strip_annotation(line: str) -> str:
+    return _ANNOTATION_RE.sub("", line)
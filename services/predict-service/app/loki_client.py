@@ -1,10 +1,14 @@
 from __future__ import annotations
 
+from collections.abc import AsyncIterator
 from dataclasses import dataclass
 from datetime import datetime, timezone
 
 import httpx
 
+from . import backpressure, metrics, replay, resilience
+from .singleflight import align_range, get_group, normalize_query
+
 
 def _dt_to_ns(dt: datetime) -> int:
     if dt.tzinfo is None:
@@ -45,16 +49,41 @@ class LokiQueryResult:
 
 
 class LokiClient:
-    def __init__(self, base_url: str, tenant_id: str | None, timeout_s: float):
+    def __init__(self, base_url: str, tenant_id: str | None, timeout_s: float, align_s: float = 0.0):
         self._base_url = base_url.rstrip("/")
         self._tenant_id = tenant_id
         self._timeout_s = timeout_s
+        self._align_s = align_s
+        self._flight = get_group("loki")
 
     def _headers(self) -> dict[str, str]:
         if self._tenant_id:
             return {"X-Scope-OrgID": self._tenant_id}
         return {}
 
+    async def _get(self, path: str, params: dict[str, str | int] | None = None) -> dict:
+        items = tuple(sorted((k, normalize_query(v) if k == "query" else v) for k, v in (params or {}).items()))
+        return await replay.upstream(
+            "loki", path, params, lambda: self._flight.do((self._tenant_id, path, items), lambda: self._fetch(path, params))
+        )
+
+    async def _fetch(self, path: str, params: dict[str, str | int] | None) -> dict:
+        endpoint = "loki.label_values" if "/label/" in path else f"loki.{path.rsplit('/', 1)[-1]}"
+        return await resilience.call(
+            endpoint,
+            lambda timeout_s: self._attempt(endpoint, path, params, timeout_s),
+            self._timeout_s,
+        )
+
+    async def _attempt(self, endpoint: str, path: str, params: dict[str, str | int] | None, timeout_s: float) -> dict:
+        async with backpressure.get_guard("loki").slot():
+            with metrics.upstream_call("loki", endpoint) as call:
+                async with httpx.AsyncClient(timeout=timeout_s) as client:
+                    r = await client.get(f"{self._base_url}{path}", params=params, headers=self._headers())
+                call["bytes"] = len(r.content)
+                r.raise_for_status()
+                return r.json()
+
     async def query_range(
         self,
         query: str,
@@ -64,6 +93,7 @@ class LokiClient:
         direction: str = "BACKWARD",
         step_seconds: int | None = None,
     ) -> LokiQueryResult:
+        start, end = align_range(start, end, self._align_s)
         params: dict[str, str | int] = {
             "query": query,
             "start": _dt_to_ns(start),
@@ -73,8 +103,58 @@ class LokiClient:
         }
         if step_seconds is not None:
             params["step"] = step_seconds
-        async with httpx.AsyncClient(timeout=self._timeout_s) as client:
-            r = await client.get(f"{self._base_url}/loki/api/v1/query_range", params=params, headers=self._headers())
-        r.raise_for_status()
-        return LokiQueryResult(raw=r.json())
+        return LokiQueryResult(raw=await self._get("/loki/api/v1/query_range", params))
+
+
+    async def iter_query_range(
+        self,
+        query: str,
+        start: datetime,
+        end: datetime,
+        page_limit: int = 5000,
+    ) -> AsyncIterator[tuple[LokiQueryResult, bool]]:
+        """按时间倒序分页拉取整个窗口，逐页产出 (结果, 是否还有下一页)，由调用方边到边处理，不在内存中累积。
 
+        下一页的 end 取本页最早时间戳 + 1ns（Loki 的 end 不含边界），边界时间戳上已经返回过的行会被跳过。
+        """
+        start, end = align_range(start, end, self._align_s)
+        start_ns, end_ns = _dt_to_ns(start), _dt_to_ns(end)
+        edge: set[tuple[str, str]] = set()
+        while True:
+            raw = await self._get(
+                "/loki/api/v1/query_range",
+                {"query": query, "start": start_ns, "end": end_ns, "limit": page_limit, "direction": "BACKWARD"},
+            )
+            results = (raw.get("data") or {}).get("result") or []
+            returned = 0
+            oldest: int | None = None
+            page: list[dict] = []
+            for item in results:
+                stream = item.get("stream") or {}
+                key = ",".join(f"{k}={v}" for k, v in sorted(stream.items()))
+                values = item.get("values") or []
+                returned += len(values)
+                kept = []
+                for value in values:
+                    try:
+                        ts = int(value[0])
+                    except (TypeError, ValueError):
+                        continue
+                    if ts == end_ns - 1 and (key, value[1]) in edge:
+                        continue
+                    kept.append(value)
+                    if oldest is None or ts < oldest:
+                        oldest = ts
+                page.append({"stream": stream, "values": kept})
+            more = returned >= page_limit and oldest is not None and start_ns <= oldest < end_ns - 1
+            if more:
+                edge = {
+                    (",".join(f"{k}={v}" for k, v in sorted(item["stream"].items())), value[1])
+                    for item in page
+                    for value in item["values"]
+                    if int(value[0]) == oldest
+                }
+                end_ns = oldest + 1
+            yield LokiQueryResult(raw={"status": raw.get("status"), "data": {"resultType": "streams", "result": page}}), more
+            if not more:
+                return
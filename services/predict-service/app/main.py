@@ -2,23 +2,38 @@ from __future__ import annotations
 
 from datetime import datetime, timezone
 import asyncio
+import contextlib
 import json
+import time
 from typing import AsyncIterator
 
 import logging
 import uuid
 
 import numpy as np
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from langchain_core.callbacks import AsyncCallbackHandler
 from langchain_core.prompts import ChatPromptTemplate
 
 from .llm import get_llm
 from .loki_client import LokiClient
-from .models import AgentTrace, LikelyFailures, PredictRequest, PredictResponse, TraceStep
+from .jobs import Job, JobEvents, JobQueue, JobQueueFull
+from .models import (
+    AgentTrace,
+    IterationTiming,
+    JobInfo,
+    JobList,
+    LikelyFailures,
+    PredictJobRequest,
+    PredictRequest,
+    PredictResponse,
+    TraceBreakdown,
+    TraceStep,
+)
 from .settings import settings
+from . import backpressure, deadline, metrics, replay, resilience, rollup, singleflight
 from .agent.executor import build_executor
 from .memory.store import get_memory
 from .tools import build_tools
@@ -30,10 +45,10 @@ class _HealthzAccessFilter(logging.Filter):
             args = record.args
             if isinstance(args, tuple) and len(args) >= 2:
                 req = args[1]
-                if isinstance(req, str) and "/healthz" in req:
+                if isinstance(req, str) and ("/healthz" in req or "/metrics" in req):
                     return False
             msg = record.getMessage()
-            if "/healthz" in msg:
+            if "/healthz" in msg or "/metrics" in msg:
                 return False
         except Exception:
             return True
@@ -43,14 +58,41 @@ class _HealthzAccessFilter(logging.Filter):
 logging.getLogger("uvicorn.access").addFilter(_HealthzAccessFilter())
 
 
-app = FastAPI(title="Predict Service", version="0.1.0")
+@contextlib.asynccontextmanager
+async def _lifespan(_: FastAPI) -> AsyncIterator[None]:
+    if settings.predict_rollup_enabled and settings.replay_mode == "off":
+        rollup_ingester.start()
+    try:
+        yield
+    finally:
+        await rollup_ingester.stop()
+
+
+app = FastAPI(title="Predict Service", version="0.1.0", lifespan=_lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
 )
-loki = LokiClient(settings.loki_base_url, settings.loki_tenant_id, settings.request_timeout_s)
+app.add_middleware(metrics.MetricsMiddleware)
+loki = LokiClient(settings.loki_base_url, settings.loki_tenant_id, settings.request_timeout_s, settings.upstream_align_s)
+jobs = JobQueue(
+    "predict",
+    settings.job_workers,
+    settings.job_queue_max_depth,
+    settings.job_max_queued_per_user,
+    settings.job_retention_s,
+)
+metrics.JOB_QUEUE_DEPTH.set_function(lambda: jobs.depth)
+metrics.JOB_RUNNING.set_function(lambda: jobs.running)
+rollup_ingester = rollup.RollupIngester(loki)
+
+
+@app.exception_handler(backpressure.BackendUnavailable)
+async def backend_unavailable(request: Request, exc: backpressure.BackendUnavailable) -> JSONResponse:
+    headers = {"Retry-After": str(int(exc.retry_after_s) + 1)} if exc.retry_after_s is not None else None
+    return JSONResponse(status_code=503, content={"detail": str(exc), **exc.observation()}, headers=headers)
 
 
 @app.get("/healthz")
@@ -58,6 +100,22 @@ def healthz() -> dict[str, str]:
     return {"status": "ok", "service": settings.service_name}
 
 
+@app.get("/metrics")
+def prometheus_metrics() -> Response:
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
+
+
+@app.get("/debug/upstream")
+def debug_upstream() -> dict:
+    return {
+        "singleflight": singleflight.stats(),
+        "endpoints": resilience.stats(),
+        "backends": backpressure.stats(),
+        "rollup": rollup.get_store().stats() if settings.predict_rollup_enabled else None,
+    }
+
+
 def _ensure_utc(dt: datetime) -> datetime:
     if dt.tzinfo is None:
         return dt.replace(tzinfo=timezone.utc)
@@ -105,7 +163,23 @@ def _stringify(value) -> str:
         return str(value)
 
 
-def _build_trace(intermediate_steps) -> AgentTrace:
+def _llm_usage(response) -> dict:
+    usage = None
+    try:
+        message = getattr(response.generations[0][0], "message", None)
+        usage = getattr(message, "usage_metadata", None)
+    except Exception:
+        usage = None
+    if usage:
+        return {"prompt_tokens": usage.get("input_tokens"), "completion_tokens": usage.get("output_tokens")}
+    token_usage = (getattr(response, "llm_output", None) or {}).get("token_usage") or {}
+    if token_usage:
+        return {"prompt_tokens": token_usage.get("prompt_tokens"), "completion_tokens": token_usage.get("completion_tokens")}
+    return {}
+
+
+def _build_trace(intermediate_steps, executor=None) -> AgentTrace:
+    iterations, tool_timings = executor.step_timings() if executor is not None else ([], {})
     steps: list[TraceStep] = []
     for idx, pair in enumerate(intermediate_steps or []):
         try:
@@ -116,11 +190,15 @@ def _build_trace(intermediate_steps) -> AgentTrace:
         tool_input = getattr(action, "tool_input", None)
         log = getattr(action, "log", None)
         obs_text = _stringify(observation)
+        obs_raw_chars = len(obs_text)
         if len(obs_text) > 8000:
             obs_text = obs_text[:8000] + "\n...(truncated)"
         inp_text = _stringify(tool_input)
         if len(inp_text) > 4000:
             inp_text = inp_text[:4000] + "\n...(truncated)"
+        timing = tool_timings.get(id(action), {})
+        iteration = timing.get("iteration")
+        planned_by = iterations[iteration] if iteration is not None and iteration < len(iterations) else {}
         steps.append(
             TraceStep(
                 index=idx,
@@ -128,9 +206,30 @@ def _build_trace(intermediate_steps) -> AgentTrace:
                 tool_input=inp_text or None,
                 observation=obs_text or None,
                 log=str(log) if log else None,
+                iteration=iteration,
+                started_at=timing.get("started_at"),
+                ended_at=timing.get("ended_at"),
+                started_ms=timing.get("started_ms"),
+                wait_ms=timing.get("wait_ms"),
+                duration_ms=timing.get("duration_ms"),
+                llm_ms=planned_by.get("llm_ms"),
+                observation_raw_chars=obs_raw_chars,
+                observation_chars=len(obs_text),
             )
         )
-    return AgentTrace(steps=steps)
+    breakdown = None
+    if executor is not None and hasattr(executor, "breakdown"):
+        breakdown = TraceBreakdown(
+            **executor.breakdown(),
+            observation_raw_chars=sum(s.observation_raw_chars or 0 for s in steps),
+            observation_chars=sum(s.observation_chars or 0 for s in steps),
+        )
+    return AgentTrace(
+        steps=steps,
+        iterations=[IterationTiming(**it) for it in iterations],
+        stopped_reason=getattr(executor, "stopped_reason", None),
+        breakdown=breakdown,
+    )
 
 
 class PredictStreamHandler(AsyncCallbackHandler):
@@ -140,6 +239,9 @@ class PredictStreamHandler(AsyncCallbackHandler):
         self.step_counter = 0
         self.current_workflow_stage = "thinking"
         self.current_step_id: str | None = None
+        self.tool_step_ids: dict = {}
+        self.run_timings: dict = {}
+        self._started = time.perf_counter()
 
     def _next_step_id(self) -> str:
         self.step_counter += 1
@@ -152,13 +254,33 @@ class PredictStreamHandler(AsyncCallbackHandler):
             "workflow_stage": workflow_stage or self.current_workflow_stage,
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "session_id": self.session_id,
+            "elapsed_ms": round((time.perf_counter() - self._started) * 1000.0, 1),
         }
         payload.update(data)
         await self.queue.put(payload)
 
+    def _begin_run(self, run_id) -> None:
+        if run_id is not None:
+            self.run_timings[run_id] = {
+                "started": time.perf_counter(),
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "ttft_ms": None,
+            }
+
+    def _end_run(self, run_id) -> dict:
+        timing = self.run_timings.pop(run_id, None)
+        if timing is None:
+            return {}
+        return {
+            "started_at": timing["started_at"],
+            "duration_ms": round((time.perf_counter() - timing["started"]) * 1000.0, 1),
+            "ttft_ms": timing["ttft_ms"],
+        }
+
     async def on_llm_start(self, serialized, prompts, **kwargs):
         self.current_workflow_stage = "thinking"
         self.current_step_id = self._next_step_id()
+        self._begin_run(kwargs.get("run_id"))
         prompt = prompts[0] if prompts else ""
         model_name = None
         if isinstance(serialized, dict):
@@ -173,6 +295,9 @@ class PredictStreamHandler(AsyncCallbackHandler):
         )
 
     async def on_llm_new_token(self, token: str, **kwargs):
+        timing = self.run_timings.get(kwargs.get("run_id"))
+        if timing is not None and timing["ttft_ms"] is None:
+            timing["ttft_ms"] = round((time.perf_counter() - timing["started"]) * 1000.0, 1)
         await self._send_event(
             "llm_token",
             {
@@ -197,6 +322,8 @@ class PredictStreamHandler(AsyncCallbackHandler):
             {
                 "response": text,
                 "step_id": self.current_step_id,
+                **self._end_run(kwargs.get("run_id")),
+                **_llm_usage(response),
             },
         )
 
@@ -248,6 +375,10 @@ class PredictStreamHandler(AsyncCallbackHandler):
             return
         self.current_workflow_stage = "executing"
         self.current_step_id = self._next_step_id()
+        run_id = kwargs.get("run_id")
+        if run_id is not None:
+            self.tool_step_ids[run_id] = self.current_step_id
+        self._begin_run(run_id)
         await self._send_event(
             "tool_start",
             {
@@ -260,18 +391,23 @@ class PredictStreamHandler(AsyncCallbackHandler):
     async def on_tool_end(self, output, **kwargs):
         self.current_workflow_stage = "observing"
         observation = _stringify(output)
+        step_id = self.tool_step_ids.pop(kwargs.get("run_id"), None) or self.current_step_id
+        timing = self._end_run(kwargs.get("run_id"))
+        timing.pop("ttft_ms", None)
         await self._send_event(
             "tool_end",
             {
                 "observation": observation,
-                "step_id": self.current_step_id,
+                "step_id": step_id,
+                "observation_chars": len(observation),
+                **timing,
             },
         )
         await self._send_event(
             "agent_observation",
             {
                 "observation": observation,
-                "step_id": self.current_step_id,
+                "step_id": step_id,
             },
         )
 
@@ -289,6 +425,9 @@ class PredictStreamHandler(AsyncCallbackHandler):
 logger = logging.getLogger(__name__)
 
 
+@metrics.tracked_session
+@replay.session
+@deadline.budgeted
 async def _run_predict(req: PredictRequest, callbacks: list | None = None) -> PredictResponse:
     logger.info("predict _run_predict start service=%s lookback_hours=%s", req.service_name, req.lookback_hours)
     llm = get_llm(streaming=callbacks is not None)
@@ -314,7 +453,7 @@ async def _run_predict(req: PredictRequest, callbacks: list | None = None) -> Pr
         res = {"output": res}
     raw = str(res.get("output") or "")
     intermediate_steps = res.get("intermediate_steps") or []
-    trace = _build_trace(intermediate_steps)
+    trace = _build_trace(intermediate_steps, executor)
 
     features: dict | None = None
     for pair in intermediate_steps:
@@ -337,6 +476,7 @@ async def _run_predict(req: PredictRequest, callbacks: list | None = None) -> Pr
 
     counts = np.array((features or {}).get("counts") or [], dtype=float)
     logs = (features or {}).get("logs") or []
+    patterns = (features or {}).get("patterns") or []
 
     try:
         out = LikelyFailures.model_validate_json(raw)
@@ -347,6 +487,7 @@ async def _run_predict(req: PredictRequest, callbacks: list | None = None) -> Pr
                 (
                     "human",
                     "服务：{service}\n过去{hours}小时的错误计数时间序列（5m窗口）：{counts}\n"
+                    "主要错误模板及其最近的计数序列（5m窗口，近似值）：\n{patterns}\n"
                     "最近的错误日志样本（可能为空/截断）：\n{logs}\n\n"
                     "请输出：一个JSON对象，其中包含：\n"
                     "1) risk_score：0.0~1.0 之间的小数，表示你对未来发生严重故障的主观概率判断；\n"
@@ -363,6 +504,10 @@ async def _run_predict(req: PredictRequest, callbacks: list | None = None) -> Pr
                 "service": req.service_name,
                 "hours": req.lookback_hours,
                 "counts": counts[-48:].tolist(),
+                "patterns": "\n".join(
+                    f"- ×{p.get('total')} {p.get('template')}：{(p.get('counts') or [])[-48:]}" for p in patterns
+                )
+                or "（无）",
                 "logs": logs_text,
             },
             config=config,
@@ -391,6 +536,9 @@ async def _run_predict(req: PredictRequest, callbacks: list | None = None) -> Pr
     )
 
 
+_PREDICT_TIMEOUT_MESSAGE = "预测任务超时，请检查 Prometheus/Loki/LLM 可用性后重试。"
+
+
 @app.post("/api/predict/run", response_model=PredictResponse)
 async def predict(req: PredictRequest) -> PredictResponse:
     timeout_s = settings.request_timeout_s + 60.0
@@ -405,45 +553,53 @@ async def predict(req: PredictRequest) -> PredictResponse:
         )
         raise HTTPException(
             status_code=504,
-            detail="预测任务超时，请检查 Prometheus/Loki/LLM 可用性后重试。",
+            detail=_PREDICT_TIMEOUT_MESSAGE,
         )
 
 
+async def _stream_predict(req: PredictRequest, queue) -> PredictResponse:
+    handler = PredictStreamHandler(queue)
+    await queue.put(
+        {
+            "event": "start",
+            "service_name": req.service_name,
+            "lookback_hours": req.lookback_hours,
+        }
+    )
+    try:
+        timeout_s = settings.request_timeout_s + 60.0
+        res = await asyncio.wait_for(_run_predict(req, callbacks=[handler]), timeout=timeout_s)
+    except asyncio.TimeoutError:
+        raise asyncio.TimeoutError(_PREDICT_TIMEOUT_MESSAGE) from None
+    meta = {
+        "event": "final",
+        "service_name": res.service_name,
+        "risk_score": res.risk_score,
+        "risk_level": res.risk_level,
+        "likely_failures": res.likely_failures,
+        "explanation": res.explanation,
+        "trace": res.trace.dict() if res.trace else None,
+    }
+    await queue.put(meta)
+    return res
+
+
+def _ndjson(items: AsyncIterator[dict]) -> StreamingResponse:
+    async def iterator() -> AsyncIterator[bytes]:
+        async for item in items:
+            data = json.dumps(item, ensure_ascii=False, default=str) + "\n"
+            yield data.encode("utf-8")
+
+    return StreamingResponse(iterator(), media_type="application/x-ndjson")
+
+
 @app.post("/api/predict/run/stream")
 async def predict_stream(req: PredictRequest):
-    queue: asyncio.Queue = asyncio.Queue()
+    queue: asyncio.Queue = metrics.track_queue(asyncio.Queue())
 
     async def runner():
         try:
-            handler = PredictStreamHandler(queue)
-            await queue.put(
-                {
-                    "event": "start",
-                    "service_name": req.service_name,
-                    "lookback_hours": req.lookback_hours,
-                }
-            )
-            try:
-                timeout_s = settings.request_timeout_s + 60.0
-                res = await asyncio.wait_for(_run_predict(req, callbacks=[handler]), timeout=timeout_s)
-            except asyncio.TimeoutError:
-                await queue.put(
-                    {
-                        "event": "error",
-                        "message": "预测任务超时，请检查 Prometheus/Loki/LLM 可用性后重试。",
-                    }
-                )
-                return
-            meta = {
-                "event": "final",
-                "service_name": res.service_name,
-                "risk_score": res.risk_score,
-                "risk_level": res.risk_level,
-                "likely_failures": res.likely_failures,
-                "explanation": res.explanation,
-                "trace": res.trace.dict() if res.trace else None,
-            }
-            await queue.put(meta)
+            await _stream_predict(req, queue)
         except Exception as exc:
             await queue.put({"event": "error", "message": str(exc)})
         finally:
@@ -451,12 +607,56 @@ async def predict_stream(req: PredictRequest):
 
     asyncio.create_task(runner())
 
-    async def iterator() -> AsyncIterator[bytes]:
+    async def items() -> AsyncIterator[dict]:
         while True:
             item = await queue.get()
-            data = json.dumps(item, ensure_ascii=False) + "\n"
-            yield data.encode("utf-8")
+            yield item
             if item.get("event") == "end":
                 break
 
-    return StreamingResponse(iterator(), media_type="application/x-ndjson")
+    return _ndjson(items())
+
+
+def _get_job(job_id: str) -> Job:
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期。")
+    return job
+
+
+@app.post("/api/predict/jobs", response_model=JobInfo, status_code=202)
+async def submit_job(req: PredictJobRequest, request: Request) -> JobInfo:
+    user = request.headers.get("X-User-Id") or req.session_id or (request.client.host if request.client else "anonymous")
+
+    async def runner(events: JobEvents) -> dict:
+        return (await _stream_predict(req, events)).model_dump()
+
+    try:
+        job = await jobs.submit(user, req.priority, runner)
+    except JobQueueFull as exc:
+        raise HTTPException(status_code=429, detail=str(exc), headers={"Retry-After": str(int(exc.retry_after_s) + 1)})
+    return JobInfo(**job.view(jobs.position(job)))
+
+
+@app.get("/api/predict/jobs", response_model=JobList)
+async def list_jobs() -> JobList:
+    return JobList(**jobs.snapshot())
+
+
+@app.get("/api/predict/jobs/{job_id}", response_model=JobInfo)
+async def get_job(job_id: str) -> JobInfo:
+    job = _get_job(job_id)
+    return JobInfo(**job.view(jobs.position(job), include_result=True))
+
+
+@app.get("/api/predict/jobs/{job_id}/stream")
+async def stream_job(job_id: str):
+    return _ndjson(_get_job(job_id).events.follow())
+
+
+@app.delete("/api/predict/jobs/{job_id}", response_model=JobInfo)
+async def cancel_job(job_id: str) -> JobInfo:
+    job = _get_job(job_id)
+    if not await jobs.cancel(job):
+        raise HTTPException(status_code=409, detail=f"任务状态为 {job.status}，无法取消。")
+    return JobInfo(**job.view())
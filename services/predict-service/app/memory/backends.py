@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+
+from ..settings import settings
+
+
+_COMPRESS_MIN_BYTES = 512
+
+
+def encode_batch(records: list[dict]) -> bytes:
+    raw = json.dumps(records, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) >= _COMPRESS_MIN_BYTES:
+        return b"z" + zlib.compress(raw, 6)
+    return b"j" + raw
+
+
+def decode_batch(blob: bytes) -> list[dict]:
+    if not blob:
+        return []
+    kind, body = blob[:1], blob[1:]
+    if kind == b"z":
+        body = zlib.decompress(body)
+    try:
+        data = json.loads(body.decode("utf-8"))
+    except Exception:
+        return []
+    return data if isinstance(data, list) else []
+
+
+@dataclass
+class SessionState:
+    summary: str = ""
+    turns: list[list[dict]] = field(default_factory=list)
+
+    def records(self) -> list[dict]:
+        return [r for turn in self.turns for r in turn]
+
+
+class SessionBackend(ABC):
+    """会话历史存储。一次 append 写入一个批次（一轮问答），load 一次读回摘要与全部批次。"""
+
+    def __init__(self, ttl_s: float, max_batches: int):
+        self._ttl_s = ttl_s
+        self._max_batches = max_batches
+
+    @abstractmethod
+    def load(self, session_id: str) -> SessionState:
+        ...
+
+    @abstractmethod
+    def append(self, session_id: str, records: list[dict]) -> None:
+        ...
+
+    @abstractmethod
+    def fold(self, session_id: str, summary: str, turn_count: int) -> None:
+        """写入新的滚动摘要，并删除已被摘要覆盖的最早 turn_count 轮。"""
+
+    @abstractmethod
+    def clear(self, session_id: str) -> None:
+        ...
+
+
+class InMemorySessionBackend(SessionBackend):
+    def __init__(self, ttl_s: float, max_batches: int):
+        super().__init__(ttl_s, max_batches)
+        self._lock = threading.Lock()
+        self._sessions: dict[str, tuple[list[bytes], float]] = {}
+        self._summaries: dict[str, str] = {}
+
+    def _evict_expired(self, now: float) -> None:
+        for key, (_, ts) in list(self._sessions.items()):
+            if now - ts > self._ttl_s:
+                self._sessions.pop(key, None)
+                self._summaries.pop(key, None)
+
+    def load(self, session_id: str) -> SessionState:
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            existing = self._sessions.get(session_id)
+            if existing is None:
+                return SessionState()
+            batches, _ = existing
+            self._sessions[session_id] = (batches, now)
+            blobs = list(batches)
+            summary = self._summaries.get(session_id, "")
+        return SessionState(summary=summary, turns=[decode_batch(blob) for blob in blobs])
+
+    def append(self, session_id: str, records: list[dict]) -> None:
+        if not records:
+            return
+        blob = encode_batch(records)
+        now = time.time()
+        with self._lock:
+            batches, _ = self._sessions.get(session_id, ([], now))
+            batches.append(blob)
+            if len(batches) > self._max_batches:
+                del batches[: len(batches) - self._max_batches]
+            self._sessions[session_id] = (batches, now)
+
+    def fold(self, session_id: str, summary: str, turn_count: int) -> None:
+        with self._lock:
+            existing = self._sessions.get(session_id)
+            if existing is None:
+                return
+            batches, ts = existing
+            del batches[:turn_count]
+            self._sessions[session_id] = (batches, ts)
+            self._summaries[session_id] = summary
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._summaries.pop(session_id, None)
+
+
+class SQLiteSessionBackend(SessionBackend):
+    _CLEANUP_EVERY = 200
+
+    def __init__(self, path: str, ttl_s: float, max_batches: int):
+        super().__init__(ttl_s, max_batches)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_batches ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " session_id TEXT NOT NULL,"
+            " payload BLOB NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_session_batches_sid ON session_batches (session_id, seq)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_summaries ("
+            " session_id TEXT PRIMARY KEY,"
+            " summary TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def load(self, session_id: str) -> SessionState:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT payload, created_at FROM session_batches WHERE session_id = ? ORDER BY seq",
+                (session_id,),
+            ).fetchall()
+            summary_row = self._conn.execute(
+                "SELECT summary, updated_at FROM session_summaries WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+        stamps = [ts for ts in (rows[-1][1] if rows else None, summary_row[1] if summary_row else None) if ts is not None]
+        if not stamps:
+            return SessionState()
+        last_ts = max(stamps)
+        if time.time() - last_ts > self._ttl_s:
+            self.clear(session_id)
+            return SessionState()
+        return SessionState(
+            summary=summary_row[0] if summary_row else "",
+            turns=[decode_batch(payload) for payload, _ in rows],
+        )
+
+    def append(self, session_id: str, records: list[dict]) -> None:
+        if not records:
+            return
+        blob = encode_batch(records)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO session_batches (session_id, payload, created_at) VALUES (?, ?, ?)",
+                    (session_id, blob, now),
+                )
+                self._conn.execute(
+                    "DELETE FROM session_batches WHERE session_id = ? AND seq NOT IN ("
+                    " SELECT seq FROM session_batches WHERE session_id = ? ORDER BY seq DESC LIMIT ?)",
+                    (session_id, session_id, self._max_batches),
+                )
+                self._writes += 1
+                if self._writes % self._CLEANUP_EVERY == 0:
+                    self._conn.execute(
+                        "DELETE FROM session_batches WHERE session_id IN ("
+                        " SELECT session_id FROM session_batches GROUP BY session_id HAVING MAX(created_at) < ?)",
+                        (now - self._ttl_s,),
+                    )
+                    self._conn.execute(
+                        "DELETE FROM session_summaries WHERE updated_at < ? AND session_id NOT IN ("
+                        " SELECT session_id FROM session_batches WHERE created_at >= ?)",
+                        (now - self._ttl_s, now - self._ttl_s),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def fold(self, session_id: str, summary: str, turn_count: int) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM session_batches WHERE seq IN ("
+                    " SELECT seq FROM session_batches WHERE session_id = ? ORDER BY seq LIMIT ?)",
+                    (session_id, turn_count),
+                )
+                self._conn.execute(
+                    "INSERT INTO session_summaries (session_id, summary, updated_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT(session_id) DO UPDATE SET summary = excluded.summary, updated_at = excluded.updated_at",
+                    (session_id, summary, time.time()),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM session_batches WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM session_summaries WHERE session_id = ?", (session_id,))
+
+
+class RedisSessionBackend(SessionBackend):
+    def __init__(self, url: str, ttl_s: float, max_batches: int, key_prefix: str):
+        super().__init__(ttl_s, max_batches)
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self._prefix = key_prefix
+
+    def _key(self, session_id: str) -> str:
+        return f"{self._prefix}{session_id}"
+
+    def _summary_key(self, session_id: str) -> str:
+        return f"{self._prefix}{session_id}:summary"
+
+    def load(self, session_id: str) -> SessionState:
+        key = self._key(session_id)
+        summary_key = self._summary_key(session_id)
+        ttl = int(self._ttl_s)
+        pipe = self._client.pipeline(transaction=False)
+        pipe.lrange(key, 0, -1)
+        pipe.get(summary_key)
+        pipe.expire(key, ttl)
+        pipe.expire(summary_key, ttl)
+        blobs, summary, _, _ = pipe.execute()
+        return SessionState(
+            summary=summary.decode("utf-8") if summary else "",
+            turns=[decode_batch(blob) for blob in blobs or []],
+        )
+
+    def append(self, session_id: str, records: list[dict]) -> None:
+        if not records:
+            return
+        key = self._key(session_id)
+        pipe = self._client.pipeline(transaction=True)
+        pipe.rpush(key, encode_batch(records))
+        pipe.ltrim(key, -self._max_batches, -1)
+        pipe.expire(key, int(self._ttl_s))
+        pipe.execute()
+
+    def fold(self, session_id: str, summary: str, turn_count: int) -> None:
+        key = self._key(session_id)
+        pipe = self._client.pipeline(transaction=True)
+        pipe.ltrim(key, turn_count, -1)
+        pipe.set(self._summary_key(session_id), summary.encode("utf-8"), ex=int(self._ttl_s))
+        pipe.execute()
+
+    def clear(self, session_id: str) -> None:
+        self._client.delete(self._key(session_id), self._summary_key(session_id))
+
+
+def build_session_backend() -> SessionBackend:
+    kind = (settings.session_backend or "memory").lower()
+    ttl_s = settings.session_ttl_s
+    max_batches = settings.session_max_turns
+    if kind == "sqlite":
+        return SQLiteSessionBackend(settings.session_sqlite_path, ttl_s, max_batches)
+    if kind == "redis":
+        return RedisSessionBackend(settings.session_redis_url, ttl_s, max_batches, settings.session_key_prefix)
+    return InMemorySessionBackend(ttl_s, max_batches)
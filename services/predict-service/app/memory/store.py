@@ -1,27 +1,80 @@
 from __future__ import annotations
 
-from datetime import datetime, timedelta, timezone
+from typing import Sequence
 
 from langchain.memory import ConversationBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, messages_from_dict
 
+from ..settings import settings
+from .backends import SessionBackend, SessionState, build_session_backend
 
-_memories: dict[str, tuple[ConversationBufferMemory, datetime]] = {}
 
+_backend: SessionBackend | None = None
 
-def get_memory(session_id: str | None) -> ConversationBufferMemory | None:
+
+def get_backend() -> SessionBackend:
+    global _backend
+    if _backend is None:
+        _backend = build_session_backend()
+    return _backend
+
+
+def _to_records(messages: Sequence[BaseMessage]) -> list[dict]:
+    return [{"t": m.type, "c": m.content} for m in messages]
+
+
+def from_records(records: list[dict]) -> list[BaseMessage]:
+    items = [{"type": r.get("t"), "data": {"content": r.get("c", "")}} for r in records if r.get("t")]
+    try:
+        return messages_from_dict(items)
+    except Exception:
+        return []
+
+
+class SessionChatMessageHistory(BaseChatMessageHistory):
+    def __init__(self, backend: SessionBackend, session_id: str):
+        self._backend = backend
+        self._session_id = session_id
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        return from_records(self.load_state().records())
+
+    def load_state(self) -> SessionState:
+        return self._backend.load(self._session_id)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self._backend.append(self._session_id, _to_records(messages))
+
+    def fold(self, summary: str, turn_count: int) -> None:
+        self._backend.fold(self._session_id, summary, turn_count)
+
+    def clear(self) -> None:
+        self._backend.clear(self._session_id)
+
+
+def get_memory(session_id: str | None) -> BaseChatMemory | None:
     if not session_id:
         return None
-    now = datetime.now(timezone.utc)
-    ttl = timedelta(hours=1)
-    for key, (_, ts) in list(_memories.items()):
-        if now - ts > ttl:
-            _memories.pop(key, None)
-    existing = _memories.get(session_id)
-    if existing is not None:
-        memory, _ = existing
-        _memories[session_id] = (memory, now)
-        return memory
-    memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-    _memories[session_id] = (memory, now)
-    return memory
+    history = SessionChatMessageHistory(get_backend(), session_id)
+    if settings.memory_mode == "summary":
+        from .summary import RollingSummaryMemory
 
+        return RollingSummaryMemory(
+            chat_memory=history,
+            session_id=session_id,
+            memory_key="chat_history",
+            input_key="input",
+            output_key="output",
+            recent_turns=settings.memory_recent_turns,
+            token_budget=settings.memory_token_budget,
+        )
+    return ConversationBufferMemory(
+        chat_memory=history,
+        memory_key="chat_history",
+        input_key="input",
+        output_key="output",
+        return_messages=True,
+    )
@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import json
+import logging
+from typing import Any
+
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from ..settings import settings
+from .backends import SessionState
+from .store import from_records
+
+
+logger = logging.getLogger(__name__)
+
+_folding: set[str] = set()
+_tasks: set[asyncio.Task] = set()
+
+_REF_TOOL_SKIP = {"trace_note"}
+_REF_ARG_KEYS = ("logql", "promql", "service_name", "start_iso", "end_iso")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if "\u4e00" <= ch <= "\u9fff")
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def _observation_size(observation: Any) -> str:
+    if isinstance(observation, dict):
+        if observation.get("error"):
+            return f"错误 {observation.get('error')}"
+        for key, unit in (("line_count", "行"), ("lines", "行"), ("evidence_lines", "行"), ("logs", "行"), ("series", "条序列"), ("counts", "个点")):
+            value = observation.get(key)
+            if isinstance(value, int):
+                return f"{value} {unit}"
+            if isinstance(value, list):
+                return f"{len(value)} {unit}"
+    text = observation if isinstance(observation, str) else json.dumps(observation, ensure_ascii=False, default=str)
+    return f"{len(text)} 字符"
+
+
+def compact_tool_refs(intermediate_steps) -> list[str]:
+    refs: list[str] = []
+    for pair in intermediate_steps or []:
+        try:
+            action, observation = pair
+        except Exception:
+            continue
+        tool = str(getattr(action, "tool", "") or "")
+        if not tool or tool in _REF_TOOL_SKIP:
+            continue
+        tool_input = getattr(action, "tool_input", None)
+        args = ""
+        if isinstance(tool_input, dict):
+            args = ", ".join(f"{k}={tool_input[k]}" for k in _REF_ARG_KEYS if tool_input.get(k))
+        elif tool_input:
+            args = str(tool_input)
+        if len(args) > 200:
+            args = args[:200] + "..."
+        refs.append(f"{tool}({args}) -> {_observation_size(observation)}")
+    return refs
+
+
+def _render_turn(turn: list[dict]) -> str:
+    parts = []
+    for record in turn:
+        role = "用户" if record.get("t") == "human" else "助手"
+        parts.append(f"{role}：{record.get('c', '')}")
+    return "\n".join(parts)
+
+
+async def _summarize(previous: str, turns: list[list[dict]], max_tokens: int) -> str:
+    from ..llm import get_llm
+
+    history = "\n\n".join(_render_turn(turn) for turn in turns)
+    messages = [
+        SystemMessage(
+            content=(
+                "你负责压缩运维对话历史。把新的对话内容合并进已有摘要，保留涉及的服务名、时间范围、"
+                "关键 LogQL/PromQL、已确认的结论与未解决的问题，删除寒暄与重复内容。"
+                f"只输出摘要正文，不超过 {max_tokens} 个 token。"
+            )
+        ),
+        HumanMessage(content=f"已有摘要：\n{previous or '（无）'}\n\n新的对话：\n{history}"),
+    ]
+    res = await get_llm().ainvoke(messages)
+    return str(getattr(res, "content", "") or "").strip()
+
+
+class RollingSummaryMemory(BaseChatMemory):
+    """保留最近 recent_turns 轮原文，更早的轮次在请求之外异步折叠进滚动摘要。"""
+
+    session_id: str
+    memory_key: str = "chat_history"
+    recent_turns: int = 3
+    token_budget: int = 1500
+
+    @property
+    def memory_variables(self) -> list[str]:
+        return [self.memory_key]
+
+    def _render(self, state: SessionState) -> list[BaseMessage]:
+        recent = state.turns[-self.recent_turns :] if self.recent_turns > 0 else []
+        budget = self.token_budget
+        summary = state.summary
+        summary_tokens = estimate_tokens(summary)
+        if summary_tokens > budget // 2:
+            keep = max(0, int(len(summary) * (budget // 2) / summary_tokens))
+            summary = summary[:keep] + "..."
+            summary_tokens = estimate_tokens(summary)
+        budget -= summary_tokens
+        kept: list[list[dict]] = []
+        for turn in reversed(recent):
+            cost = sum(estimate_tokens(str(r.get("c", ""))) for r in turn)
+            if kept and cost > budget:
+                break
+            kept.append(turn)
+            budget -= cost
+        kept.reverse()
+        messages: list[BaseMessage] = []
+        if summary:
+            messages.append(SystemMessage(content=f"此前对话摘要：{summary}"))
+        messages.extend(from_records([r for turn in kept for r in turn]))
+        return messages
+
+    def load_memory_variables(self, inputs: dict[str, Any]) -> dict[str, Any]:
+        return {self.memory_key: self._render(self.chat_memory.load_state())}
+
+    async def aload_memory_variables(self, inputs: dict[str, Any]) -> dict[str, Any]:
+        state = await asyncio.to_thread(self.chat_memory.load_state)
+        return {self.memory_key: self._render(state)}
+
+    def _turn_messages(self, inputs: dict[str, Any], outputs: dict[str, Any]) -> list[BaseMessage]:
+        input_str, output_str = self._get_input_output(inputs, outputs)
+        refs = compact_tool_refs(outputs.get("intermediate_steps"))
+        if refs:
+            output_str = f"{output_str}\n\n[已调用工具]\n" + "\n".join(refs)
+        return [HumanMessage(content=input_str), AIMessage(content=output_str)]
+
+    def save_context(self, inputs: dict[str, Any], outputs: dict[str, Any]) -> None:
+        self.chat_memory.add_messages(self._turn_messages(inputs, outputs))
+        self._schedule_fold()
+
+    async def asave_context(self, inputs: dict[str, Any], outputs: dict[str, Any]) -> None:
+        await self.chat_memory.aadd_messages(self._turn_messages(inputs, outputs))
+        self._schedule_fold()
+
+    def _schedule_fold(self) -> None:
+        if self.session_id in _folding:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        _folding.add(self.session_id)
+        task = loop.create_task(self._fold(), context=contextvars.Context())
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+    async def _fold(self) -> None:
+        try:
+            state = await asyncio.to_thread(self.chat_memory.load_state)
+            if len(state.turns) < self.recent_turns + settings.memory_fold_batch_turns:
+                return
+            older = state.turns[: len(state.turns) - self.recent_turns]
+            summary = await _summarize(state.summary, older, settings.memory_summary_max_tokens)
+            if not summary:
+                return
+            await asyncio.to_thread(self.chat_memory.fold, summary, len(older))
+        except Exception:
+            logger.warning("memory fold failed session=%s", self.session_id, exc_info=True)
+        finally:
+            _folding.discard(self.session_id)
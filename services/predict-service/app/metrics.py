@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import time
+import weakref
+from typing import Awaitable, Callable, Iterator, ParamSpec, TypeVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+_SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+_FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HTTP_LATENCY = Histogram(
+    "aegis_http_request_duration_seconds",
+    "HTTP 请求耗时（流式接口计到响应体发送完毕）",
+    ["method", "route", "status"],
+    buckets=_SLOW_BUCKETS,
+)
+TOOL_LATENCY = Histogram("aegis_tool_call_duration_seconds", "Agent 工具调用耗时", ["tool"], buckets=_SLOW_BUCKETS)
+TOOL_ERRORS = Counter("aegis_tool_errors_total", "Agent 工具调用失败次数（含结构化错误返回）", ["tool", "error"])
+UPSTREAM_LATENCY = Histogram(
+    "aegis_upstream_request_duration_seconds",
+    "单次 Loki/Prometheus HTTP 请求耗时",
+    ["backend", "endpoint", "outcome"],
+    buckets=_FAST_BUCKETS,
+)
+UPSTREAM_BYTES = Counter("aegis_upstream_response_bytes_total", "Loki/Prometheus 响应体字节数", ["backend", "endpoint"])
+LLM_TTFT = Histogram("aegis_llm_time_to_first_token_seconds", "LLM 流式调用首个分片延迟", ["model"], buckets=_SLOW_BUCKETS)
+LLM_LATENCY = Histogram("aegis_llm_request_duration_seconds", "LLM 单次调用总耗时", ["model", "outcome"], buckets=_SLOW_BUCKETS)
+LLM_TOKENS = Counter("aegis_llm_tokens_total", "LLM token 用量", ["model", "kind"])
+ACTIVE_SESSIONS = Gauge("aegis_active_sessions", "正在进行的分析会话数")
+STREAM_QUEUE_DEPTH = Gauge("aegis_stream_queue_depth", "所有流式响应队列中尚未发送的事件数")
+JOB_QUEUE_DEPTH = Gauge("aegis_job_queue_depth", "异步任务排队数")
+JOB_RUNNING = Gauge("aegis_job_running", "异步任务运行数")
+
+_llm_calls: contextvars.ContextVar[list[dict] | None] = contextvars.ContextVar("llm_calls", default=None)
+
+_stream_queues: weakref.WeakSet[asyncio.Queue] = weakref.WeakSet()
+STREAM_QUEUE_DEPTH.set_function(lambda: sum(q.qsize() for q in list(_stream_queues)))
+
+
+def track_queue(queue: asyncio.Queue) -> asyncio.Queue:
+    _stream_queues.add(queue)
+    return queue
+
+
+def tracked_session(fn: Callable[P, Awaitable[R]]) -> Callable[P, Awaitable[R]]:
+    @functools.wraps(fn)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        with ACTIVE_SESSIONS.track_inprogress():
+            return await fn(*args, **kwargs)
+
+    return wrapper
+
+
+def observe_tool(tool: str, seconds: float, observation: object = None, exc: BaseException | None = None) -> None:
+    TOOL_LATENCY.labels(tool).observe(seconds)
+    if exc is not None:
+        TOOL_ERRORS.labels(tool, type(exc).__name__).inc()
+    elif isinstance(observation, dict) and observation.get("error"):
+        TOOL_ERRORS.labels(tool, str(observation["error"])).inc()
+
+
+@contextlib.contextmanager
+def upstream_call(backend: str, endpoint: str) -> Iterator[dict]:
+    """记录一次上游 HTTP 请求；调用方把响应体大小写入 yield 出的 dict 的 "bytes"。"""
+    info = {"bytes": 0}
+    outcome = "error"
+    started = time.perf_counter()
+    try:
+        yield info
+        outcome = "ok"
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        UPSTREAM_LATENCY.labels(backend, endpoint, outcome).observe(time.perf_counter() - started)
+        if info["bytes"]:
+            UPSTREAM_BYTES.labels(backend, endpoint).inc(info["bytes"])
+
+
+def observe_llm(
+    model: str,
+    seconds: float,
+    outcome: str,
+    usage: dict | None,
+    ttft_s: float | None = None,
+) -> None:
+    LLM_LATENCY.labels(model, outcome).observe(seconds)
+    if ttft_s is not None:
+        LLM_TTFT.labels(model).observe(ttft_s)
+    usage = usage or {}
+    if usage.get("input_tokens"):
+        LLM_TOKENS.labels(model, "prompt").inc(usage["input_tokens"])
+    if usage.get("output_tokens"):
+        LLM_TOKENS.labels(model, "completion").inc(usage["output_tokens"])
+    calls = _llm_calls.get()
+    if calls is not None:
+        calls.append(
+            {
+                "ended": time.perf_counter(),
+                "seconds": seconds,
+                "ttft_s": ttft_s,
+                "outcome": outcome,
+                "input_tokens": usage.get("input_tokens") or 0,
+                "output_tokens": usage.get("output_tokens") or 0,
+            }
+        )
+
+
+@contextlib.contextmanager
+def collect_llm_calls() -> Iterator[list[dict]]:
+    """在当前上下文（及其派生的 Task）内收集每次 LLM 调用的耗时与 token 用量，供 Agent trace 使用。"""
+    calls: list[dict] = []
+    token = _llm_calls.set(calls)
+    try:
+        yield calls
+    finally:
+        _llm_calls.reset(token)
+
+
+def render() -> tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """纯 ASGI 中间件，按路由模板（而非原始路径）记录请求耗时，避免标签基数膨胀。"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            if route != "/metrics":
+                HTTP_LATENCY.labels(scope["method"], route, str(status)).observe(time.perf_counter() - started)
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+from datetime import datetime
+from typing import Literal
+
 from pydantic import BaseModel, Field
 
 
@@ -9,10 +12,52 @@ class TraceStep(BaseModel):
     tool_input: str | None = None
     observation: str | None = None
     log: str | None = None
+    iteration: int | None = None
+    started_at: datetime | None = None
+    ended_at: datetime | None = None
+    started_ms: float | None = None
+    wait_ms: float | None = None
+    duration_ms: float | None = None
+    llm_ms: float | None = None
+    observation_raw_chars: int | None = None
+    observation_chars: int | None = None
+
+
+class IterationTiming(BaseModel):
+    index: int
+    started_at: datetime | None = None
+    ended_at: datetime | None = None
+    started_ms: float | None = None
+    llm_ms: float | None = None
+    ttft_ms: float | None = None
+    tools_ms: float | None = None
+    wall_ms: float | None = None
+    tool_calls: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+
+
+class TraceBreakdown(BaseModel):
+    wall_ms: float | None = None
+    llm_ms: float | None = None
+    tool_wall_ms: float | None = None
+    tool_ms: float | None = None
+    other_ms: float | None = None
+    iterations: int = 0
+    tool_calls: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    observation_raw_chars: int = 0
+    observation_chars: int = 0
 
 
 class AgentTrace(BaseModel):
     steps: list[TraceStep] = []
+    iterations: list[IterationTiming] = []
+    stopped_reason: str | None = None
+    breakdown: TraceBreakdown | None = None
 
 
 class PredictRequest(BaseModel):
@@ -35,3 +80,30 @@ class LikelyFailures(BaseModel):
     explanation: str
     risk_score: float | None = Field(default=None, ge=0.0, le=1.0)
     risk_level: str | None = None
+
+
+class PredictJobRequest(PredictRequest):
+    priority: int = Field(default=5, ge=0, le=9)
+
+
+class JobInfo(BaseModel):
+    job_id: str
+    status: Literal["queued", "running", "succeeded", "failed", "cancelled"]
+    user: str
+    priority: int
+    position: int | None = None
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    wait_ms: float | None = None
+    run_ms: float | None = None
+    error: str | None = None
+    result: PredictResponse | None = None
+
+
+class JobList(BaseModel):
+    workers: int
+    max_depth: int
+    queued: int
+    running: int
+    jobs: list[JobInfo] = []
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Coroutine, ParamSpec, TypeVar
+
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from .settings import settings
+from .singleflight import normalize_query
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+logger = logging.getLogger(__name__)
+
+# 随调用时刻变化的参数，不参与上游响应的匹配
+_TIME_PARAMS = {"start", "end", "time"}
+
+_cassette: contextvars.ContextVar["Cassette | None"] = contextvars.ContextVar("replay_cassette", default=None)
+_fixtures: dict[str, dict] = {}
+
+
+class ReplayMiss(RuntimeError):
+    """回放时找不到与本次调用对应的录制记录，通常说明代码路径与录制时不同。"""
+
+
+class ReplayedError(RuntimeError):
+    """录制时上游调用失败，回放时原样抛出同一错误信息。"""
+
+
+def _upstream_key(backend: str, path: str, params: dict | None) -> str:
+    items = sorted(
+        (k, normalize_query(v) if k == "query" else v) for k, v in (params or {}).items() if k not in _TIME_PARAMS
+    )
+    return json.dumps([backend, path, items], ensure_ascii=False, default=str)
+
+
+def _messages_key(messages: list[BaseMessage]) -> str:
+    payload = json.dumps([message_to_dict(m) for m in messages], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def _delay(seconds: float) -> float:
+    scaled = seconds / settings.replay_speed if settings.replay_speed > 0 else 0.0
+    return scaled + settings.replay_latency_ms / 1000.0
+
+
+class Cassette:
+    """一次分析会话的录制内容：按调用顺序保存的 LLM 交互与 Loki/Prometheus 响应。"""
+
+    def __init__(self, mode: str, fixture: dict | None = None):
+        self.mode = mode
+        self.llm: list[dict] = list((fixture or {}).get("llm") or [])
+        self.upstream: list[dict] = list((fixture or {}).get("upstream") or [])
+        self._llm_used: set[int] = set()
+        self._upstream_cursor: dict[str, int] = {}
+
+    def take_llm(self, request_key: str) -> dict:
+        """优先取请求内容完全相同的记录，否则按录制顺序取下一条未用过的记录。"""
+        for idx, entry in enumerate(self.llm):
+            if idx not in self._llm_used and entry.get("request_key") == request_key:
+                self._llm_used.add(idx)
+                return entry
+        for idx, entry in enumerate(self.llm):
+            if idx not in self._llm_used:
+                self._llm_used.add(idx)
+                return entry
+        raise ReplayMiss(f"录制中的 {len(self.llm)} 次 LLM 调用已全部回放完")
+
+    def take_upstream(self, key: str) -> dict:
+        """同一查询被调用多次时按录制顺序依次返回，超出录制次数后重复最后一条。"""
+        matches = [entry for entry in self.upstream if entry["key"] == key]
+        if not matches:
+            raise ReplayMiss(f"录制中没有该上游查询：{key}")
+        cursor = self._upstream_cursor.get(key, 0)
+        self._upstream_cursor[key] = cursor + 1
+        return matches[min(cursor, len(matches) - 1)]
+
+
+def _load_fixture(path: str) -> dict:
+    fixture = _fixtures.get(path)
+    if fixture is None:
+        fixture = json.loads(Path(path).read_text(encoding="utf-8"))
+        _fixtures[path] = fixture
+    return fixture
+
+
+def _write_fixture(cassette: Cassette, entry: str, request: Any) -> Path:
+    now = datetime.now(timezone.utc)
+    path = Path(settings.replay_dir) / f"{settings.service_name}-{now:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fixture = {
+        "service": settings.service_name,
+        "entry": entry,
+        "recorded_at": now.isoformat(),
+        "request": request.model_dump(mode="json") if hasattr(request, "model_dump") else None,
+        "llm": cassette.llm,
+        "upstream": cassette.upstream,
+    }
+    path.write_text(json.dumps(fixture, ensure_ascii=False, default=str), encoding="utf-8")
+    return path
+
+
+def session(fn: Callable[P, Awaitable[R]]) -> Callable[P, Awaitable[R]]:
+    """按 settings.replay_mode 为被装饰的会话录制或回放外部调用；off 时不做任何事。
+
+    record：会话结束后把本次所有 LLM 交互与上游响应写入 replay_dir 下的一个 fixture 文件。
+    replay：从 replay_fixture 提供 LLM 与上游响应，不访问任何后端。
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        mode = settings.replay_mode
+        if mode not in ("record", "replay"):
+            return await fn(*args, **kwargs)
+        if mode == "replay":
+            if not settings.replay_fixture:
+                raise RuntimeError("REPLAY_MODE=replay 需要设置 REPLAY_FIXTURE")
+            cassette = Cassette(mode, _load_fixture(settings.replay_fixture))
+        else:
+            cassette = Cassette(mode)
+        token = _cassette.set(cassette)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            _cassette.reset(token)
+            if mode == "record":
+                path = await asyncio.to_thread(_write_fixture, cassette, fn.__name__, args[0] if args else None)
+                logger.info("replay fixture recorded path=%s llm=%d upstream=%d", path, len(cassette.llm), len(cassette.upstream))
+
+    return wrapper
+
+
+async def upstream(backend: str, path: str, params: dict | None, fetch: Callable[[], Awaitable[dict]]) -> dict:
+    """录制或回放一次 Loki/Prometheus 查询的 JSON 响应；未启用时直接调用 fetch。"""
+    cassette = _cassette.get()
+    if cassette is None:
+        return await fetch()
+    key = _upstream_key(backend, path, params)
+    if cassette.mode == "replay":
+        entry = cassette.take_upstream(key)
+        await asyncio.sleep(_delay(entry["seconds"]))
+        if "error" in entry:
+            raise ReplayedError(entry["error"])
+        return entry["response"]
+    started = time.perf_counter()
+    try:
+        data = await fetch()
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:
+        cassette.upstream.append(
+            {"key": key, "seconds": time.perf_counter() - started, "error": f"{type(exc).__name__}: {exc}"}
+        )
+        raise
+    cassette.upstream.append({"key": key, "seconds": time.perf_counter() - started, "response": data})
+    return data
+
+
+async def llm_stream(
+    messages: list[BaseMessage],
+    source: AsyncIterator[ChatGenerationChunk],
+    run_manager: Any = None,
+) -> AsyncIterator[ChatGenerationChunk]:
+    """录制或回放一次流式 LLM 调用的全部分片及其到达时刻。"""
+    cassette = _cassette.get()
+    if cassette is None:
+        async for chunk in source:
+            yield chunk
+        return
+    request_key = _messages_key(messages)
+    if cassette.mode == "replay":
+        await source.aclose()
+        entry = cassette.take_llm(request_key)
+        elapsed = 0.0
+        if settings.replay_latency_ms:
+            await asyncio.sleep(settings.replay_latency_ms / 1000.0)
+        for item in entry.get("chunks") or []:
+            wait = (item["at"] - elapsed) / settings.replay_speed if settings.replay_speed > 0 else 0.0
+            elapsed = item["at"]
+            if wait > 0:
+                await asyncio.sleep(wait)
+            chunk = ChatGenerationChunk(
+                message=messages_from_dict([item["message"]])[0],
+                generation_info=item.get("generation_info"),
+            )
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        if "error" in entry:
+            raise ReplayedError(entry["error"])
+        return
+    entry = {"request_key": request_key, "request": [message_to_dict(m) for m in messages], "chunks": []}
+    cassette.llm.append(entry)
+    started = time.perf_counter()
+    try:
+        async for chunk in source:
+            entry["chunks"].append(
+                {
+                    "at": time.perf_counter() - started,
+                    "message": message_to_dict(chunk.message),
+                    "generation_info": chunk.generation_info,
+                }
+            )
+            yield chunk
+    except Exception as exc:
+        entry["error"] = f"{type(exc).__name__}: {exc}"
+        raise
+
+
+async def llm_generate(messages: list[BaseMessage], call: Coroutine[Any, Any, ChatResult]) -> ChatResult:
+    """录制或回放一次非流式 LLM 调用的结果。"""
+    cassette = _cassette.get()
+    if cassette is None:
+        return await call
+    request_key = _messages_key(messages)
+    if cassette.mode == "replay":
+        call.close()
+        entry = cassette.take_llm(request_key)
+        await asyncio.sleep(_delay(entry.get("seconds") or 0.0))
+        if "error" in entry:
+            raise ReplayedError(entry["error"])
+        generations = [
+            ChatGeneration(message=messages_from_dict([g["message"]])[0], generation_info=g.get("generation_info"))
+            for g in entry.get("generations") or []
+        ]
+        return ChatResult(generations=generations, llm_output=entry.get("llm_output"))
+    entry = {"request_key": request_key, "request": [message_to_dict(m) for m in messages], "generations": []}
+    cassette.llm.append(entry)
+    started = time.perf_counter()
+    try:
+        result = await call
+    except Exception as exc:
+        entry["error"] = f"{type(exc).__name__}: {exc}"
+        raise
+    finally:
+        entry["seconds"] = time.perf_counter() - started
+    entry["generations"] = [
+        {"message": message_to_dict(g.message), "generation_info": g.generation_info} for g in result.generations
+    ]
+    entry["llm_output"] = result.llm_output
+    return result
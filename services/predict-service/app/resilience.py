@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+
+import httpx
+
+from . import deadline
+from .settings import settings
+
+
+T = TypeVar("T")
+Attempt = Callable[[float], Awaitable[T]]
+
+
+class EndpointStats:
+    """单个上游端点的滚动延迟窗口与重试/对冲计数。"""
+
+    def __init__(self, name: str, window: int = 200):
+        self.name = name
+        self._latencies: deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def observe(self, seconds: float) -> None:
+        self._latencies.append(seconds)
+
+    def quantile(self, q: float) -> float | None:
+        if len(self._latencies) < max(1, settings.upstream_hedge_min_samples):
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def hedge_delay(self) -> float | None:
+        if not settings.upstream_hedge_enabled:
+            return None
+        p = self.quantile(settings.upstream_hedge_quantile)
+        if p is None:
+            return None
+        return max(p, settings.upstream_hedge_min_delay_s)
+
+    def stats(self) -> dict:
+        p50 = self.quantile(0.5)
+        p95 = self.quantile(0.95)
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "samples": len(self._latencies),
+            "p50_ms": round(p50 * 1000.0, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000.0, 1) if p95 is not None else None,
+        }
+
+
+_endpoints: dict[str, EndpointStats] = {}
+
+
+def get_endpoint(name: str) -> EndpointStats:
+    ep = _endpoints.get(name)
+    if ep is None:
+        ep = EndpointStats(name)
+        _endpoints[name] = ep
+    return ep
+
+
+def stats() -> dict[str, dict]:
+    return {name: ep.stats() for name, ep in _endpoints.items()}
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError))
+
+
+async def _timed(ep: EndpointStats, attempt: Attempt[T], timeout_s: float) -> T:
+    started = time.monotonic()
+    result = await asyncio.wait_for(attempt(timeout_s), timeout_s)
+    ep.observe(time.monotonic() - started)
+    return result
+
+
+async def _hedged(ep: EndpointStats, attempt: Attempt[T], budget_s: float) -> T:
+    primary = asyncio.ensure_future(_timed(ep, attempt, budget_s))
+    delay = ep.hedge_delay()
+    if delay is None or delay >= budget_s:
+        return await primary
+    pending: set[asyncio.Future] = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return primary.result()
+        ep.hedges += 1
+        hedge = asyncio.ensure_future(_timed(ep, attempt, budget_s - delay))
+        pending.add(hedge)
+        error: BaseException | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    if fut is hedge:
+                        ep.hedge_wins += 1
+                    return fut.result()
+                error = fut.exception()
+        assert error is not None
+        raise error
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
+async def call(endpoint: str, attempt: Attempt[T], timeout_s: float) -> T:
+    """执行幂等读请求：失败时按带抖动的指数退避重试，慢于该端点 p95 时发出对冲请求取先到者。
+
+    attempt 接收本次可用的超时秒数；重试、退避与对冲都不会超出 timeout_s 与请求剩余预算中较小的一个。
+    """
+    ep = get_endpoint(endpoint)
+    ep.calls += 1
+    until = time.monotonic() + (deadline.clamp(timeout_s) or 0.0)
+    retries = 0
+    while True:
+        remaining = until - time.monotonic()
+        try:
+            if remaining <= 0:
+                raise deadline.DeadlineExceeded(f"{endpoint} 超出剩余时间预算")
+            return await _hedged(ep, attempt, remaining)
+        except Exception as exc:
+            backoff = random.uniform(0, min(settings.upstream_retry_max_s, settings.upstream_retry_base_s * 2**retries))
+            if (
+                retries >= settings.upstream_max_retries
+                or not is_retryable(exc)
+                or time.monotonic() + backoff >= until
+            ):
+                ep.failures += 1
+                raise
+        retries += 1
+        ep.retries += 1
+        await asyncio.sleep(backoff)
@@ -0,0 +1,431 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from .loki_client import LokiClient
+from .settings import settings
+from .sketch import PatternSketch
+from .tools.prometheus_query_range import fetch_prometheus_range
+
+
+logger = logging.getLogger(__name__)
+
+BUCKET_S = 300
+ERRORS = "errors"
+_TEMPLATE_PREFIX = "tpl:"
+_METRIC_PREFIX = "metric:"
+
+
+def bucket_of(dt: datetime) -> int:
+    return int(dt.timestamp()) // BUCKET_S
+
+
+def bucket_start(bucket: int) -> datetime:
+    return datetime.fromtimestamp(bucket * BUCKET_S, tz=timezone.utc)
+
+
+def error_query(service: str) -> str:
+    selector = settings.loki_selector_template.format(label_key=settings.loki_service_label_key, service=service)
+    error_regex = (
+        r'(?i)('
+        r'error|exception|traceback|panic|fatal|timeout|'
+        r'unauthorized|forbidden|denied|permission denied|'
+        r'authentication failed|login failed|invalid password|'
+        r'4\d\d|5\d\d|'
+        r'connection refused|connection reset'
+        r')'
+    )
+    # 反引号字符串不处理转义，正则中的 \d 可原样传给 Loki
+    return f"{selector} |~ `{error_regex}`"
+
+
+class RollupStore:
+    """按服务保存 5 分钟桶的错误计数、高频模板计数与关键指标。
+
+    每个服务记录一段连续的已入库区间 [covered_from, covered_to)（桶序号），区间内没有行的桶即为 0。
+    所有方法都是同步的 SQLite 调用，在事件循环中应通过 asyncio.to_thread 调用。
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rollup ("
+            " service TEXT NOT NULL,"
+            " series TEXT NOT NULL,"
+            " bucket INTEGER NOT NULL,"
+            " value REAL NOT NULL,"
+            " PRIMARY KEY (service, series, bucket)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rollup_templates ("
+            " service TEXT NOT NULL,"
+            " series TEXT NOT NULL,"
+            " template TEXT NOT NULL,"
+            " example TEXT NOT NULL,"
+            " PRIMARY KEY (service, series)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rollup_coverage ("
+            " service TEXT PRIMARY KEY,"
+            " covered_from INTEGER,"
+            " covered_to INTEGER,"
+            " requested_at REAL NOT NULL)"
+        )
+
+    def track(self, service: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO rollup_coverage (service, requested_at) VALUES (?, ?)"
+                " ON CONFLICT(service) DO UPDATE SET requested_at = excluded.requested_at",
+                (service, time.time()),
+            )
+
+    def services(self, idle_s: float) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT service FROM rollup_coverage WHERE requested_at >= ? ORDER BY requested_at DESC",
+                (time.time() - idle_s,),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def coverage(self, service: str) -> tuple[int, int] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT covered_from, covered_to FROM rollup_coverage WHERE service = ?", (service,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return row[0], row[1]
+
+    def write(self, service: str, lo: int, hi: int, rows: list[tuple[str, int, float]], templates: list[tuple[str, str, str]]) -> None:
+        """写入 [lo, hi) 区间的数据并把它并入已覆盖区间；区间必须与已覆盖区间相接或重叠，否则抛出 ValueError。"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT covered_from, covered_to FROM rollup_coverage WHERE service = ?", (service,)
+                ).fetchone()
+                if row is not None and row[0] is not None and (hi < row[0] or lo > row[1]):
+                    raise ValueError(f"{service}: [{lo}, {hi}) 与已覆盖区间 [{row[0]}, {row[1]}) 不相接")
+                self._conn.execute(
+                    "DELETE FROM rollup WHERE service = ? AND bucket >= ? AND bucket < ?", (service, lo, hi)
+                )
+                self._conn.executemany(
+                    "INSERT INTO rollup (service, series, bucket, value) VALUES (?, ?, ?, ?)",
+                    [(service, series, bucket, value) for series, bucket, value in rows],
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO rollup_templates (service, series, template, example) VALUES (?, ?, ?, ?)",
+                    [(service, series, template, example) for series, template, example in templates],
+                )
+                self._conn.execute(
+                    "UPDATE rollup_coverage SET"
+                    " covered_from = MIN(COALESCE(covered_from, ?), ?),"
+                    " covered_to = MAX(COALESCE(covered_to, ?), ?)"
+                    " WHERE service = ?",
+                    (lo, lo, hi, hi, service),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def reset(self, service: str) -> None:
+        """丢弃服务的全部桶与已覆盖区间，之后从头入库。"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM rollup WHERE service = ?", (service,))
+                self._conn.execute("DELETE FROM rollup_templates WHERE service = ?", (service,))
+                self._conn.execute(
+                    "UPDATE rollup_coverage SET covered_from = NULL, covered_to = NULL WHERE service = ?", (service,)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def prune(self, before: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM rollup WHERE bucket < ?", (before,))
+            # 整段已覆盖区间都早于保留期的服务没有剩下任何数据，清空区间而不是把起点推到 covered_to 之后
+            self._conn.execute(
+                "UPDATE rollup_coverage SET covered_from = NULL, covered_to = NULL WHERE covered_to <= ?", (before,)
+            )
+            self._conn.execute(
+                "UPDATE rollup_coverage SET covered_from = ? WHERE covered_from < ?", (before, before)
+            )
+            self._conn.execute(
+                "DELETE FROM rollup_templates WHERE NOT EXISTS ("
+                " SELECT 1 FROM rollup r WHERE r.service = rollup_templates.service AND r.series = rollup_templates.series)"
+            )
+
+    def series(self, service: str, series: str, lo: int, hi: int) -> np.ndarray:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT bucket, value FROM rollup WHERE service = ? AND series = ? AND bucket >= ? AND bucket < ?",
+                (service, series, lo, hi),
+            ).fetchall()
+        out = np.zeros(max(0, hi - lo), dtype=float)
+        for bucket, value in rows:
+            out[bucket - lo] = value
+        return out
+
+    def top_templates(self, service: str, lo: int, hi: int, n: int) -> list[tuple[str, float, str, str]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT r.series, SUM(r.value) AS total, t.template, t.example"
+                " FROM rollup r JOIN rollup_templates t ON t.service = r.service AND t.series = r.series"
+                " WHERE r.service = ? AND r.series LIKE ? AND r.bucket >= ? AND r.bucket < ?"
+                " GROUP BY r.series ORDER BY total DESC LIMIT ?",
+                (service, _TEMPLATE_PREFIX + "%", lo, hi, n),
+            ).fetchall()
+        return [(series, total, template, example) for series, total, template, example in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT service, covered_from, covered_to FROM rollup_coverage ORDER BY service"
+            ).fetchall()
+            count = self._conn.execute("SELECT COUNT(*) FROM rollup").fetchone()[0]
+        return {
+            "rows": count,
+            "services": {
+                service: None
+                if lo is None
+                else {"from": bucket_start(lo).isoformat(), "to": bucket_start(hi).isoformat()}
+                for service, lo, hi in rows
+            },
+        }
+
+
+_store: RollupStore | None = None
+
+
+def get_store() -> RollupStore:
+    global _store
+    if _store is None:
+        _store = RollupStore(settings.predict_rollup_path)
+    return _store
+
+
+def _track_and_cover(store: RollupStore, service: str) -> tuple[int, int] | None:
+    store.track(service)
+    return store.coverage(service)
+
+
+def _read_local(
+    store: RollupStore, service: str, first: int, recent_from: int, local_to: int
+) -> tuple[np.ndarray, list[tuple[str, float, str, str, np.ndarray]], dict[str, list[float]]]:
+    """一次性读出 read_features 需要的全部本地数据（在工作线程中执行）。"""
+    counts = store.series(service, ERRORS, first, local_to)
+    templates = [
+        (series, total, template, example, store.series(service, series, recent_from, local_to))
+        for series, total, template, example in store.top_templates(
+            service, first, local_to, settings.predict_top_patterns
+        )
+    ]
+    metrics = {
+        name: store.series(service, _METRIC_PREFIX + name, recent_from, local_to).tolist()
+        for name in settings.predict_rollup_metrics
+    }
+    return counts, templates, metrics
+
+
+async def read_features(loki: LokiClient, service: str, start: datetime, now: datetime) -> dict | None:
+    """已入库区间覆盖回看窗口时，从本地读取已结束的桶，只向 Loki 查询入库之后的尾部（通常是当前未结束的桶）。
+
+    覆盖不足时返回 None，由调用方走完整扫描；同时登记该服务，后台 ingester 随后会开始跟踪它。
+    """
+    store = get_store()
+    covered = await asyncio.to_thread(_track_and_cover, store, service)
+    first, current = bucket_of(start), bucket_of(now)
+    if covered is None or covered[0] > first or covered[1] < current - settings.predict_rollup_max_lag_buckets:
+        return None
+    started = time.perf_counter()
+    local_to = covered[1]
+    recent = min(288, current + 1 - first)
+    recent_from = current + 1 - recent
+
+    tail = PatternSketch(
+        bucket_start(local_to),
+        bucket_start(current + 1),
+        bucket_s=BUCKET_S,
+        width=settings.predict_sketch_width,
+        depth=settings.predict_sketch_depth,
+        heavy_hitters=settings.predict_sketch_heavy_hitters,
+        recent_buckets=current + 1 - local_to,
+    )
+    logs: list[str] = []
+    async for page, more in loki.iter_query_range(
+        error_query(service), bucket_start(local_to), now, page_limit=settings.predict_page_limit
+    ):
+        tail.add_page(page.raw)
+        if not logs:
+            logs = page.flatten_log_lines(limit=120)
+        if more and tail.pages >= settings.predict_max_pages:
+            return None
+
+    tail_counts = np.asarray(tail.counts(), dtype=float)
+    local_counts, local_templates, local_metrics = await asyncio.to_thread(
+        _read_local, store, service, first, recent_from, local_to
+    )
+    counts = np.concatenate([local_counts, tail_counts])
+    tail_patterns = {p["fingerprint"]: p for p in tail.top_patterns(settings.predict_top_patterns)}
+
+    patterns = []
+    for series, total, template, example, local_series in local_templates:
+        fp = series[len(_TEMPLATE_PREFIX) :]
+        extra = tail_patterns.pop(fp, None)
+        tail_series = np.asarray(extra["counts"], dtype=float) if extra else np.zeros(tail_counts.size)
+        series_counts = np.concatenate([local_series, tail_series])
+        patterns.append(
+            {
+                "fingerprint": fp,
+                "template": template,
+                "example": example,
+                "total": int(total + (extra["total"] if extra else 0)),
+                "max_overcount": extra["max_overcount"] if extra else 0,
+                "counts": series_counts[-recent:].tolist(),
+            }
+        )
+    # 只在尾部出现的模板与本地的高频模板一起按总数排序
+    for fp, extra in tail_patterns.items():
+        padded = np.concatenate([np.zeros(max(0, recent - len(extra["counts"]))), np.asarray(extra["counts"], dtype=float)])
+        patterns.append({**extra, "counts": padded[-recent:].tolist()})
+    patterns = sorted(patterns, key=lambda p: -p["total"])[: settings.predict_top_patterns]
+    if not logs:
+        logs = [p["example"] for p in patterns]
+
+    return {
+        "counts": counts[-288:].tolist(),
+        "patterns": patterns,
+        "metrics": local_metrics,
+        "logs": logs,
+        "scan": {
+            "source": "rollup",
+            "rollup_from": bucket_start(covered[0]).isoformat(),
+            "loki_from": bucket_start(local_to).isoformat(),
+            "lines": tail.lines,
+            "pages": tail.pages,
+            "truncated": False,
+            "covered_from": None,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        },
+    }
+
+
+class RollupIngester:
+    """后台周期性地把已结束的 5 分钟桶追加进 RollupStore。
+
+    每轮对每个被跟踪的服务先向前补齐到当前桶之前，再向后回填一段历史，直到覆盖 PREDICT_ROLLUP_RETENTION_H；
+    回填从最近往更早推进，较短的回看窗口会最先可用。
+    """
+
+    def __init__(self, loki: LokiClient):
+        self._loki = loki
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        store = get_store()
+        for service in settings.predict_rollup_services:
+            await asyncio.to_thread(store.track, service)
+        while True:
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("rollup ingest tick failed", exc_info=True)
+            await asyncio.sleep(settings.predict_rollup_interval_s)
+
+    async def tick(self) -> None:
+        store = get_store()
+        current = bucket_of(datetime.now(timezone.utc))
+        oldest = current - int(settings.predict_rollup_retention_h * 3600 // BUCKET_S)
+        chunk = max(1, int(settings.predict_rollup_chunk_h * 3600 // BUCKET_S))
+        await asyncio.to_thread(store.prune, oldest)
+        services = await asyncio.to_thread(store.services, settings.predict_rollup_idle_h * 3600)
+        for service in services[: settings.predict_rollup_max_services]:
+            covered = await asyncio.to_thread(store.coverage, service)
+            if covered is None or covered[1] < oldest:
+                # 停滞超过保留期：旧区间与新区间不再相接，丢弃后从当前桶重新开始
+                if covered is not None:
+                    await asyncio.to_thread(store.reset, service)
+                covered = (current, current)
+            lo, hi = covered[1], min(current, covered[1] + chunk)
+            if lo < hi:
+                await self._ingest(service, lo, hi)
+            lo, hi = max(oldest, covered[0] - chunk), covered[0]
+            if lo < hi:
+                await self._ingest(service, lo, hi)
+
+    async def _ingest(self, service: str, lo: int, hi: int) -> None:
+        start, end = bucket_start(lo), bucket_start(hi)
+        sketch = PatternSketch(
+            start,
+            end,
+            bucket_s=BUCKET_S,
+            width=settings.predict_sketch_width,
+            depth=settings.predict_sketch_depth,
+            heavy_hitters=settings.predict_sketch_heavy_hitters,
+            recent_buckets=hi - lo,
+        )
+        # Loki 的 end 不含边界，正好对应半开区间 [lo, hi)
+        async for page, _more in self._loki.iter_query_range(
+            error_query(service), start, end, page_limit=settings.predict_page_limit
+        ):
+            sketch.add_page(page.raw)
+
+        rows: list[tuple[str, int, float]] = []
+        for i, value in enumerate(sketch.counts()):
+            if value:
+                rows.append((ERRORS, lo + i, value))
+        templates: list[tuple[str, str, str]] = []
+        for pattern in sketch.top_patterns(settings.predict_rollup_templates):
+            series = _TEMPLATE_PREFIX + pattern["fingerprint"]
+            templates.append((series, pattern["template"], pattern["example"]))
+            rows.extend((series, lo + i, value) for i, value in enumerate(pattern["counts"]) if value)
+        for name, template in settings.predict_rollup_metrics.items():
+            rows.extend(await _metric_rows(name, template.format(service=service), start, end, lo, hi))
+        await asyncio.to_thread(get_store().write, service, lo, hi, rows, templates)
+
+
+async def _metric_rows(name: str, promql: str, start: datetime, end: datetime, lo: int, hi: int) -> list[tuple[str, int, float]]:
+    res = await fetch_prometheus_range(promql, start, end - timedelta(seconds=BUCKET_S), step=f"{BUCKET_S}s")
+    if res.get("error"):
+        raise RuntimeError(f"{name}: {res.get('message') or res['error']}")
+    sums: dict[int, float] = {}
+    for item in res.get("series") or []:
+        for ts, val in item.get("values") or []:
+            try:
+                bucket, value = int(float(ts)) // BUCKET_S, float(val)
+            except (TypeError, ValueError):
+                continue
+            if lo <= bucket < hi and value == value:
+                sums[bucket] = sums.get(bucket, 0.0) + value
+    return [(_METRIC_PREFIX + name, bucket, value) for bucket, value in sums.items()]
+
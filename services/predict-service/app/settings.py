@@ -13,8 +13,71 @@ class Settings(BaseSettings):
     prometheus_base_url: str = "http://prometheus-server.observability.svc.cluster.local:80"
 
     request_timeout_s: float = 60.0
+    request_budget_s: float = 110.0
+    deadline_reserve_s: float = 8.0
+    upstream_align_s: float = 5.0
+    upstream_max_retries: int = 2
+    upstream_retry_base_s: float = 0.2
+    upstream_retry_max_s: float = 2.0
+    upstream_hedge_enabled: bool = True
+    upstream_hedge_quantile: float = 0.95
+    upstream_hedge_min_samples: int = 20
+    upstream_hedge_min_delay_s: float = 0.05
+    backend_limit_initial: int = 8
+    backend_limit_min: int = 1
+    backend_limit_max: int = 64
+    backend_limit_tolerance: float = 2.0
+    backend_limit_backoff: float = 0.75
+    backend_limit_baseline_alpha: float = 0.05
+    backend_queue_timeout_s: float = 10.0
+    backend_breaker_failures: int = 5
+    backend_breaker_cooldown_s: float = 15.0
     step_seconds: int = 300
 
+    session_backend: str = "memory"
+    session_ttl_s: float = 3600.0
+    session_max_turns: int = 50
+    session_sqlite_path: str = "/tmp/aegis-predict-sessions.db"
+    session_redis_url: str = "redis://localhost:6379/0"
+    session_key_prefix: str = "aegis:predict:session:"
+    memory_mode: str = "buffer"
+    memory_recent_turns: int = 3
+    memory_token_budget: int = 1500
+    memory_fold_batch_turns: int = 2
+    memory_summary_max_tokens: int = 400
+
+    agent_max_tool_concurrency: int = 4
+
+    predict_page_limit: int = 5000
+    predict_max_pages: int = 200
+    predict_sketch_width: int = 16384
+    predict_sketch_depth: int = 4
+    predict_sketch_heavy_hitters: int = 64
+    predict_top_patterns: int = 5
+    predict_rollup_enabled: bool = True
+    predict_rollup_path: str = "/tmp/aegis-predict-rollup.db"
+    predict_rollup_services: list[str] = []
+    predict_rollup_metrics: dict[str, str] = {}
+    predict_rollup_interval_s: float = 60.0
+    predict_rollup_chunk_h: float = 6.0
+    predict_rollup_retention_h: float = 720.0
+    predict_rollup_idle_h: float = 72.0
+    predict_rollup_max_services: int = 50
+    predict_rollup_max_lag_buckets: int = 3
+    predict_rollup_templates: int = 20
+
+    job_workers: int = 2
+    job_queue_max_depth: int = 50
+    job_max_queued_per_user: int = 10
+    job_retention_s: float = 3600.0
+    job_events_tail: int = 200
+
+    replay_mode: str = "off"
+    replay_dir: str = "/tmp/aegis-predict-replay"
+    replay_fixture: str | None = None
+    replay_speed: float = 1.0
+    replay_latency_ms: float = 0.0
+
     llm_model: str = "doubao-seed-1-6-251015"
     ark_api_key: str | None = None
     ark_base_url: str = "https://ark.cn-beijing.volces.com/api/v3"
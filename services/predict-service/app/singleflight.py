@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import math
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Hashable
+
+
+def normalize_query(query: str) -> str:
+    """折叠引号外的连续空白，引号内（含反引号）原样保留。"""
+    out: list[str] = []
+    quote: str | None = None
+    escaped = False
+    pending_space = False
+    for ch in (query or "").strip():
+        if quote is not None:
+            out.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == "\\" and quote != "`":
+                escaped = True
+            elif ch == quote:
+                quote = None
+            continue
+        if ch.isspace():
+            pending_space = True
+            continue
+        if pending_space:
+            out.append(" ")
+            pending_space = False
+        if ch in ('"', "'", "`"):
+            quote = ch
+        out.append(ch)
+    return "".join(out)
+
+
+def align_range(start: datetime, end: datetime, align_s: float) -> tuple[datetime, datetime]:
+    if align_s <= 0:
+        return start, end
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    s = math.floor(start.timestamp() / align_s) * align_s
+    e = math.ceil(end.timestamp() / align_s) * align_s
+    return datetime.fromtimestamp(s, tz=timezone.utc), datetime.fromtimestamp(e, tz=timezone.utc)
+
+
+class SingleFlight:
+    """相同 key 的并发请求只向上游发起一次，其余调用方共享同一结果（或同一异常）。
+
+    coalesced_callers 为搭便车的调用方数；saved_upstream_calls 只计其中共享到成功结果的，
+    首个调用失败时跟随方拿到的是同一异常，并没有省下一次有效的上游调用。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self._followers: dict[asyncio.Future, int] = {}
+        self.upstream_calls = 0
+        self.coalesced_callers = 0
+        self.saved_upstream_calls = 0
+
+    def _done(self, key: Hashable, fut: asyncio.Future) -> None:
+        if self._inflight.get(key) is fut:
+            self._inflight.pop(key)
+        followers = self._followers.pop(fut, 0)
+        if not fut.cancelled() and fut.exception() is None:
+            self.saved_upstream_calls += followers
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.coalesced_callers += 1
+            self._followers[fut] = self._followers.get(fut, 0) + 1
+            return await asyncio.shield(fut)
+        fut = asyncio.ensure_future(fn())
+        self._inflight[key] = fut
+        self.upstream_calls += 1
+        fut.add_done_callback(lambda f: self._done(key, f))
+        return await asyncio.shield(fut)
+
+    def stats(self) -> dict:
+        return {
+            "upstream_calls": self.upstream_calls,
+            "coalesced_callers": self.coalesced_callers,
+            "saved_upstream_calls": self.saved_upstream_calls,
+            "inflight": len(self._inflight),
+        }
+
+
+_groups: dict[str, SingleFlight] = {}
+
+
+def get_group(name: str) -> SingleFlight:
+    group = _groups.get(name)
+    if group is None:
+        group = SingleFlight(name)
+        _groups[name] = group
+    return group
+
+
+def stats() -> dict[str, dict]:
+    return {name: group.stats() for name, group in _groups.items()}
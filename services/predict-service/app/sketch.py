@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+from datetime import datetime
+
+import numpy as np
+
+from .log_normalize import fingerprint, normalize
+
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def _mix(keys: np.ndarray, buckets: np.ndarray) -> np.ndarray:
+    """把 (模板指纹, 时间桶) 混合成一个 64 位哈希（splitmix64 终结函数）。"""
+    x = keys ^ (buckets.astype(np.uint64) * _GOLDEN)
+    x = x ^ (x >> np.uint64(30))
+    x = x * _MIX1
+    x = x ^ (x >> np.uint64(27))
+    x = x * _MIX2
+    return x ^ (x >> np.uint64(31))
+
+
+class CountMinSketch:
+    """固定 depth × width 的计数表，估计值只会偏高；采用保守更新以减小偏差。"""
+
+    def __init__(self, width: int, depth: int):
+        self._width = np.uint64(max(16, width))
+        self._table = np.zeros((max(1, depth), int(self._width)), dtype=np.int64)
+
+    def _indices(self, hashes: np.ndarray) -> np.ndarray:
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(self._table.shape[0], dtype=np.uint64)[:, None]
+        return ((h1[None, :] + rows * h2[None, :]) % self._width).astype(np.intp)
+
+    def add(self, hashes: np.ndarray, counts: np.ndarray) -> None:
+        idx = self._indices(hashes)
+        rows = np.arange(self._table.shape[0])[:, None]
+        target = self._table[rows, idx].min(axis=0) + counts
+        for r in range(self._table.shape[0]):
+            np.maximum.at(self._table[r], idx[r], target)
+
+    def estimate(self, hashes: np.ndarray) -> np.ndarray:
+        idx = self._indices(hashes)
+        rows = np.arange(self._table.shape[0])[:, None]
+        return self._table[rows, idx].min(axis=0)
+
+    @property
+    def nbytes(self) -> int:
+        return self._table.nbytes
+
+
+class SpaceSaving:
+    """容量固定的高频项统计：满员时替换计数最小的项，count 为上界，count - error 为下界。"""
+
+    def __init__(self, capacity: int):
+        self._capacity = max(1, capacity)
+        self._items: dict[int, list] = {}
+
+    def add(self, key: int, count: int, example: str) -> int | None:
+        """累加计数；若为腾出位置淘汰了某个项，返回被淘汰的键。"""
+        item = self._items.get(key)
+        if item is not None:
+            item[0] += count
+            return None
+        if len(self._items) < self._capacity:
+            self._items[key] = [count, 0, example]
+            return None
+        victim = min(self._items, key=lambda k: self._items[k][0])
+        floor = self._items.pop(victim)[0]
+        self._items[key] = [floor + count, floor, example]
+        return victim
+
+    def __contains__(self, key: int) -> bool:
+        return key in self._items
+
+    def top(self, n: int) -> list[tuple[int, int, int, str]]:
+        ranked = sorted(self._items.items(), key=lambda kv: -kv[1][0])[:n]
+        return [(key, count, error, example) for key, (count, error, example) in ranked]
+
+
+class PatternSketch:
+    """按页流式聚合错误日志，内存只取决于桶数与 sketch 参数，与扫描的行数无关：
+
+    - 每个时间桶的总数精确计数；
+    - 模板的整体频次进 SpaceSaving，得到高频错误类型；
+    - 被 SpaceSaving 跟踪的模板在最近 recent_buckets 个桶上逐桶精确计数；
+    - 所有 (模板, 时间桶) 的出现次数进 Count-Min，用于补齐模板被跟踪之前已扫描过的那些桶。
+
+    predict_collect_features 按时间倒序分页，最近的桶最先到达，高频模板通常在第一页就被跟踪，
+    因此输出窗口内的计数基本是精确值。
+    """
+
+    def __init__(
+        self,
+        start: datetime,
+        end: datetime,
+        bucket_s: int = 300,
+        width: int = 16384,
+        depth: int = 4,
+        heavy_hitters: int = 64,
+        recent_buckets: int = 288,
+    ):
+        self._start_ns = int(start.timestamp() * 1_000_000_000)
+        self._end_ns = int(end.timestamp() * 1_000_000_000)
+        self._bucket_ns = bucket_s * 1_000_000_000
+        self._totals = np.zeros(max(1, -(-(self._end_ns - self._start_ns) // self._bucket_ns)), dtype=np.int64)
+        self._cms = CountMinSketch(width, depth)
+        self._heavy = SpaceSaving(heavy_hitters)
+        self._recent_from = max(0, self._totals.size - recent_buckets)
+        self._exact = np.zeros((max(1, heavy_hitters), self._totals.size - self._recent_from), dtype=np.int64)
+        self._slots: dict[int, int] = {}
+        # 模板开始被跟踪时，此前已扫描过的桶区间 [lo, hi]，这些桶的计数只能来自 Count-Min
+        self._unseen: dict[int, tuple[int, int] | None] = {}
+        self._scanned: tuple[int, int] | None = None
+        self.lines = 0
+        self.pages = 0
+        self.oldest_ns: int | None = None
+
+    def add_page(self, raw: dict) -> int:
+        stamps: list[int] = []
+        keys: list[int] = []
+        lines: list[str] = []
+        for item in (raw.get("data") or {}).get("result") or []:
+            for ts, line in item.get("values") or []:
+                try:
+                    ts_ns = int(ts)
+                except (TypeError, ValueError):
+                    continue
+                if ts_ns < self._start_ns or ts_ns > self._end_ns:
+                    continue
+                stamps.append(ts_ns)
+                keys.append(fingerprint(normalize(line)))
+                lines.append(line)
+        self.pages += 1
+        if not stamps:
+            return 0
+        ts_arr = np.asarray(stamps, dtype=np.int64)
+        buckets = np.minimum((ts_arr - self._start_ns) // self._bucket_ns, self._totals.size - 1)
+        self._totals += np.bincount(buckets, minlength=self._totals.size)
+        key_arr = np.asarray(keys, dtype=np.uint64)
+
+        pair, pair_counts = np.unique(_mix(key_arr, buckets), return_counts=True)
+        self._cms.add(pair, pair_counts)
+
+        uniq, inverse, counts = np.unique(key_arr, return_inverse=True, return_counts=True)
+        first = np.full(uniq.size, len(lines), dtype=np.int64)
+        np.minimum.at(first, inverse, np.arange(len(lines)))
+        for key, i, count in zip(uniq.tolist(), first.tolist(), counts.tolist()):
+            tracked = key in self._heavy
+            victim = self._heavy.add(key, count, lines[i][:300])
+            if victim is not None and victim in self._slots:
+                self._slots[key] = self._slots.pop(victim)
+                self._unseen.pop(victim, None)
+                self._exact[self._slots[key]] = 0
+            elif not tracked and key not in self._slots and len(self._slots) < self._exact.shape[0]:
+                self._slots[key] = len(self._slots)
+            if not tracked and key in self._slots:
+                self._unseen[key] = self._scanned
+
+        recent = buckets >= self._recent_from
+        if recent.any():
+            slot_of = np.array([self._slots.get(k, -1) for k in uniq.tolist()], dtype=np.int64)[inverse]
+            hit = recent & (slot_of >= 0)
+            np.add.at(self._exact, (slot_of[hit], buckets[hit] - self._recent_from), 1)
+
+        lo, hi = int(buckets.min()), int(buckets.max())
+        self._scanned = (lo, hi) if self._scanned is None else (min(self._scanned[0], lo), max(self._scanned[1], hi))
+        oldest = int(ts_arr.min())
+        self.oldest_ns = oldest if self.oldest_ns is None else min(self.oldest_ns, oldest)
+        self.lines += len(stamps)
+        return len(stamps)
+
+    def counts(self) -> list[float]:
+        return self._totals.astype(float).tolist()
+
+    def top_patterns(self, n: int) -> list[dict]:
+        """取频次最高的 n 个模板及其在最近 recent_buckets 个桶上的计数（未精确跟踪的桶为不超过桶总数的估计值）。"""
+        buckets = np.arange(self._recent_from, self._totals.size, dtype=np.int64)
+        totals = self._totals[self._recent_from :]
+        patterns = []
+        for key, count, error, example in self._heavy.top(n):
+            est = np.minimum(self._cms.estimate(_mix(np.full(buckets.size, key, dtype=np.uint64), buckets)), totals)
+            slot = self._slots.get(key)
+            if slot is None:
+                series = est
+            else:
+                series = self._exact[slot].copy()
+                unseen = self._unseen.get(key)
+                if unseen is not None:
+                    gap = (buckets >= unseen[0]) & (buckets <= unseen[1])
+                    series[gap] = np.maximum(series[gap], est[gap])
+            patterns.append(
+                {
+                    "fingerprint": f"{key:016x}",
+                    "template": normalize(example),
+                    "example": example,
+                    "total": count,
+                    "max_overcount": error,
+                    "counts": series.astype(float).tolist(),
+                }
+            )
+        return patterns
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._totals.nbytes + self._cms.nbytes + self._exact.nbytes
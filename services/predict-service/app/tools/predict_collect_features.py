@@ -4,65 +4,92 @@ from datetime import datetime, timedelta, timezone
 
 from langchain_core.tools import tool
 
+from .. import deadline, rollup
+from ..backpressure import BackendUnavailable
 from ..loki_client import LokiClient
 from ..settings import settings
+from ..sketch import PatternSketch
 
 
 def make_predict_collect_features(loki: LokiClient):
-    @tool("predict_collect_features", description="从 Loki 拉取错误计数时间序列与日志样本，作为预测特征。")
+    @tool("predict_collect_features", description="从 Loki 拉取错误计数时间序列、主要错误模板的分桶计数与日志样本，作为预测特征。")
     async def predict_collect_features(service_name: str, lookback_hours: int = 24) -> dict:
         now = datetime.now(timezone.utc)
         start = now - timedelta(hours=lookback_hours)
 
-        selector = settings.loki_selector_template.format(
-            label_key=settings.loki_service_label_key,
-            service=service_name,
-        )
-        error_regex = (
-            r'(?i)('
-            r'error|exception|traceback|panic|fatal|timeout|'
-            r'unauthorized|forbidden|denied|permission denied|'
-            r'authentication failed|login failed|invalid password|'
-            r'4\d\d|5\d\d|'
-            r'connection refused|connection reset'
-            r')'
-        )
+        log_query = rollup.error_query(service_name)
+        if settings.predict_rollup_enabled and settings.replay_mode == "off":
+            try:
+                local = await rollup.read_features(loki, service_name, start, now)
+            except BackendUnavailable as exc:
+                return {**exc.observation(), "service_name": service_name, "lookback_hours": lookback_hours, "logql": log_query}
+            except Exception:
+                local = None
+            if local is not None:
+                return {
+                    "service_name": service_name,
+                    "lookback_hours": lookback_hours,
+                    **local,
+                    "logql": log_query,
+                    "loki_api": {"path": "/loki/api/v1/query_range"},
+                }
 
-        log_query = f'{selector} |~ "{error_regex}"'
-        counts: list[float] = []
         evidence: list[str] = []
-        bucket_count = max(1, int(lookback_hours * 60 / 5))
-        buckets = [0.0] * bucket_count
+        sketch = PatternSketch(
+            start,
+            now,
+            bucket_s=300,
+            width=settings.predict_sketch_width,
+            depth=settings.predict_sketch_depth,
+            heavy_hitters=settings.predict_sketch_heavy_hitters,
+            recent_buckets=288,
+        )
+        truncated = False
 
+        # 逐页拉取并折叠进固定大小的 sketch，长回看窗口也不在内存中保留原始日志
         try:
-            logs_res = await loki.query_range(log_query, start=start, end=now, limit=5000, direction="BACKWARD")
-            data = logs_res.raw.get("data", {})
-            results = data.get("result", []) or []
-            for item in results:
-                values = item.get("values") or []
-                for ts, _line in values:
-                    try:
-                        ts_ns = float(ts)
-                        dt = datetime.fromtimestamp(ts_ns / 1_000_000_000, tz=timezone.utc)
-                    except Exception:
-                        continue
-                    if dt < start or dt > now:
-                        continue
-                    offset_s = (dt - start).total_seconds()
-                    idx = int(offset_s // 300)
-                    if 0 <= idx < bucket_count:
-                        buckets[idx] += 1.0
-            counts = buckets
-            evidence = logs_res.flatten_log_lines(limit=120)
+            async for page, more in loki.iter_query_range(log_query, start, now, page_limit=settings.predict_page_limit):
+                sketch.add_page(page.raw)
+                if not evidence:
+                    evidence = page.flatten_log_lines(limit=120)
+                left = deadline.remaining()
+                if more and (
+                    sketch.pages >= settings.predict_max_pages
+                    or (left is not None and left < settings.deadline_reserve_s * 2)
+                ):
+                    truncated = True
+                    break
+        except BackendUnavailable as exc:
+            return {**exc.observation(), "service_name": service_name, "lookback_hours": lookback_hours, "logql": log_query}
         except Exception:
-            counts = []
-            evidence = []
+            if not sketch.lines:
+                return {
+                    "service_name": service_name,
+                    "lookback_hours": lookback_hours,
+                    "counts": [],
+                    "patterns": [],
+                    "logs": [],
+                    "logql": log_query,
+                    "loki_api": {"path": "/loki/api/v1/query_range"},
+                }
+            truncated = True
 
+        covered_from = None
+        if truncated and sketch.oldest_ns is not None:
+            covered_from = datetime.fromtimestamp(sketch.oldest_ns / 1_000_000_000, tz=timezone.utc).isoformat()
         return {
             "service_name": service_name,
             "lookback_hours": lookback_hours,
-            "counts": counts[-288:],
+            "counts": sketch.counts()[-288:],
+            "patterns": sketch.top_patterns(settings.predict_top_patterns),
             "logs": evidence,
+            "scan": {
+                "lines": sketch.lines,
+                "pages": sketch.pages,
+                "truncated": truncated,
+                "covered_from": covered_from,
+                "sketch_bytes": sketch.memory_bytes,
+            },
             "logql": log_query,
             "loki_api": {"path": "/loki/api/v1/query_range"},
         }
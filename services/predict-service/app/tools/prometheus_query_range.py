@@ -6,7 +6,10 @@ import re
 import httpx
 from langchain_core.tools import tool
 
+from .. import metrics, replay, resilience
+from ..backpressure import BackendUnavailable, get_guard
 from ..settings import settings
+from ..singleflight import align_range, get_group, normalize_query
 
 
 def _parse_dt(iso: str) -> datetime:
@@ -16,6 +19,74 @@ def _parse_dt(iso: str) -> datetime:
     return dt.astimezone(timezone.utc)
 
 
+_flight = get_group("prometheus")
+
+
+async def _fetch(params: dict) -> dict:
+    return await resilience.call(
+        "prometheus.query_range",
+        lambda timeout_s: _attempt(params, timeout_s),
+        settings.request_timeout_s,
+    )
+
+
+async def _attempt(params: dict, timeout_s: float) -> dict:
+    async with get_guard("prometheus").slot():
+        with metrics.upstream_call("prometheus", "query_range") as call:
+            async with httpx.AsyncClient(timeout=timeout_s) as client:
+                r = await client.get(f"{settings.prometheus_base_url.rstrip('/')}/api/v1/query_range", params=params)
+            call["bytes"] = len(r.content)
+            r.raise_for_status()
+            return r.json()
+
+
+def _reshape_series(data: dict) -> list[dict]:
+    series = []
+    for item in data.get("data", {}).get("result", []) or []:
+        metric = item.get("metric", {}) or {}
+        values = []
+        for ts, val in item.get("values") or []:
+            values.append([ts, val])
+        series.append({"metric": metric, "values": values})
+    return series
+
+
+async def fetch_prometheus_range(promql: str, start: datetime, end: datetime, step: str = "60s") -> dict:
+    q_start, q_end = align_range(start, end, settings.upstream_align_s)
+    params = {
+        "query": promql,
+        "start": q_start.isoformat(),
+        "end": q_end.isoformat(),
+        "step": step,
+    }
+    try:
+        data = await replay.upstream(
+            "prometheus",
+            "/api/v1/query_range",
+            params,
+            lambda: _flight.do((normalize_query(promql), params["start"], params["end"], step), lambda: _fetch(params)),
+        )
+    except BackendUnavailable as exc:
+        return {**exc.observation(), "promql": promql, "start": start.isoformat(), "end": end.isoformat(), "step": step}
+    except Exception as exc:
+        return {
+            "error": "prometheus_request_failed",
+            "message": str(exc),
+            "promql": promql,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "step": step,
+        }
+    return {
+        "promql": promql,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "step": step,
+        "result_type": data.get("data", {}).get("resultType"),
+        "series": _reshape_series(data),
+    }
+
+
 @tool(
     "prometheus_query_range",
     description="按时间范围执行 PromQL 查询，返回时间序列数据及元信息，适用于 Todo_List 项目的风险评估场景。",
@@ -54,38 +125,4 @@ async def prometheus_query_range(
                 "start_raw": start_iso,
                 "end_raw": end_iso,
             }
-    params = {
-        "query": promql,
-        "start": start.isoformat(),
-        "end": end.isoformat(),
-        "step": step,
-    }
-    try:
-        async with httpx.AsyncClient(timeout=settings.request_timeout_s) as client:
-            r = await client.get(f"{settings.prometheus_base_url.rstrip('/')}/api/v1/query_range", params=params)
-        r.raise_for_status()
-        data = r.json()
-    except Exception as exc:
-        return {
-            "error": "prometheus_request_failed",
-            "message": str(exc),
-            "promql": promql,
-            "start": start.isoformat(),
-            "end": end.isoformat(),
-            "step": step,
-        }
-    series = []
-    for item in data.get("data", {}).get("result", []) or []:
-        metric = item.get("metric", {}) or {}
-        values = []
-        for ts, val in item.get("values") or []:
-            values.append([ts, val])
-        series.append({"metric": metric, "values": values})
-    return {
-        "promql": promql,
-        "start": start.isoformat(),
-        "end": end.isoformat(),
-        "step": step,
-        "result_type": data.get("data", {}).get("resultType"),
-        "series": series,
-    }
+    return await fetch_prometheus_range(promql, start, end, step)
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import asyncio
+
+from app.jobs import JobEvents, compact_events
+from app.settings import settings
+
+
+def token(text: str, step: str = "s1") -> dict:
+    return {"event": "llm_token", "token": text, "step_id": step}
+
+
+def test_compact_merges_adjacent_tokens_per_step():
+    items = [
+        {"event": "llm_start", "step_id": "s1"},
+        token("根"),
+        token("因"),
+        token("是", "s2"),
+        {"event": "llm_end", "step_id": "s2"},
+        token("a"),
+        {"event": "end"},
+    ]
+    assert compact_events(items, 100) == [
+        {"event": "llm_start", "step_id": "s1"},
+        token("根因"),
+        token("是", "s2"),
+        {"event": "llm_end", "step_id": "s2"},
+        token("a"),
+        {"event": "end"},
+    ]
+
+
+def test_compact_keeps_bounded_tail():
+    items = [{"event": "tool_end", "n": i} for i in range(10)] + [{"event": "end"}]
+    out = compact_events(items, 4)
+    assert out[0]["event"] == "events_truncated"
+    assert out[0]["dropped"] == 7
+    assert out[1:] == items[-4:]
+
+
+async def _collect(events: JobEvents) -> list[dict]:
+    return [item async for item in events.follow()]
+
+
+def test_events_compact_after_end_without_breaking_live_follower(monkeypatch):
+    monkeypatch.setattr(settings, "job_events_tail", 3)
+
+    async def scenario():
+        events = JobEvents()
+        follower = asyncio.create_task(_collect(events))
+        await asyncio.sleep(0)
+        for i in range(50):
+            await events.put(token(str(i)))
+        await events.put({"event": "tool_end"})
+        await events.put({"event": "end"})
+        live = await follower
+        return events, live
+
+    events, live = asyncio.run(scenario())
+    # 运行中订阅的一方拿到全部事件
+    assert len(live) == 52
+    # 结束后只保留合并后的有界尾部
+    assert events.items == [token("".join(str(i) for i in range(50))), {"event": "tool_end"}, {"event": "end"}]
+    replay = asyncio.run(_collect(events))
+    assert replay == events.items
@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+from app.log_normalize import fingerprint, normalize
+
+
+def key(text: str) -> int:
+    return fingerprint(normalize(text))
+
+
+def test_status_codes_keep_distinct_fingerprints():
+    assert key("GET /api/todo status=500 took 12ms") != key("GET /api/todo status=404 took 12ms")
+    assert key('{"status_code": 503, "path": "/x"}') != key('{"status_code": 200, "path": "/x"}')
+    assert key('10.0.0.1 - - "GET /x HTTP/1.1" 502 1234') != key('10.0.0.2 - - "GET /x HTTP/1.1" 404 1234')
+    assert key("HTTP/2 503 Service Unavailable") != key("HTTP/2 200 OK")
+
+
+def test_same_status_still_clusters():
+    assert key("GET /api/todo status=500 took 12ms") == key("GET /api/todo status=500 took 907ms")
+    assert key('10.0.0.1 - - "GET /a HTTP/1.1" 502 1234') == key('10.0.0.9 - - "GET /b HTTP/1.1" 502 77')
+
+
+def test_other_numbers_are_masked():
+    assert normalize("status=500 retry 3 after 1.5s") == "status=500 retry <num> after <num>s"
+    assert normalize("user 500 items code: 12345") == "user <num> items code: <num>"
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from app import rollup
+from app.loki_client import LokiQueryResult
+from app.rollup import ERRORS, RollupIngester, RollupStore, bucket_of, bucket_start
+from app.settings import settings
+
+
+NOW = datetime(2026, 6, 1, 4, 2, 30, tzinfo=timezone.utc)
+CURRENT = bucket_of(NOW)
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return NOW
+
+
+class FakeLoki:
+    def __init__(self, pages: list[dict] | None = None):
+        self.pages = pages or []
+        self.calls: list[tuple[datetime, datetime]] = []
+
+    async def iter_query_range(self, query, start, end, page_limit):
+        self.calls.append((start, end))
+        for raw in self.pages:
+            yield LokiQueryResult(raw), False
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = RollupStore(str(tmp_path / "rollup.db"))
+    monkeypatch.setattr(rollup, "_store", store)
+    monkeypatch.setattr(rollup, "datetime", FixedDatetime)
+    monkeypatch.setattr(settings, "predict_rollup_metrics", {})
+    return store
+
+
+def fill(store: RollupStore, service: str, lo: int, hi: int, value: float = 1.0) -> None:
+    store.write(service, lo, hi, [(ERRORS, b, value) for b in range(lo, hi)], [])
+
+
+def test_adjacent_writes_extend_coverage(store):
+    store.track("api")
+    assert store.coverage("api") is None
+    fill(store, "api", 100, 110)
+    fill(store, "api", 110, 120)
+    fill(store, "api", 90, 100)
+    assert store.coverage("api") == (90, 120)
+    assert store.series("api", ERRORS, 88, 92).tolist() == [0.0, 0.0, 1.0, 1.0]
+
+
+def test_write_refuses_a_gap(store):
+    store.track("api")
+    fill(store, "api", 100, 110)
+    with pytest.raises(ValueError):
+        fill(store, "api", 200, 210)
+    with pytest.raises(ValueError):
+        fill(store, "api", 80, 90)
+    assert store.coverage("api") == (100, 110)
+
+
+def test_prune_trims_or_clears_coverage(store):
+    store.track("api")
+    store.track("web")
+    fill(store, "api", 100, 110)
+    fill(store, "web", 100, 120)
+    store.prune(110)
+    assert store.coverage("api") is None
+    assert store.coverage("web") == (110, 120)
+    assert store.series("web", ERRORS, 100, 120).tolist() == [0.0] * 10 + [1.0] * 10
+
+
+def test_tick_restarts_after_stall_longer_than_retention(store, monkeypatch):
+    monkeypatch.setattr(settings, "predict_rollup_retention_h", 1.0)  # 12 个桶
+    monkeypatch.setattr(settings, "predict_rollup_chunk_h", 0.5)  # 6 个桶
+    oldest = CURRENT - 12
+    store.track("api")
+    fill(store, "api", CURRENT - 100, CURRENT - 90, value=5.0)
+
+    ingested: list[tuple[int, int]] = []
+
+    async def fake_ingest(self, service, lo, hi):
+        ingested.append((lo, hi))
+        await asyncio.to_thread(fill, store, service, lo, hi)
+
+    monkeypatch.setattr(RollupIngester, "_ingest", fake_ingest)
+    ingester = RollupIngester(FakeLoki())
+    asyncio.run(ingester.tick())
+
+    assert ingested == [(CURRENT - 6, CURRENT)]
+    # 只有真正入库的部分算作已覆盖，而不是 [oldest, current)
+    assert store.coverage("api") == (CURRENT - 6, CURRENT)
+    assert store.series("api", ERRORS, CURRENT - 100, CURRENT - 90).tolist() == [0.0] * 10
+    # 回看窗口超出已覆盖区间时 read_features 回退到完整扫描
+    loki = FakeLoki()
+    assert asyncio.run(rollup.read_features(loki, "api", bucket_start(oldest), NOW)) is None
+    assert loki.calls == []
+
+    asyncio.run(ingester.tick())
+    assert store.coverage("api") == (oldest, CURRENT)
+
+
+def test_tick_restarts_even_if_prune_left_stale_coverage(store, monkeypatch):
+    monkeypatch.setattr(settings, "predict_rollup_retention_h", 1.0)
+    monkeypatch.setattr(settings, "predict_rollup_chunk_h", 0.5)
+    store.track("api")
+    fill(store, "api", CURRENT - 100, CURRENT - 90)
+    monkeypatch.setattr(RollupStore, "prune", lambda self, before: None)
+
+    async def fake_ingest(self, service, lo, hi):
+        await asyncio.to_thread(fill, store, service, lo, hi)
+
+    monkeypatch.setattr(RollupIngester, "_ingest", fake_ingest)
+    asyncio.run(RollupIngester(FakeLoki()).tick())
+    assert store.coverage("api") == (CURRENT - 6, CURRENT)
+
+
+def test_read_features_falls_back_without_coverage_or_when_lagging(store, monkeypatch):
+    monkeypatch.setattr(settings, "predict_rollup_max_lag_buckets", 3)
+    loki = FakeLoki()
+    start = bucket_start(CURRENT - 10)
+    assert asyncio.run(rollup.read_features(loki, "api", start, NOW)) is None
+    fill(store, "api", CURRENT - 20, CURRENT - 4)
+    assert asyncio.run(rollup.read_features(loki, "api", start, NOW)) is None
+    assert loki.calls == []
+
+
+def test_read_features_combines_local_buckets_with_loki_tail(store):
+    store.track("api")
+    fill(store, "api", CURRENT - 20, CURRENT - 1, value=2.0)
+    ts = int(NOW.timestamp()) * 1_000_000_000
+    page = {"data": {"resultType": "streams", "result": [{"stream": {"app": "api"}, "values": [[str(ts), "ERROR boom"]]}]}}
+    loki = FakeLoki([page])
+    out = asyncio.run(rollup.read_features(loki, "api", bucket_start(CURRENT - 10), NOW))
+    assert out is not None
+    assert out["scan"]["source"] == "rollup"
+    assert loki.calls == [(bucket_start(CURRENT - 1), NOW)]
+    assert out["counts"] == [2.0] * 9 + [0.0, 1.0]
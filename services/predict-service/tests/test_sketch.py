@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+
+from app.sketch import PatternSketch
+
+
+START = datetime(2026, 6, 1, 4, 0, tzinfo=timezone.utc)
+END = START + timedelta(minutes=30)
+
+
+def page(entries: list[tuple[int, str]]) -> dict:
+    values = [[str(int((START + timedelta(seconds=s)).timestamp() * 1_000_000_000)), line] for s, line in entries]
+    return {"data": {"resultType": "streams", "result": [{"stream": {"app": "api"}, "values": values}]}}
+
+
+def test_counts_per_bucket_and_ignores_out_of_window_lines():
+    sketch = PatternSketch(START, END, bucket_s=300)
+    added = sketch.add_page(page([(10, "ERROR a"), (20, "ERROR b"), (610, "ERROR c"), (-5, "ERROR early"), (3600, "late")]))
+    assert added == 3
+    assert sketch.counts() == [2.0, 0.0, 1.0, 0.0, 0.0, 0.0]
+    assert sketch.lines == 3 and sketch.pages == 1
+
+
+def test_top_patterns_group_by_template_with_exact_recent_counts():
+    sketch = PatternSketch(START, END, bucket_s=300, heavy_hitters=4, recent_buckets=6)
+    # Loki 按时间倒序分页：先到最近的桶
+    sketch.add_page(page([(1500 + i, f"ERROR timeout after {i}ms") for i in range(5)] + [(1510, "WARN disk 91% full")]))
+    sketch.add_page(page([(30 + i, f"ERROR timeout after {i * 7}ms") for i in range(3)]))
+    top = sketch.top_patterns(2)
+    assert top[0]["template"] == "ERROR timeout after <num>ms"
+    assert top[0]["total"] == 8
+    assert top[0]["counts"] == [3.0, 0.0, 0.0, 0.0, 0.0, 5.0]
+    assert top[1]["total"] == 1
+
+
+def test_count_min_estimates_never_exceed_bucket_totals():
+    sketch = PatternSketch(START, END, bucket_s=300, width=16, depth=2, heavy_hitters=1, recent_buckets=6)
+    sketch.add_page(page([(s, f"ERROR kind{s % 9} failed") for s in range(0, 1800, 7)]))
+    totals = sketch.counts()
+    for pattern in sketch.top_patterns(1):
+        assert all(c <= t for c, t in zip(pattern["counts"], totals))
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
-from langchain.agents import AgentExecutor
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.memory import ConversationBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
+
+from ..settings import settings
+from .concurrent import ConcurrentAgentExecutor
 
 
 try:
@@ -12,7 +14,7 @@ except Exception:
     from langchain.agents import create_openai_functions_agent as create_tool_calling_agent
 
 
-def build_executor(llm: BaseChatModel, tools, memory: ConversationBufferMemory | None) -> AgentExecutor:
+def build_executor(llm: BaseChatModel, tools, memory: BaseChatMemory | None) -> ConcurrentAgentExecutor:
     prompt = ChatPromptTemplate.from_messages(
         [
             (
@@ -26,7 +28,7 @@ def build_executor(llm: BaseChatModel, tools, memory: ConversationBufferMemory |
                 " - HTTP：http_requests_total、http_request_duration_seconds_bucket，用于计算请求量、错误率、P95/P99 延迟。"
                 "   注意：在 Todo_List 当前环境中，这两类指标用 service 标签区分 user-service/todo-service/ai-service。"
                 "   你在选择器中必须通过 service=\"user-service\" 这类条件进行过滤，可以按 service、method、path、status 等维度聚合；"
-                "   严禁在 http_requests_total 或 http_request_duration_seconds_bucket 的选择器中使用 app 或 namespace 标签，例如 {app=\"user-service\"} 或 {app=\"user-service\", namespace=\"todo-list\"}，"
+                "   严禁在 http_requests_total 或 http_request_duration_seconds_bucket 的选择器中使用 app 或 namespace 标签，例如 {{app=\"user-service\"}} 或 {{app=\"user-service\", namespace=\"todo-list\"}}，"
                 "   因为这些标签在实际指标上并不存在，会导致查询结果始终为空。"
                 " - 业务：user_registration_*、user_login_*、todo_*、ai_chat_*，用于观察功能级成功率和流量；"
                 " - 可用性与资源：up、process_resident_memory_bytes、process_cpu_seconds_total；"
@@ -49,17 +51,20 @@ def build_executor(llm: BaseChatModel, tools, memory: ConversationBufferMemory |
                 "evidence 为若干关键证据点（每个元素是一行简要文本，需引用关键日志片段和必要指标结论），suggested_actions 为一系列具体可执行的动作。"
                 "每次调用任何工具前，先调用trace_note记录本轮要做什么与原因（不超过80字）。",
             ),
-            MessagesPlaceholder(variable_name="chat_history"),
+            MessagesPlaceholder(variable_name="chat_history", optional=True),
             ("human", "{input}"),
             MessagesPlaceholder(variable_name="agent_scratchpad"),
         ]
     )
     agent = create_tool_calling_agent(llm, tools, prompt)
-    return AgentExecutor(
+    return ConcurrentAgentExecutor(
         agent=agent,
         tools=tools,
         memory=memory,
         verbose=True,
         handle_parsing_errors=True,
         return_intermediate_steps=True,
+        max_tool_concurrency=settings.agent_max_tool_concurrency,
+        deadline_reserve_s=settings.deadline_reserve_s,
+        partial_llm=llm,
     )
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import asyncio
+import re
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .log_normalize import fingerprint, normalize
+from .logql import quote
+from .loki_client import LokiClient
+from .settings import settings
+from .tools.rca_collect_evidence import ERROR_REGEX
+
+
+CATEGORIES = [
+    ("fatal", re.compile(r"(?i)\b(fatal|panic|oom|out of memory|segfault)\b")),
+    ("exception", re.compile(r"(?i)(exception|traceback|caused by)")),
+    ("timeout", re.compile(r"(?i)(timeout|timed out|deadline exceeded)")),
+    ("connection", re.compile(r"(?i)(connection refused|connection reset|unavailable)")),
+    ("auth", re.compile(r"(?i)(unauthorized|forbidden|denied|authentication failed|login failed|invalid password)")),
+    ("http_5xx", re.compile(r"\b5\d\d\b")),
+    ("http_4xx", re.compile(r"\b4\d\d\b")),
+]
+_OTHER = "other"
+
+
+def category_of(text: str) -> str:
+    for name, pattern in CATEGORIES:
+        if pattern.search(text):
+            return name
+    return _OTHER
+
+
+def _label(offset_h: float) -> str:
+    return f"-{offset_h:g}h" if offset_h % 24 else f"-{offset_h / 24:g}d"
+
+
+async def differential_analysis(loki: LokiClient, start: datetime, end: datetime) -> dict:
+    """对比故障窗口与若干等长历史窗口（默认 1 天前、7 天前同时段）中各服务错误日志模板的出现次数，
+    只返回新出现或显著增多的模式；其余模板的指纹记入 background，供后续阶段从证据中剔除。
+
+    各窗口的查询并发执行并经过进程级结果缓存，历史窗口可跨请求复用。
+    """
+    offsets = [h for h in settings.rca_diff_baseline_offsets_h if h > 0]
+    windows = [("incident", start, end)] + [
+        (_label(h), start - timedelta(hours=h), end - timedelta(hours=h)) for h in offsets
+    ]
+    failed_queries: list[dict] = []
+    try:
+        services = (await loki.label_values(settings.loki_service_label_key))[: settings.rca_diff_max_services]
+    except Exception as exc:
+        return {"error": f"{type(exc).__name__}: {exc}"[:300], "new": [], "increased": [], "categories": [], "background": set()}
+
+    async def fetch(service: str, w_start: datetime, w_end: datetime) -> dict | None:
+        selector = settings.loki_selector_template.format(label_key=settings.loki_service_label_key, service=service)
+        query = f"{selector} |~ {quote(ERROR_REGEX)}"
+        try:
+            res = await loki.query_range(query, start=w_start, end=w_end, limit=settings.rca_diff_line_limit)
+        except Exception as exc:
+            failed_queries.append(
+                {
+                    "service": service,
+                    "query": query,
+                    "window": [w_start.isoformat(), w_end.isoformat()],
+                    "error": f"{type(exc).__name__}: {exc}"[:300],
+                }
+            )
+            return None
+        return res.raw
+
+    jobs = [
+        (service, col, fetch(service, w_start, w_end))
+        for service in services
+        for col, (_, w_start, w_end) in enumerate(windows)
+    ]
+    raws = await asyncio.gather(*(job for _, _, job in jobs))
+
+    index: dict[tuple[str, int], int] = {}
+    examples: list[str] = []
+    rows_per_window: list[list[int]] = [[] for _ in windows]
+    valid = np.zeros((len(services), len(windows)), dtype=bool)
+    service_idx = {s: i for i, s in enumerate(services)}
+    for (service, col, _), raw in zip(jobs, raws):
+        if raw is None:
+            continue
+        valid[service_idx[service], col] = True
+        rows = rows_per_window[col]
+        for item in (raw.get("data") or {}).get("result") or []:
+            for _ts, line in item.get("values") or []:
+                key = (service, fingerprint(normalize(line)))
+                row = index.get(key)
+                if row is None:
+                    row = len(examples)
+                    index[key] = row
+                    examples.append(line)
+                rows.append(row)
+
+    window_info = [{"label": label, "start": s.isoformat(), "end": e.isoformat()} for label, s, e in windows]
+    unjudged = [s for s in services if not valid[service_idx[s], 0] or not valid[service_idx[s], 1:].any()]
+    if not examples:
+        return {
+            "windows": window_info,
+            "new": [],
+            "increased": [],
+            "categories": [],
+            "templates": 0,
+            "unjudged_services": unjudged,
+            "failed_queries": failed_queries,
+            "background": set(),
+        }
+
+    keys = list(index)
+    counts = np.stack(
+        [np.bincount(np.asarray(rows, dtype=np.int64), minlength=len(keys)) for rows in rows_per_window], axis=1
+    ).astype(float)
+    row_service = np.array([service_idx[s] for s, _ in keys], dtype=np.int64)
+    base_valid = valid[row_service, 1:]
+    n_base = base_valid.sum(axis=1)
+    judged = valid[row_service, 0] & (n_base > 0)
+
+    incident = counts[:, 0]
+    base = np.where(base_valid, counts[:, 1:], 0.0)
+    base_mean = base.sum(axis=1) / np.maximum(n_base, 1)
+    base_max = base.max(axis=1, initial=0.0)
+    ratio = (incident + 1.0) / (base_mean + 1.0)
+    z = (incident - base_mean) / np.sqrt(base_mean + 1.0)
+
+    enough = judged & (incident >= settings.rca_diff_min_count)
+    is_new = enough & (base_max == 0)
+    is_up = enough & ~is_new & (ratio >= settings.rca_diff_min_ratio) & (z >= settings.rca_diff_min_z)
+
+    def pick(mask: np.ndarray) -> list[dict]:
+        rows = np.flatnonzero(mask)
+        rows = rows[np.argsort(-z[rows], kind="stable")][: settings.rca_diff_max_patterns]
+        return [
+            {
+                "service": keys[r][0],
+                "template": normalize(examples[r]),
+                "example": examples[r][: settings.rca_pipeline_max_line_chars],
+                "incident": int(incident[r]),
+                "baseline_mean": round(float(base_mean[r]), 2),
+                "ratio": round(float(ratio[r]), 2),
+            }
+            for r in rows
+        ]
+
+    cat_names = [name for name, _ in CATEGORIES] + [_OTHER]
+    cat_idx = np.array([cat_names.index(category_of(line)) for line in examples], dtype=np.int64)
+    cat_incident = np.bincount(cat_idx[judged], weights=incident[judged], minlength=len(cat_names))
+    cat_base = np.bincount(cat_idx[judged], weights=base_mean[judged], minlength=len(cat_names))
+    categories = [
+        {
+            "category": name,
+            "incident": int(cat_incident[i]),
+            "baseline_mean": round(float(cat_base[i]), 2),
+            "ratio": round(float((cat_incident[i] + 1.0) / (cat_base[i] + 1.0)), 2),
+        }
+        for i, name in enumerate(cat_names)
+        if cat_incident[i] or cat_base[i]
+    ]
+    significant = {keys[r][1] for r in np.flatnonzero(is_new | is_up)}
+    background = {keys[r][1] for r in np.flatnonzero(judged & ~is_new & ~is_up)} - significant
+    return {
+        "windows": window_info,
+        "new": pick(is_new),
+        "increased": pick(is_up),
+        "categories": sorted(categories, key=lambda c: -c["ratio"]),
+        "templates": len(keys),
+        "unjudged_services": unjudged,
+        "failed_queries": failed_queries,
+        "background": background,
+    }
+
+
+def describe(diff: dict | None) -> str:
+    if not diff:
+        return "（未完成日志差异分析）"
+    if diff.get("error"):
+        return f"（日志差异分析失败：{diff['error']}）"
+    baselines = "、".join(w["label"] for w in diff.get("windows", [])[1:]) or "无"
+    lines = [f"对比窗口：{baselines}（同时段、等长）"]
+    for item in diff.get("new") or []:
+        lines.append(f"[新出现] {item['service']} ×{item['incident']}：{item['example']}")
+    for item in diff.get("increased") or []:
+        lines.append(
+            f"[增多 x{item['ratio']}] {item['service']} ×{item['incident']}（基线均值 {item['baseline_mean']}）：{item['example']}"
+        )
+    if len(lines) == 1:
+        lines.append("未发现新出现或显著增多的错误日志模式。")
+    cats = [f"{c['category']} {c['incident']}/{c['baseline_mean']}" for c in diff.get("categories") or [] if c["ratio"] >= 1.5]
+    if cats:
+        lines.append("增多的错误类别（故障窗口/基线均值）：" + "，".join(cats))
+    if diff.get("unjudged_services"):
+        lines.append("缺少基线、未参与比较的服务：" + "，".join(diff["unjudged_services"]))
+    return "\n".join(lines)
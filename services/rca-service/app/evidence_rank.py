@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import heapq
+import math
+import re
+from dataclasses import dataclass
+
+from .log_normalize import annotate, fingerprint, message_of, normalize, ts_of
+
+
+_SEVERITY = [
+    (re.compile(r"(?i)\b(fatal|panic|oom|out of memory|segfault|deadlock)\b"), 3.0),
+    (re.compile(r"(?i)(exception|traceback|\berror\b|\bcaused by\b)"), 2.0),
+    (re.compile(r"(?i)(timeout|timed out|refused|reset|denied|unauthorized|forbidden|unavailable|\b5\d\d\b)"), 1.5),
+]
+
+
+def severity_of(text: str) -> float:
+    for pattern, weight in _SEVERITY:
+        if pattern.search(text):
+            return weight
+    return 1.0
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+@dataclass
+class _Template:
+    count: int
+    service: str
+    line: str
+    severity: float
+    first_ns: int | None
+    last_ns: int | None
+
+
+class EvidenceRanker:
+    """单遍流式地为候选日志打分；模板以归一化文本的 64 位指纹为键，模板数上限 max_templates。
+    用于精确去重的行哈希每条候选一个整数；每个服务进入打分的候选行上限 max_per_service，超出的行不打分，
+    只计入 dropped。按服务分别设上限，保留哪些行不取决于各服务查询返回的先后顺序。
+    内存以 max_templates 与 max_per_service × 服务数为界。
+
+    score = 严重度 × 窗口内稀有度 log(1 + N / count) × 相对基线窗口的 IDF。
+    每个模板只保留首次出现的一行作为代表（Loki 按时间倒序返回，即最新的一条），select 时按分数贪心挑选，
+    同一服务每多选一条，其后续候选的分数乘以 diversity_decay，并受 token 预算约束。
+    """
+
+    def __init__(self, max_templates: int = 2000, diversity_decay: float = 0.7, max_per_service: int = 10000):
+        self._max_templates = max(8, max_templates)
+        self._decay = diversity_decay
+        self._max_per_service = max(1, max_per_service)
+        self._per_service: dict[str, int] = {}
+        self._templates: dict[int, _Template] = {}
+        self._baseline: dict[int, int] = {}
+        self._seen: set[int] = set()
+        self.candidates = 0
+        self.baseline_lines = 0
+        self.pruned = 0
+        self.dropped = 0
+
+    def add(self, service: str, line: str) -> None:
+        digest = hash(line)
+        if digest in self._seen:
+            return
+        taken = self._per_service.get(service, 0)
+        if taken >= self._max_per_service:
+            self.dropped += 1
+            return
+        self._per_service[service] = taken + 1
+        self._seen.add(digest)
+        self.candidates += 1
+        text = message_of(line)
+        key = fingerprint(normalize(text))
+        ts = ts_of(line)
+        entry = self._templates.get(key)
+        if entry is not None:
+            entry.count += 1
+            if ts is not None:
+                entry.first_ns = ts if entry.first_ns is None else min(entry.first_ns, ts)
+                entry.last_ns = ts if entry.last_ns is None else max(entry.last_ns, ts)
+            return
+        if len(self._templates) >= self._max_templates:
+            self._prune()
+        self._templates[key] = _Template(1, service, line, severity_of(text), ts, ts)
+
+    def add_baseline(self, line: str) -> None:
+        self.baseline_lines += 1
+        key = fingerprint(normalize(message_of(line)))
+        if key in self._baseline:
+            self._baseline[key] += 1
+            return
+        if len(self._baseline) >= self._max_templates:
+            # 基线只需要常见模板的计数，淘汰计数最少的一半
+            keep = heapq.nlargest(self._max_templates // 2, self._baseline.items(), key=lambda kv: kv[1])
+            self._baseline = dict(keep)
+        self._baseline[key] = 1
+
+    def _score(self, key: int, entry: _Template) -> float:
+        rarity = math.log1p(self.candidates / entry.count)
+        idf = 1.0
+        if self.baseline_lines:
+            idf = math.log((self.baseline_lines + 1) / (self._baseline.get(key, 0) + 1)) + 1.0
+        return entry.severity * rarity * idf
+
+    def _prune(self) -> None:
+        # 同时保留高频模板（保证其计数不因淘汰而被低估成"稀有"）与当前得分最高的模板
+        items = list(self._templates.items())
+        frequent = heapq.nlargest(self._max_templates // 4, items, key=lambda kv: kv[1].count)
+        valuable = heapq.nlargest(self._max_templates // 2, items, key=lambda kv: self._score(*kv))
+        kept = dict(frequent)
+        kept.update(valuable)
+        self.pruned += len(self._templates) - len(kept)
+        self._templates = kept
+
+    @property
+    def templates(self) -> int:
+        return len(self._templates)
+
+    def select(self, max_lines: int, token_budget: int) -> tuple[list[str], int]:
+        """返回按分数排序、跨服务去集中的证据行及其估算 token 数。"""
+        heap = [(-self._score(k, e), 0, k) for k, e in self._templates.items()]
+        heapq.heapify(heap)
+        per_service: dict[str, int] = {}
+        selected: list[str] = []
+        tokens = 0
+        while heap and len(selected) < max_lines and tokens < token_budget:
+            neg_score, seen_taken, key = heapq.heappop(heap)
+            entry = self._templates[key]
+            taken = per_service.get(entry.service, 0)
+            if taken != seen_taken:
+                heapq.heappush(heap, (neg_score * self._decay ** (taken - seen_taken), taken, key))
+                continue
+            line = annotate(entry.line, entry.count, entry.first_ns, entry.last_ns)
+            cost = estimate_tokens(line)
+            if tokens + cost > token_budget:
+                continue
+            selected.append(line)
+            tokens += cost
+            per_service[entry.service] = taken + 1
+        return selected, tokens
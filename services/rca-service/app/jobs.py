@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Callable
+
+from .settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+JobRunner = Callable[["JobEvents"], Awaitable[dict]]
+
+
+class JobQueueFull(Exception):
+    def __init__(self, message: str, retry_after_s: float):
+        super().__init__(message)
+        self.retry_after_s = retry_after_s
+
+
+def compact_events(items: list[dict], tail: int) -> list[dict]:
+    """合并同一步骤中相邻的 llm_token 事件，并只保留最后 tail 条；有丢弃时在开头放一条 events_truncated。"""
+    merged: list[dict] = []
+    for item in items:
+        last = merged[-1] if merged else None
+        if (
+            last is not None
+            and item.get("event") == "llm_token"
+            and last.get("event") == "llm_token"
+            and last.get("step_id") == item.get("step_id")
+        ):
+            merged[-1] = {**last, "token": f"{last.get('token', '')}{item.get('token', '')}"}
+        else:
+            merged.append(item)
+    if len(merged) <= tail:
+        return merged
+    dropped = len(merged) - tail
+    return [{"event": "events_truncated", "event_type": "events_truncated", "dropped": dropped}, *merged[dropped:]]
+
+
+class JobEvents:
+    """任务事件日志：实现 put() 以便直接作为 StreamHandler 的队列，同时支持多个订阅方从头回放。
+
+    任务结束后（且没有订阅方正在读取时）按 compact_events 压缩，保留期内只占用有界内存；
+    运行期间保留全部事件，订阅方可以完整回放。
+    """
+
+    def __init__(self) -> None:
+        self.items: list[dict] = []
+        self._cond = asyncio.Condition()
+        self._followers = 0
+        self._compacted = False
+
+    async def put(self, item: dict) -> None:
+        async with self._cond:
+            self.items.append(item)
+            self._compact_if_idle()
+            self._cond.notify_all()
+
+    def _compact_if_idle(self) -> None:
+        if self._compacted or self._followers or not self.closed:
+            return
+        self.items = compact_events(self.items, settings.job_events_tail)
+        self._compacted = True
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.items) and self.items[-1].get("event") == "end"
+
+    async def follow(self) -> AsyncIterator[dict]:
+        index = 0
+        self._followers += 1
+        try:
+            while True:
+                async with self._cond:
+                    await self._cond.wait_for(lambda: len(self.items) > index)
+                    batch = self.items[index:]
+                index += len(batch)
+                for item in batch:
+                    yield item
+                    if item.get("event") == "end":
+                        return
+        finally:
+            self._followers -= 1
+            self._compact_if_idle()
+
+
+class Job:
+    def __init__(self, job_id: str, user: str, priority: int, seq: int, runner: JobRunner):
+        self.id = job_id
+        self.user = user
+        self.priority = priority
+        self.seq = seq
+        self.runner = runner
+        self.status = "queued"
+        self.created_at = datetime.now(timezone.utc)
+        self.started_at: datetime | None = None
+        self.finished_at: datetime | None = None
+        self.result: dict | None = None
+        self.error: str | None = None
+        self.events = JobEvents()
+        self.task: asyncio.Task | None = None
+        self.cancel_requested = False
+        self._created = time.monotonic()
+        self._started: float | None = None
+        self._finished: float | None = None
+
+    @property
+    def wait_ms(self) -> float:
+        end = self._started if self._started is not None else (self._finished or time.monotonic())
+        return round((end - self._created) * 1000.0, 1)
+
+    @property
+    def run_ms(self) -> float | None:
+        if self._started is None:
+            return None
+        return round(((self._finished or time.monotonic()) - self._started) * 1000.0, 1)
+
+    def view(self, position: int | None = None, include_result: bool = False) -> dict:
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "user": self.user,
+            "priority": self.priority,
+            "position": position,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "wait_ms": self.wait_ms,
+            "run_ms": self.run_ms,
+            "error": self.error,
+        }
+        if include_result:
+            data["result"] = self.result
+        return data
+
+
+class JobQueue:
+    """有界工作池：按优先级（数值越大越先执行）调度，同优先级下优先选择运行中任务最少、最久未被服务的用户。"""
+
+    def __init__(self, name: str, workers: int, max_depth: int, max_queued_per_user: int, retention_s: float):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_depth = max_depth
+        self.max_queued_per_user = max_queued_per_user
+        self.retention_s = retention_s
+        self._jobs: dict[str, Job] = {}
+        self._queued: dict[str, list[Job]] = defaultdict(list)
+        self._running: dict[str, int] = defaultdict(int)
+        self._last_served: dict[str, int] = {}
+        self._seq = itertools.count()
+        self._cond: asyncio.Condition | None = None
+        self._worker_tasks: list[asyncio.Task] = []
+        self._run_ms: list[float] = []
+
+    @property
+    def depth(self) -> int:
+        return sum(len(jobs) for jobs in self._queued.values())
+
+    @property
+    def running(self) -> int:
+        return sum(self._running.values())
+
+    def _ensure_workers(self) -> None:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        self._worker_tasks = [t for t in self._worker_tasks if not t.done()]
+        while len(self._worker_tasks) < self.workers:
+            self._worker_tasks.append(asyncio.create_task(self._worker()))
+
+    def _retry_after(self) -> float:
+        avg = sum(self._run_ms) / len(self._run_ms) / 1000.0 if self._run_ms else settings.request_timeout_s
+        return max(1.0, avg * (self.depth + 1) / self.workers)
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job._finished is not None and now - job._finished > self.retention_s:
+                del self._jobs[job_id]
+
+    async def submit(self, user: str, priority: int, runner: JobRunner) -> Job:
+        self._ensure_workers()
+        self._prune()
+        if self.depth >= self.max_depth:
+            raise JobQueueFull(f"排队任务已达上限 {self.max_depth}，请稍后重试。", self._retry_after())
+        if len(self._queued[user]) >= self.max_queued_per_user:
+            raise JobQueueFull(f"用户 {user} 排队任务已达上限 {self.max_queued_per_user}。", self._retry_after())
+        job = Job(uuid.uuid4().hex, user, priority, next(self._seq), runner)
+        self._jobs[job.id] = job
+        assert self._cond is not None
+        async with self._cond:
+            self._queued[user].append(job)
+            self._cond.notify()
+        return job
+
+    def _pick(self) -> Job | None:
+        best: tuple | None = None
+        best_user: str | None = None
+        for user, jobs in self._queued.items():
+            if not jobs:
+                continue
+            head = max(jobs, key=lambda j: (j.priority, -j.seq))
+            key = (-head.priority, self._running[user], self._last_served.get(user, -1), head.seq)
+            if best is None or key < best:
+                best, best_user = key, user
+        if best_user is None:
+            return None
+        jobs = self._queued[best_user]
+        job = max(jobs, key=lambda j: (j.priority, -j.seq))
+        jobs.remove(job)
+        if not jobs:
+            del self._queued[best_user]
+        self._last_served[best_user] = next(self._seq)
+        return job
+
+    def position(self, job: Job) -> int | None:
+        if job.status != "queued":
+            return None
+        ahead = [j for jobs in self._queued.values() for j in jobs if (j.priority, -j.seq) > (job.priority, -job.seq)]
+        return len(ahead) + 1
+
+    async def _worker(self) -> None:
+        assert self._cond is not None
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self.depth > 0)
+                job = self._pick()
+            if job is None:
+                continue
+            await self._execute(job)
+
+    async def _execute(self, job: Job) -> None:
+        job.status = "running"
+        job.started_at = datetime.now(timezone.utc)
+        job._started = time.monotonic()
+        self._running[job.user] += 1
+        job.task = asyncio.current_task()
+        try:
+            job.result = await job.runner(job.events)
+            job.status = "succeeded"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            job.error = "任务已取消。"
+            if not job.cancel_requested:
+                raise
+            asyncio.current_task().uncancel()
+            await job.events.put({"event": "error", "message": job.error})
+        except Exception as exc:
+            logger.exception("%s job %s failed", self.name, job.id)
+            job.status = "failed"
+            job.error = str(exc) or type(exc).__name__
+            await job.events.put({"event": "error", "message": job.error})
+        finally:
+            job.task = None
+            job.finished_at = datetime.now(timezone.utc)
+            job._finished = time.monotonic()
+            self._running[job.user] -= 1
+            if not self._running[job.user]:
+                del self._running[job.user]
+            self._run_ms = (self._run_ms + [job.run_ms or 0.0])[-50:]
+            await job.events.put({"event": "end"})
+
+    async def cancel(self, job: Job) -> bool:
+        if job.status == "queued":
+            assert self._cond is not None
+            async with self._cond:
+                jobs = self._queued.get(job.user) or []
+                if job in jobs:
+                    jobs.remove(job)
+                    if not jobs:
+                        del self._queued[job.user]
+            job.status = "cancelled"
+            job.error = "任务已取消。"
+            job.finished_at = datetime.now(timezone.utc)
+            job._finished = time.monotonic()
+            await job.events.put({"event": "error", "message": job.error})
+            await job.events.put({"event": "end"})
+            return True
+        if job.status == "running" and job.task is not None:
+            job.cancel_requested = True
+            job.task.cancel()
+            return True
+        return False
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def snapshot(self) -> dict:
+        active = [j for j in self._jobs.values() if j.status in ("queued", "running")]
+        active.sort(key=lambda j: (j.status != "running", -j.priority, j.seq))
+        return {
+            "workers": self.workers,
+            "max_depth": self.max_depth,
+            "queued": self.depth,
+            "running": self.running,
+            "jobs": [j.view(self.position(j)) for j in active],
+        }
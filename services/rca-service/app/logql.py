@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import re
+import warnings
+
+
+# Loki 使用 RE2：不支持环视、反向引用、原子组与占有量词
+_RE2_GROUP_UNSUPPORTED = ("(?=", "(?!", "(?<=", "(?<!", "(?>")
+_RE2_COUNTED = re.compile(r"\{\d+(?:,\d*)?\}")
+# RE2 支持而 Python re 不认识的写法：\z、\Q...\E、\C、\pL 等
+_RE2_ONLY_ESCAPE = re.compile(r"\\[zQECpP]")
+
+
+def quote(value: str) -> str:
+    """按 Go 字符串规则把值写成 LogQL 双引号字面量（反斜杠与双引号需转义）。"""
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _re2_unsupported(pattern: str) -> str | None:
+    """逐字符扫描正则，返回第一个 RE2 不支持的写法；转义字符、字符类与 \\Q...\\E 中的内容按字面处理。"""
+    i, n = 0, len(pattern)
+    while i < n:
+        ch = pattern[i]
+        if ch == "\\":
+            nxt = pattern[i + 1 : i + 2]
+            if nxt == "Q":
+                end = pattern.find("\\E", i + 2)
+                i = n if end < 0 else end + 2
+                continue
+            if nxt and nxt in "123456789":
+                return pattern[i : i + 2]
+            i += 2
+            continue
+        if ch == "[":
+            j = i + 1
+            if pattern[j : j + 1] == "^":
+                j += 1
+            if pattern[j : j + 1] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                if pattern[j] == "[" and pattern[j + 1 : j + 2] == ":":
+                    close = pattern.find(":]", j + 2)
+                    j = j + 1 if close < 0 else close + 2
+                    continue
+                j += 2 if pattern[j] == "\\" else 1
+            i = j + 1
+            continue
+        if ch == "(":
+            for group in _RE2_GROUP_UNSUPPORTED:
+                if pattern.startswith(group, i):
+                    return group
+            i += 1
+            continue
+        end = i + 1 if ch in "*+?" else 0
+        if ch == "{":
+            m = _RE2_COUNTED.match(pattern, i)
+            end = m.end() if m else 0
+        if end:
+            if pattern[end : end + 1] == "+":
+                return pattern[i : end + 1]
+            if pattern[end : end + 1] == "?":
+                end += 1
+            i = end
+            continue
+        i += 1
+    return None
+
+
+def regex_error(pattern: str) -> str | None:
+    """检查正则能否被 Loki（RE2）接受，返回错误说明；合法时返回 None。"""
+    found = _re2_unsupported(pattern)
+    if found is not None:
+        return f"Loki 使用 RE2 正则，不支持 {found}（环视、反向引用、原子组或占有量词）"
+    try:
+        with warnings.catch_warnings():
+            # [[:alpha:]] 等 POSIX 字符类在 Python 中会触发 FutureWarning
+            warnings.simplefilter("ignore", FutureWarning)
+            re.compile(pattern)
+    except re.error as exc:
+        # Python re 只作参考：含 RE2 独有转义时不据此拒绝
+        if _RE2_ONLY_ESCAPE.search(pattern):
+            return None
+        return f"正则语法错误：{exc}"
+    return None
@@ -5,6 +5,9 @@ from datetime import datetime, timezone
 
 import httpx
 
+from . import backpressure, metrics, replay, resilience, result_cache, snapshot
+from .singleflight import align_range, get_group, normalize_query
+
 
 def _dt_to_ns(dt: datetime) -> int:
     if dt.tzinfo is None:
@@ -32,21 +35,58 @@ class LokiQueryResult:
 
 
 class LokiClient:
-    def __init__(self, base_url: str, tenant_id: str | None, timeout_s: float):
+    def __init__(self, base_url: str, tenant_id: str | None, timeout_s: float, align_s: float = 0.0):
         self._base_url = base_url.rstrip("/")
         self._tenant_id = tenant_id
         self._timeout_s = timeout_s
+        self._align_s = align_s
+        self._flight = get_group("loki")
+        self._cache = result_cache.get_cache("loki")
 
     def _headers(self) -> dict[str, str]:
         if self._tenant_id:
             return {"X-Scope-OrgID": self._tenant_id}
         return {}
 
+    async def _get(self, path: str, params: dict[str, str | int] | None = None) -> dict:
+        items = tuple(sorted((k, normalize_query(v) if k == "query" else v) for k, v in (params or {}).items()))
+        key = (self._tenant_id, path, items)
+        end_ns = (params or {}).get("end") or (params or {}).get("time")
+        end_s = int(end_ns) / 1_000_000_000 if end_ns is not None else None
+        ttl_s = result_cache.ttl_for(end_s)
+        return await replay.upstream(
+            "loki",
+            path,
+            params,
+            lambda: snapshot.upstream(
+                "loki",
+                path,
+                params,
+                end_s,
+                lambda: self._cache.get_or_fetch(key, ttl_s, lambda: self._flight.do(key, lambda: self._fetch(path, params))),
+            ),
+        )
+
+    async def _fetch(self, path: str, params: dict[str, str | int] | None) -> dict:
+        endpoint = "loki.label_values" if "/label/" in path else f"loki.{path.rsplit('/', 1)[-1]}"
+        return await resilience.call(
+            endpoint,
+            lambda timeout_s: self._attempt(endpoint, path, params, timeout_s),
+            self._timeout_s,
+        )
+
+    async def _attempt(self, endpoint: str, path: str, params: dict[str, str | int] | None, timeout_s: float) -> dict:
+        async with backpressure.get_guard("loki").slot():
+            with metrics.upstream_call("loki", endpoint) as call:
+                async with httpx.AsyncClient(timeout=timeout_s) as client:
+                    r = await client.get(f"{self._base_url}{path}", params=params, headers=self._headers())
+                call["bytes"] = len(r.content)
+                r.raise_for_status()
+                return r.json()
+
     async def label_values(self, label: str) -> list[str]:
-        async with httpx.AsyncClient(timeout=self._timeout_s) as client:
-            r = await client.get(f"{self._base_url}/loki/api/v1/label/{label}/values", headers=self._headers())
-        r.raise_for_status()
-        return (r.json().get("data") or [])[:]
+        data = await self._get(f"/loki/api/v1/label/{label}/values")
+        return (data.get("data") or [])[:]
 
     async def query_range(
         self,
@@ -56,6 +96,7 @@ class LokiClient:
         limit: int = 200,
         direction: str = "BACKWARD",
     ) -> LokiQueryResult:
+        start, end = align_range(start, end, self._align_s)
         params: dict[str, str | int] = {
             "query": query,
             "start": _dt_to_ns(start),
@@ -63,8 +104,5 @@ class LokiClient:
             "limit": limit,
             "direction": direction,
         }
-        async with httpx.AsyncClient(timeout=self._timeout_s) as client:
-            r = await client.get(f"{self._base_url}/loki/api/v1/query_range", params=params, headers=self._headers())
-        r.raise_for_status()
-        return LokiQueryResult(raw=r.json())
+        return LokiQueryResult(raw=await self._get("/loki/api/v1/query_range", params))
 
@@ -3,24 +3,42 @@ from __future__ import annotations
 from datetime import datetime, timedelta, timezone
 import asyncio
 import json
+import time
 from typing import AsyncIterator
 
 import logging
 import uuid
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 from langchain_core.callbacks import AsyncCallbackHandler
 
 from .llm import get_llm
 from .loki_client import LokiClient
-from .models import AgentTrace, RCAOutput, RCARequest, RCAResponse, TraceStep
+from .jobs import Job, JobEvents, JobQueue, JobQueueFull
+from .models import (
+    AgentTrace,
+    IterationTiming,
+    JobInfo,
+    JobList,
+    RCAJobRequest,
+    RCAOutput,
+    RCARequest,
+    RCAResponse,
+    TraceBreakdown,
+    TraceStep,
+)
 from .settings import settings
+from . import backpressure, deadline, metrics, replay, resilience, result_cache, singleflight, snapshot
 from .agent.executor import build_executor
 from .memory.store import get_memory
+from .pipeline import run_pipeline
+from .prefetch import prefetch_rca_context
 from .tools import build_tools
+from .tools import memo as tool_memo
+from .tools.memo import ToolMemo, current_tool_memo
 
 
 class _HealthzAccessFilter(logging.Filter):
@@ -29,10 +47,10 @@ class _HealthzAccessFilter(logging.Filter):
             args = record.args
             if isinstance(args, tuple) and len(args) >= 2:
                 req = args[1]
-                if isinstance(req, str) and "/healthz" in req:
+                if isinstance(req, str) and ("/healthz" in req or "/metrics" in req):
                     return False
             msg = record.getMessage()
-            if "/healthz" in msg:
+            if "/healthz" in msg or "/metrics" in msg:
                 return False
         except Exception:
             return True
@@ -49,7 +67,23 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-loki = LokiClient(settings.loki_base_url, settings.loki_tenant_id, settings.request_timeout_s)
+app.add_middleware(metrics.MetricsMiddleware)
+loki = LokiClient(settings.loki_base_url, settings.loki_tenant_id, settings.request_timeout_s, settings.upstream_align_s)
+jobs = JobQueue(
+    "rca",
+    settings.job_workers,
+    settings.job_queue_max_depth,
+    settings.job_max_queued_per_user,
+    settings.job_retention_s,
+)
+metrics.JOB_QUEUE_DEPTH.set_function(lambda: jobs.depth)
+metrics.JOB_RUNNING.set_function(lambda: jobs.running)
+
+
+@app.exception_handler(backpressure.BackendUnavailable)
+async def backend_unavailable(request: Request, exc: backpressure.BackendUnavailable) -> JSONResponse:
+    headers = {"Retry-After": str(int(exc.retry_after_s) + 1)} if exc.retry_after_s is not None else None
+    return JSONResponse(status_code=503, content={"detail": str(exc), **exc.observation()}, headers=headers)
 
 
 @app.get("/healthz")
@@ -57,6 +91,24 @@ def healthz() -> dict[str, str]:
     return {"status": "ok", "service": settings.service_name}
 
 
+@app.get("/metrics")
+def prometheus_metrics() -> Response:
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
+
+
+@app.get("/debug/upstream")
+def debug_upstream() -> dict:
+    return {
+        "singleflight": singleflight.stats(),
+        "result_cache": result_cache.stats(),
+        "snapshots": snapshot.stats(),
+        "tool_memo": tool_memo.stats(),
+        "endpoints": resilience.stats(),
+        "backends": backpressure.stats(),
+    }
+
+
 _CST = timezone(timedelta(hours=8))
 
 
@@ -77,7 +129,23 @@ def _stringify(value) -> str:
         return str(value)
 
 
-def _build_trace(intermediate_steps) -> AgentTrace:
+def _llm_usage(response) -> dict:
+    usage = None
+    try:
+        message = getattr(response.generations[0][0], "message", None)
+        usage = getattr(message, "usage_metadata", None)
+    except Exception:
+        usage = None
+    if usage:
+        return {"prompt_tokens": usage.get("input_tokens"), "completion_tokens": usage.get("output_tokens")}
+    token_usage = (getattr(response, "llm_output", None) or {}).get("token_usage") or {}
+    if token_usage:
+        return {"prompt_tokens": token_usage.get("prompt_tokens"), "completion_tokens": token_usage.get("completion_tokens")}
+    return {}
+
+
+def _build_trace(intermediate_steps, executor=None) -> AgentTrace:
+    iterations, tool_timings = executor.step_timings() if executor is not None else ([], {})
     steps: list[TraceStep] = []
     for idx, pair in enumerate(intermediate_steps or []):
         try:
@@ -88,11 +156,15 @@ def _build_trace(intermediate_steps) -> AgentTrace:
         tool_input = getattr(action, "tool_input", None)
         log = getattr(action, "log", None)
         obs_text = _stringify(observation)
+        obs_raw_chars = len(obs_text)
         if len(obs_text) > 8000:
             obs_text = obs_text[:8000] + "\n...(truncated)"
         inp_text = _stringify(tool_input)
         if len(inp_text) > 4000:
             inp_text = inp_text[:4000] + "\n...(truncated)"
+        timing = tool_timings.get(id(action), {})
+        iteration = timing.get("iteration")
+        planned_by = iterations[iteration] if iteration is not None and iteration < len(iterations) else {}
         steps.append(
             TraceStep(
                 index=idx,
@@ -100,9 +172,30 @@ def _build_trace(intermediate_steps) -> AgentTrace:
                 tool_input=inp_text or None,
                 observation=obs_text or None,
                 log=str(log) if log else None,
+                iteration=iteration,
+                started_at=timing.get("started_at"),
+                ended_at=timing.get("ended_at"),
+                started_ms=timing.get("started_ms"),
+                wait_ms=timing.get("wait_ms"),
+                duration_ms=timing.get("duration_ms"),
+                llm_ms=planned_by.get("llm_ms"),
+                observation_raw_chars=obs_raw_chars,
+                observation_chars=len(obs_text),
             )
         )
-    return AgentTrace(steps=steps)
+    breakdown = None
+    if executor is not None and hasattr(executor, "breakdown"):
+        breakdown = TraceBreakdown(
+            **executor.breakdown(),
+            observation_raw_chars=sum(s.observation_raw_chars or 0 for s in steps),
+            observation_chars=sum(s.observation_chars or 0 for s in steps),
+        )
+    return AgentTrace(
+        steps=steps,
+        iterations=[IterationTiming(**it) for it in iterations],
+        stopped_reason=getattr(executor, "stopped_reason", None),
+        breakdown=breakdown,
+    )
 
 
 class RCAStreamHandler(AsyncCallbackHandler):
@@ -112,6 +205,9 @@ class RCAStreamHandler(AsyncCallbackHandler):
         self.step_counter = 0
         self.current_workflow_stage = "thinking"
         self.current_step_id: str | None = None
+        self.tool_step_ids: dict = {}
+        self.run_timings: dict = {}
+        self._started = time.perf_counter()
 
     def _next_step_id(self) -> str:
         self.step_counter += 1
@@ -124,13 +220,33 @@ class RCAStreamHandler(AsyncCallbackHandler):
             "workflow_stage": workflow_stage or self.current_workflow_stage,
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "session_id": self.session_id,
+            "elapsed_ms": round((time.perf_counter() - self._started) * 1000.0, 1),
         }
         payload.update(data)
         await self.queue.put(payload)
 
+    def _begin_run(self, run_id) -> None:
+        if run_id is not None:
+            self.run_timings[run_id] = {
+                "started": time.perf_counter(),
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "ttft_ms": None,
+            }
+
+    def _end_run(self, run_id) -> dict:
+        timing = self.run_timings.pop(run_id, None)
+        if timing is None:
+            return {}
+        return {
+            "started_at": timing["started_at"],
+            "duration_ms": round((time.perf_counter() - timing["started"]) * 1000.0, 1),
+            "ttft_ms": timing["ttft_ms"],
+        }
+
     async def on_llm_start(self, serialized, prompts, **kwargs):
         self.current_workflow_stage = "thinking"
         self.current_step_id = self._next_step_id()
+        self._begin_run(kwargs.get("run_id"))
         prompt = prompts[0] if prompts else ""
         model_name = None
         if isinstance(serialized, dict):
@@ -145,6 +261,9 @@ class RCAStreamHandler(AsyncCallbackHandler):
         )
 
     async def on_llm_new_token(self, token: str, **kwargs):
+        timing = self.run_timings.get(kwargs.get("run_id"))
+        if timing is not None and timing["ttft_ms"] is None:
+            timing["ttft_ms"] = round((time.perf_counter() - timing["started"]) * 1000.0, 1)
         await self._send_event(
             "llm_token",
             {
@@ -169,6 +288,8 @@ class RCAStreamHandler(AsyncCallbackHandler):
             {
                 "response": text,
                 "step_id": self.current_step_id,
+                **self._end_run(kwargs.get("run_id")),
+                **_llm_usage(response),
             },
         )
 
@@ -220,6 +341,10 @@ class RCAStreamHandler(AsyncCallbackHandler):
             return
         self.current_workflow_stage = "executing"
         self.current_step_id = self._next_step_id()
+        run_id = kwargs.get("run_id")
+        if run_id is not None:
+            self.tool_step_ids[run_id] = self.current_step_id
+        self._begin_run(run_id)
         await self._send_event(
             "tool_start",
             {
@@ -232,21 +357,30 @@ class RCAStreamHandler(AsyncCallbackHandler):
     async def on_tool_end(self, output, **kwargs):
         self.current_workflow_stage = "observing"
         observation = _stringify(output)
+        step_id = self.tool_step_ids.pop(kwargs.get("run_id"), None) or self.current_step_id
+        timing = self._end_run(kwargs.get("run_id"))
+        timing.pop("ttft_ms", None)
         await self._send_event(
             "tool_end",
             {
                 "observation": observation,
-                "step_id": self.current_step_id,
+                "step_id": step_id,
+                "observation_chars": len(observation),
+                **timing,
             },
         )
         await self._send_event(
             "agent_observation",
             {
                 "observation": observation,
-                "step_id": self.current_step_id,
+                "step_id": step_id,
             },
         )
 
+    async def on_pipeline_stage(self, stage: dict):
+        self.current_workflow_stage = "executing"
+        await self._send_event("pipeline_stage", stage)
+
     async def on_chain_error(self, error, **kwargs):
         await self._send_event(
             "error",
@@ -258,33 +392,60 @@ class RCAStreamHandler(AsyncCallbackHandler):
         )
 
 
+@metrics.tracked_session
+@replay.session
+@snapshot.session
+@deadline.budgeted
 async def _run_rca(req: RCARequest, callbacks: list | None = None) -> RCAResponse:
     start = _ensure_cst(req.time_range.start)
     end = _ensure_cst(req.time_range.end)
     if end <= start:
         raise HTTPException(status_code=400, detail="end必须大于start。")
+    if req.mode == "pipeline":
+        return await _run_rca_pipeline(req, start, end, callbacks)
 
-    llm = get_llm(streaming=callbacks is not None)
-    tools = build_tools(loki)
-    memory = get_memory(req.session_id)
-    executor = build_executor(llm, tools, memory)
-
-    agent_input = (
-        f"故障描述：{req.description}\n"
-        f"时间范围（CST，UTC+8）：{start.isoformat()} ~ {end.isoformat()}\n\n"
-        "请按以下步骤执行：\n"
-        "1) 调用工具rca_collect_evidence获取日志证据\n"
-        "2) 基于证据输出RCA结论\n\n"
-        "输出必须是JSON对象，字段为：summary, suspected_service, root_cause, evidence, suggested_actions。"
-    )
-    config = {"callbacks": callbacks} if callbacks else None
-    res = await executor.ainvoke({"input": agent_input}, config=config)
+    memo = ToolMemo(req.session_id)
+    memo_token = current_tool_memo.set(memo)
+    try:
+        prefetched = ""
+        if settings.rca_prefetch_enabled:
+            prefetched = await prefetch_rca_context(loki, start, end, memo)
+
+        llm = get_llm(streaming=callbacks is not None)
+        tools = build_tools(loki)
+        memory = get_memory(req.session_id)
+        executor = build_executor(llm, tools, memory)
+
+        if prefetched:
+            steps = (
+                "请按以下步骤执行：\n"
+                "1) 先基于下方已预取的日志证据与 RED 指标分析，仅在需要更多或不同数据时再调用工具\n"
+                "2) 基于证据输出RCA结论\n\n"
+                f"{prefetched}\n\n"
+            )
+        else:
+            steps = (
+                "请按以下步骤执行：\n"
+                "1) 调用工具rca_collect_evidence获取日志证据\n"
+                "2) 基于证据输出RCA结论\n\n"
+            )
+        agent_input = (
+            f"故障描述：{req.description}\n"
+            f"时间范围（CST，UTC+8）：{start.isoformat()} ~ {end.isoformat()}\n\n"
+            f"{steps}"
+            "输出必须是JSON对象，字段为：summary, suspected_service, root_cause, evidence, suggested_actions。"
+        )
+        config = {"callbacks": callbacks} if callbacks else None
+        res = await executor.ainvoke({"input": agent_input}, config=config)
+    finally:
+        memo.cancel_pending()
+        current_tool_memo.reset(memo_token)
     raw = str(res.get("output") or "")
     try:
         out = RCAOutput.model_validate_json(raw)
     except Exception:
         out = RCAOutput(summary=raw.strip() or "模型输出为空。")
-    trace = _build_trace(res.get("intermediate_steps"))
+    trace = _build_trace(res.get("intermediate_steps"), executor)
     return RCAResponse(
         summary=out.summary,
         suspected_service=out.suspected_service,
@@ -292,6 +453,31 @@ async def _run_rca(req: RCARequest, callbacks: list | None = None) -> RCARespons
         evidence=out.evidence or [],
         suggested_actions=out.suggested_actions or [],
         trace=trace,
+        snapshot=snapshot.info(),
+        tool_memo=memo.info(),
+    )
+
+
+async def _run_rca_pipeline(req: RCARequest, start: datetime, end: datetime, callbacks: list | None) -> RCAResponse:
+    llm = get_llm(streaming=callbacks is not None)
+    config = {"callbacks": callbacks} if callbacks else None
+    on_stage = None
+    for cb in callbacks or []:
+        if isinstance(cb, RCAStreamHandler):
+            on_stage = cb.on_pipeline_stage
+            break
+    out, report = await run_pipeline(loki, llm, req.description, start, end, config=config, on_stage=on_stage)
+    memory = get_memory(req.session_id)
+    if memory is not None:
+        await memory.asave_context({"input": req.description}, {"output": out.model_dump_json()})
+    return RCAResponse(
+        summary=out.summary,
+        suspected_service=out.suspected_service,
+        root_cause=out.root_cause,
+        evidence=out.evidence or [],
+        suggested_actions=out.suggested_actions or [],
+        pipeline=report,
+        snapshot=snapshot.info(),
     )
 
 
@@ -300,33 +486,48 @@ async def analyze(req: RCARequest) -> RCAResponse:
     return await _run_rca(req)
 
 
+async def _stream_rca(req: RCARequest, queue) -> RCAResponse:
+    handler = RCAStreamHandler(queue)
+    start = _ensure_cst(req.time_range.start)
+    end = _ensure_cst(req.time_range.end)
+    await queue.put(
+        {
+            "event": "start",
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+        }
+    )
+    res = await _run_rca(req, callbacks=[handler])
+    meta = {
+        "event": "final",
+        "summary": res.summary,
+        "suspected_service": res.suspected_service,
+        "root_cause": res.root_cause,
+        "evidence": res.evidence,
+        "suggested_actions": res.suggested_actions,
+        "trace": res.trace.dict() if res.trace else None,
+        "pipeline": res.pipeline.dict() if res.pipeline else None,
+    }
+    await queue.put(meta)
+    return res
+
+
+def _ndjson(items: AsyncIterator[dict]) -> StreamingResponse:
+    async def iterator() -> AsyncIterator[bytes]:
+        async for item in items:
+            data = json.dumps(item, ensure_ascii=False, default=str) + "\n"
+            yield data.encode("utf-8")
+
+    return StreamingResponse(iterator(), media_type="application/x-ndjson")
+
+
 @app.post("/api/rca/analyze/stream")
 async def analyze_stream(req: RCARequest):
-    queue: asyncio.Queue = asyncio.Queue()
+    queue: asyncio.Queue = metrics.track_queue(asyncio.Queue())
 
     async def runner():
         try:
-            handler = RCAStreamHandler(queue)
-            start = _ensure_cst(req.time_range.start)
-            end = _ensure_cst(req.time_range.end)
-            await queue.put(
-                {
-                    "event": "start",
-                    "start": start.isoformat(),
-                    "end": end.isoformat(),
-                }
-            )
-            res = await _run_rca(req, callbacks=[handler])
-            meta = {
-                "event": "final",
-                "summary": res.summary,
-                "suspected_service": res.suspected_service,
-                "root_cause": res.root_cause,
-                "evidence": res.evidence,
-                "suggested_actions": res.suggested_actions,
-                "trace": res.trace.dict() if res.trace else None,
-            }
-            await queue.put(meta)
+            await _stream_rca(req, queue)
         except Exception as exc:
             await queue.put({"event": "error", "message": str(exc)})
         finally:
@@ -334,12 +535,58 @@ async def analyze_stream(req: RCARequest):
 
     asyncio.create_task(runner())
 
-    async def iterator() -> AsyncIterator[bytes]:
+    async def items() -> AsyncIterator[dict]:
         while True:
             item = await queue.get()
-            data = json.dumps(item, ensure_ascii=False) + "\n"
-            yield data.encode("utf-8")
+            yield item
             if item.get("event") == "end":
                 break
 
-    return StreamingResponse(iterator(), media_type="application/x-ndjson")
+    return _ndjson(items())
+
+
+def _get_job(job_id: str) -> Job:
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期。")
+    return job
+
+
+@app.post("/api/rca/jobs", response_model=JobInfo, status_code=202)
+async def submit_job(req: RCAJobRequest, request: Request) -> JobInfo:
+    if _ensure_cst(req.time_range.end) <= _ensure_cst(req.time_range.start):
+        raise HTTPException(status_code=400, detail="end必须大于start。")
+    user = request.headers.get("X-User-Id") or req.session_id or (request.client.host if request.client else "anonymous")
+
+    async def runner(events: JobEvents) -> dict:
+        return (await _stream_rca(req, events)).model_dump()
+
+    try:
+        job = await jobs.submit(user, req.priority, runner)
+    except JobQueueFull as exc:
+        raise HTTPException(status_code=429, detail=str(exc), headers={"Retry-After": str(int(exc.retry_after_s) + 1)})
+    return JobInfo(**job.view(jobs.position(job)))
+
+
+@app.get("/api/rca/jobs", response_model=JobList)
+async def list_jobs() -> JobList:
+    return JobList(**jobs.snapshot())
+
+
+@app.get("/api/rca/jobs/{job_id}", response_model=JobInfo)
+async def get_job(job_id: str) -> JobInfo:
+    job = _get_job(job_id)
+    return JobInfo(**job.view(jobs.position(job), include_result=True))
+
+
+@app.get("/api/rca/jobs/{job_id}/stream")
+async def stream_job(job_id: str):
+    return _ndjson(_get_job(job_id).events.follow())
+
+
+@app.delete("/api/rca/jobs/{job_id}", response_model=JobInfo)
+async def cancel_job(job_id: str) -> JobInfo:
+    job = _get_job(job_id)
+    if not await jobs.cancel(job):
+        raise HTTPException(status_code=409, detail=f"任务状态为 {job.status}，无法取消。")
+    return JobInfo(**job.view())
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from datetime import datetime
+from typing import Literal
 
 from pydantic import BaseModel, Field
 
@@ -11,10 +12,52 @@ class TraceStep(BaseModel):
     tool_input: str | None = None
     observation: str | None = None
     log: str | None = None
+    iteration: int | None = None
+    started_at: datetime | None = None
+    ended_at: datetime | None = None
+    started_ms: float | None = None
+    wait_ms: float | None = None
+    duration_ms: float | None = None
+    llm_ms: float | None = None
+    observation_raw_chars: int | None = None
+    observation_chars: int | None = None
+
+
+class IterationTiming(BaseModel):
+    index: int
+    started_at: datetime | None = None
+    ended_at: datetime | None = None
+    started_ms: float | None = None
+    llm_ms: float | None = None
+    ttft_ms: float | None = None
+    tools_ms: float | None = None
+    wall_ms: float | None = None
+    tool_calls: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+
+
+class TraceBreakdown(BaseModel):
+    wall_ms: float | None = None
+    llm_ms: float | None = None
+    tool_wall_ms: float | None = None
+    tool_ms: float | None = None
+    other_ms: float | None = None
+    iterations: int = 0
+    tool_calls: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    observation_raw_chars: int = 0
+    observation_chars: int = 0
 
 
 class AgentTrace(BaseModel):
     steps: list[TraceStep] = []
+    iterations: list[IterationTiming] = []
+    stopped_reason: str | None = None
+    breakdown: TraceBreakdown | None = None
 
 
 class TimeRange(BaseModel):
@@ -26,6 +69,40 @@ class RCARequest(BaseModel):
     description: str = Field(min_length=1, max_length=4000)
     time_range: TimeRange
     session_id: str | None = Field(default=None, max_length=200)
+    incident_id: str | None = Field(default=None, max_length=200)
+    mode: Literal["agent", "pipeline"] = "agent"
+
+
+class PipelineStage(BaseModel):
+    name: str
+    status: str
+    started_ms: float | None = None
+    duration_ms: float | None = None
+    error: str | None = None
+
+
+class PipelineReport(BaseModel):
+    stages: list[PipelineStage] = []
+    llm_calls: int = 0
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    total_ms: float | None = None
+
+
+class SnapshotInfo(BaseModel):
+    id: str
+    created_at: str | None = None
+    hits: int = 0
+    misses: int = 0
+
+
+class ToolMemoInfo(BaseModel):
+    session_id: str
+    hits: int = 0
+    misses: int = 0
+    session_hits: int = 0
+    session_misses: int = 0
+    session_hit_rate: float | None = None
 
 
 class RCAResponse(BaseModel):
@@ -35,6 +112,9 @@ class RCAResponse(BaseModel):
     evidence: list[str] = []
     suggested_actions: list[str] = []
     trace: AgentTrace | None = None
+    pipeline: PipelineReport | None = None
+    snapshot: SnapshotInfo | None = None
+    tool_memo: ToolMemoInfo | None = None
 
 
 class RCAOutput(BaseModel):
@@ -43,3 +123,30 @@ class RCAOutput(BaseModel):
     root_cause: str | None = None
     evidence: list[str] = []
     suggested_actions: list[str] = []
+
+
+class RCAJobRequest(RCARequest):
+    priority: int = Field(default=5, ge=0, le=9)
+
+
+class JobInfo(BaseModel):
+    job_id: str
+    status: Literal["queued", "running", "succeeded", "failed", "cancelled"]
+    user: str
+    priority: int
+    position: int | None = None
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    wait_ms: float | None = None
+    run_ms: float | None = None
+    error: str | None = None
+    result: RCAResponse | None = None
+
+
+class JobList(BaseModel):
+    workers: int
+    max_depth: int
+    queued: int
+    running: int
+    jobs: list[JobInfo] = []
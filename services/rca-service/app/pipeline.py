@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.prompts import ChatPromptTemplate
+
+from . import deadline
+from .differential import describe, differential_analysis
+from .log_normalize import line_fingerprint, strip_annotation
+from .loki_client import LokiClient
+from .models import PipelineReport, PipelineStage, RCAOutput
+from .prefetch import red_queries
+from .settings import settings
+from .tools.prometheus_query_range import fetch_prometheus_range
+from .tools.rca_collect_evidence import collect_evidence
+
+
+StageFn = Callable[[dict[str, Any]], Awaitable[Any]]
+StageHook = Callable[[dict], Awaitable[None]]
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: StageFn
+    deps: list[str] = field(default_factory=list)
+    timeout_s: float | None = None
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000.0, 1)
+
+
+async def run_dag(stages: list[Stage], on_stage: StageHook | None = None) -> tuple[dict[str, Any], list[PipelineStage]]:
+    """按依赖关系并发执行各阶段；单个阶段超时或失败时结果记为 None，下游阶段照常执行。
+
+    阶段超时会收缩到请求剩余预算（预留 deadline_reserve_s 给最后的 LLM 汇总）。
+    """
+    t0 = time.perf_counter()
+    futures: dict[str, asyncio.Future] = {s.name: asyncio.get_running_loop().create_future() for s in stages}
+    results: dict[str, Any] = {}
+    report: dict[str, PipelineStage] = {}
+
+    async def run(stage: Stage) -> None:
+        if stage.deps:
+            await asyncio.gather(*(futures[d] for d in stage.deps))
+        inputs = {d: results.get(d) for d in stage.deps}
+        started = time.perf_counter()
+        status, error, value = "ok", None, None
+        timeout_s = deadline.clamp(stage.timeout_s, settings.deadline_reserve_s)
+        try:
+            value = await asyncio.wait_for(stage.fn(inputs), timeout=timeout_s)
+        except asyncio.TimeoutError:
+            status, error = "timeout", f"超过 {timeout_s:.1f}s 截止时间" if timeout_s is not None else "超出时间预算"
+        except Exception as exc:
+            status, error = "failed", f"{type(exc).__name__}: {exc}"
+        ended = time.perf_counter()
+        results[stage.name] = value
+        report[stage.name] = PipelineStage(
+            name=stage.name,
+            status=status,
+            started_ms=_ms(started - t0),
+            duration_ms=_ms(ended - started),
+            error=error,
+        )
+        futures[stage.name].set_result(None)
+        if on_stage is not None:
+            await on_stage(report[stage.name].model_dump())
+
+    await asyncio.gather(*(run(s) for s in stages))
+    return results, [report[s.name] for s in stages]
+
+
+def _metric_means(result: dict | None) -> dict[str, float]:
+    means: dict[str, float] = {}
+    for item in (result or {}).get("series") or []:
+        values: list[float] = []
+        for _, val in item.get("values") or []:
+            try:
+                v = float(val)
+            except Exception:
+                continue
+            if v == v:
+                values.append(v)
+        if values:
+            means[(item.get("metric") or {}).get("service", "?")] = sum(values) / len(values)
+    return means
+
+
+async def _fetch_red(start: datetime, end: datetime) -> dict[str, dict]:
+    queries = red_queries(settings.rca_known_services)
+    step = settings.rca_prefetch_step
+    results = await asyncio.gather(*(fetch_prometheus_range(q, start, end, step) for q in queries.values()))
+    return dict(zip(queries.keys(), results))
+
+
+def _compare(incident: dict[str, dict] | None, baseline: dict[str, dict] | None) -> list[str]:
+    lines: list[str] = []
+    for label, result in (incident or {}).items():
+        now = _metric_means(result)
+        before = _metric_means((baseline or {}).get(label))
+        for service, value in sorted(now.items()):
+            prev = before.get(service)
+            if prev is None:
+                lines.append(f"{label} {service}：故障窗口均值 {value:.3g}（基线无数据）")
+                continue
+            ratio = value / prev if prev else float("inf") if value else 1.0
+            lines.append(f"{label} {service}：故障窗口均值 {value:.3g}，基线 {prev:.3g}，变化 x{ratio:.2f}")
+    return lines
+
+
+def _reduce(inputs: dict[str, Any]) -> dict[str, str]:
+    evidence = inputs.get("evidence") or {}
+    lines = evidence.get("evidence_lines") or []
+    background = (inputs.get("diff") or {}).get("background")
+    if background:
+        # 历史窗口中同样常见的日志模式只是背景噪声，不再占用证据篇幅
+        kept = [line for line in lines if line_fingerprint(strip_annotation(line)) not in background]
+        lines = kept or lines
+    lines = [line[: settings.rca_pipeline_max_line_chars] for line in lines]
+    lines = lines[: settings.rca_pipeline_max_evidence_lines]
+    comparison = inputs.get("compare") or []
+    return {
+        "evidence": "\n".join(lines) or "（未收集到日志证据）",
+        "metrics": "\n".join(comparison) or "（未获取到 RED 指标）",
+        "diff": describe(inputs.get("diff")) if settings.rca_diff_enabled else "（未启用）",
+    }
+
+
+async def run_pipeline(
+    loki: LokiClient,
+    llm: BaseChatModel,
+    description: str,
+    start: datetime,
+    end: datetime,
+    config: dict | None = None,
+    on_stage: StageHook | None = None,
+) -> tuple[RCAOutput, PipelineReport]:
+    t0 = time.perf_counter()
+    baseline_start = start - (end - start)
+    stage_timeout = settings.rca_pipeline_stage_timeout_s
+
+    async def evidence(_: dict) -> dict:
+        return await collect_evidence(loki, start, end)
+
+    async def metrics(_: dict) -> dict:
+        return await _fetch_red(start, end)
+
+    async def baseline(_: dict) -> dict:
+        return await _fetch_red(baseline_start, start)
+
+    async def diff(_: dict) -> dict | None:
+        if not settings.rca_diff_enabled:
+            return None
+        return await differential_analysis(loki, start, end)
+
+    async def compare(inputs: dict) -> list[str]:
+        return _compare(inputs.get("metrics"), inputs.get("baseline"))
+
+    async def reduce(inputs: dict) -> dict[str, str]:
+        return _reduce(inputs)
+
+    stages = [
+        Stage("evidence", evidence, timeout_s=stage_timeout),
+        Stage("metrics", metrics, timeout_s=stage_timeout),
+        Stage("baseline", baseline, timeout_s=stage_timeout),
+        Stage("diff", diff, timeout_s=stage_timeout),
+        Stage("compare", compare, deps=["metrics", "baseline"], timeout_s=stage_timeout),
+        Stage("reduce", reduce, deps=["evidence", "compare", "diff"], timeout_s=stage_timeout),
+    ]
+    results, stage_report = await run_dag(stages, on_stage)
+    reduced = results.get("reduce") or {"evidence": "（无）", "metrics": "（无）", "diff": "（无）"}
+
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                "你是一个面向 Todo_List 项目的 SRE 根因分析助手。只能依据给出的 Loki 日志证据、日志模式差异"
+                "（故障窗口相对历史同时段新出现或显著增多的错误）与 Prometheus RED 指标"
+                "（故障窗口与前一等长基线窗口对比）推断根因，不能编造数据；证据不足时在 summary 中说明。"
+                "只输出符合 JSON schema 的内容。",
+            ),
+            (
+                "human",
+                "故障描述：{description}\n"
+                "时间范围（CST，UTC+8）：{start} ~ {end}\n"
+                "基线窗口：{baseline_start} ~ {start}\n\n"
+                "RED 指标对比：\n{metrics}\n\n"
+                "日志模式差异：\n{diff}\n\n"
+                "错误日志证据：\n{evidence}\n\n"
+                "请输出字段：summary, suspected_service, root_cause, evidence, suggested_actions。",
+            ),
+        ]
+    )
+    chain = prompt | llm.with_structured_output(RCAOutput, include_raw=True)
+    started = time.perf_counter()
+    res = await chain.ainvoke(
+        {
+            "description": description,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "baseline_start": baseline_start.isoformat(),
+            "metrics": reduced["metrics"],
+            "evidence": reduced["evidence"],
+            "diff": reduced["diff"],
+        },
+        config=config,
+    )
+    ended = time.perf_counter()
+    stage_report.append(
+        PipelineStage(name="synthesize", status="ok", started_ms=_ms(started - t0), duration_ms=_ms(ended - started))
+    )
+    if on_stage is not None:
+        await on_stage(stage_report[-1].model_dump())
+
+    out = res.get("parsed") if isinstance(res, dict) else None
+    raw = res.get("raw") if isinstance(res, dict) else None
+    if out is None:
+        content = str(getattr(raw, "content", "") or "").strip()
+        out = RCAOutput(summary=content or "模型输出为空。")
+    usage = getattr(raw, "usage_metadata", None) or {}
+    report = PipelineReport(
+        stages=stage_report,
+        llm_calls=1,
+        prompt_tokens=usage.get("input_tokens"),
+        completion_tokens=usage.get("output_tokens"),
+        total_ms=_ms(time.perf_counter() - t0),
+    )
+    return out, report
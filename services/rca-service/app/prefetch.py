@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import datetime
+
+from .loki_client import LokiClient
+from .settings import settings
+from .tools.memo import ToolMemo, memo_key
+from .tools.prometheus_query_range import fetch_prometheus_range, narrow_series
+from .tools.rca_collect_evidence import collect_evidence, evidence_memo_key
+
+
+logger = logging.getLogger(__name__)
+
+
+def red_queries(services: list[str]) -> dict[str, str]:
+    matcher = "|".join(services)
+    return {
+        "请求速率(req/s)": f'sum by (service) (rate(http_requests_total{{service=~"{matcher}"}}[1m]))',
+        "5xx 速率(req/s)": f'sum by (service) (rate(http_requests_total{{service=~"{matcher}", status=~"5.."}}[1m]))',
+        "P95 延迟(s)": (
+            "histogram_quantile(0.95, sum by (service, le) "
+            f'(rate(http_request_duration_seconds_bucket{{service=~"{matcher}"}}[5m])))'
+        ),
+    }
+
+
+def _series_digest(label: str, result: dict) -> list[str]:
+    if result.get("error"):
+        return [f"{label}：查询失败（{result.get('message')}）"]
+    lines: list[str] = []
+    for item in result.get("series") or []:
+        values: list[float] = []
+        for _, val in item.get("values") or []:
+            try:
+                values.append(float(val))
+            except Exception:
+                continue
+        values = [v for v in values if v == v]
+        if not values:
+            continue
+        service = (item.get("metric") or {}).get("service", "?")
+        lines.append(
+            f"{label} {service}：均值 {sum(values) / len(values):.3g}，最大 {max(values):.3g}，最新 {values[-1]:.3g}"
+        )
+    return lines or [f"{label}：无数据"]
+
+
+async def prefetch_rca_context(loki: LokiClient, start: datetime, end: datetime, memo: ToolMemo) -> str:
+    """在第一次 LLM 调用前并发拉取默认证据与 RED 指标，写入请求级备忘（同一会话此前轮次已查过的直接复用），并返回供 Agent 输入使用的摘要。"""
+    step = settings.rca_prefetch_step
+    evidence_task = memo.start(
+        evidence_memo_key(start, end),
+        lambda: collect_evidence(loki, start, end),
+    )
+    metric_tasks: dict[str, asyncio.Task] = {}
+    for label, promql in red_queries(settings.rca_known_services).items():
+        metric_tasks[label] = memo.start(
+            memo_key("prometheus_query_range", start, end, promql, step),
+            lambda promql=promql: fetch_prometheus_range(promql, start, end, step),
+            narrow_series,
+        )
+
+    await asyncio.wait([evidence_task, *metric_tasks.values()], timeout=settings.rca_prefetch_timeout_s)
+
+    lines: list[str] = []
+    if evidence_task.done() and not evidence_task.cancelled() and evidence_task.exception() is None:
+        evidence = evidence_task.result()
+        evidence_lines = evidence.get("evidence_lines") or []
+        lines.append(
+            f"- rca_collect_evidence(start_iso={start.isoformat()}, end_iso={end.isoformat()})："
+            f"共 {len(evidence_lines)} 条证据，前 {min(len(evidence_lines), settings.rca_prefetch_digest_lines)} 条："
+        )
+        for line in evidence_lines[: settings.rca_prefetch_digest_lines]:
+            lines.append(f"  {line[:300]}")
+        failed = evidence.get("failed_queries") or []
+        if failed:
+            lines.append(f"  （其中 {len(failed)} 个 Loki 查询在重试后仍失败，证据可能不完整）")
+    for label, task in metric_tasks.items():
+        if not task.done() or task.cancelled() or task.exception() is not None:
+            continue
+        for digest in _series_digest(label, task.result()):
+            lines.append(f"- {digest}")
+    if not lines:
+        logger.info("rca prefetch produced nothing within %.1fs", settings.rca_prefetch_timeout_s)
+        return ""
+    promqls = "；".join(red_queries(settings.rca_known_services).values())
+    return (
+        f"已预取的数据（以相同参数调用工具会直接命中缓存；RED 指标 PromQL：{promqls}，step={step}）：\n"
+        + "\n".join(lines)
+    )
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Hashable
+
+from .settings import settings
+
+
+def ttl_for(end: datetime | float | None) -> float:
+    """查询窗口结束时间早于 now - upstream_cache_settle_s 时数据已不会再变化，使用较长的 TTL。"""
+    if end is None:
+        return settings.upstream_cache_ttl_s
+    end_s = end.timestamp() if isinstance(end, datetime) else float(end)
+    if end_s < time.time() - settings.upstream_cache_settle_s:
+        return settings.upstream_cache_historical_ttl_s
+    return settings.upstream_cache_ttl_s
+
+
+class ResultCache:
+    """进程内 LRU + TTL 的上游查询结果缓存，跨请求复用；返回的对象为共享只读数据，调用方不得修改。"""
+
+    def __init__(self, name: str, max_entries: int):
+        self.name = name
+        self._max_entries = max_entries
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get_or_fetch(self, key: Hashable, ttl_s: float, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        if ttl_s <= 0 or self._max_entries <= 0:
+            return await fetch()
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = await fetch()
+        self._entries[key] = (time.monotonic() + ttl_s, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else None,
+            "evictions": self.evictions,
+        }
+
+
+_caches: dict[str, ResultCache] = {}
+
+
+def get_cache(name: str) -> ResultCache:
+    cache = _caches.get(name)
+    if cache is None:
+        cache = ResultCache(name, settings.upstream_cache_max_entries)
+        _caches[name] = cache
+    return cache
+
+
+def stats() -> dict[str, dict]:
+    return {name: cache.stats() for name, cache in _caches.items()}
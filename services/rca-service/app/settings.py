@@ -13,9 +13,95 @@ class Settings(BaseSettings):
     prometheus_base_url: str = "http://prometheus-server.observability.svc.cluster.local:80"
 
     request_timeout_s: float = 60.0
+    request_budget_s: float = 150.0
+    deadline_reserve_s: float = 8.0
+    upstream_align_s: float = 5.0
+    upstream_cache_ttl_s: float = 30.0
+    upstream_cache_historical_ttl_s: float = 3600.0
+    upstream_cache_settle_s: float = 300.0
+    upstream_cache_max_entries: int = 256
+    upstream_max_retries: int = 2
+    upstream_retry_base_s: float = 0.2
+    upstream_retry_max_s: float = 2.0
+    upstream_hedge_enabled: bool = True
+    upstream_hedge_quantile: float = 0.95
+    upstream_hedge_min_samples: int = 20
+    upstream_hedge_min_delay_s: float = 0.05
+    backend_limit_initial: int = 8
+    backend_limit_min: int = 1
+    backend_limit_max: int = 64
+    backend_limit_tolerance: float = 2.0
+    backend_limit_backoff: float = 0.75
+    backend_limit_baseline_alpha: float = 0.05
+    backend_queue_timeout_s: float = 10.0
+    backend_breaker_failures: int = 5
+    backend_breaker_cooldown_s: float = 15.0
     per_service_log_limit: int = 200
     max_total_evidence_lines: int = 200
 
+    session_backend: str = "memory"
+    session_ttl_s: float = 3600.0
+    session_max_turns: int = 50
+    session_sqlite_path: str = "/tmp/aegis-rca-sessions.db"
+    session_redis_url: str = "redis://localhost:6379/0"
+    session_key_prefix: str = "aegis:rca:session:"
+    memory_mode: str = "buffer"
+    memory_recent_turns: int = 3
+    memory_token_budget: int = 1500
+    memory_fold_batch_turns: int = 2
+    memory_summary_max_tokens: int = 400
+
+    tool_memo_enabled: bool = True
+    tool_memo_fresh_s: float = 30.0
+    tool_memo_settle_s: float = 300.0
+    tool_memo_max_sessions: int = 64
+    tool_memo_max_entries: int = 32
+
+    agent_max_tool_concurrency: int = 4
+
+    job_workers: int = 2
+    job_queue_max_depth: int = 50
+    job_max_queued_per_user: int = 10
+    job_retention_s: float = 3600.0
+    job_events_tail: int = 200
+
+    rca_prefetch_enabled: bool = True
+    rca_known_services: list[str] = ["user-service", "todo-service", "ai-service"]
+    rca_prefetch_timeout_s: float = 15.0
+    rca_prefetch_step: str = "60s"
+    rca_prefetch_digest_lines: int = 40
+
+    rca_pipeline_stage_timeout_s: float = 20.0
+    rca_pipeline_max_evidence_lines: int = 80
+    rca_pipeline_max_line_chars: int = 300
+
+    rca_evidence_ranking: bool = True
+    rca_evidence_baseline: bool = True
+    rca_evidence_max_candidates: int = 10000
+    rca_evidence_max_templates: int = 2000
+    rca_evidence_token_budget: int = 6000
+    rca_evidence_diversity_decay: float = 0.7
+
+    rca_diff_enabled: bool = True
+    rca_diff_baseline_offsets_h: list[float] = [24.0, 168.0]
+    rca_diff_max_services: int = 50
+    rca_diff_line_limit: int = 1000
+    rca_diff_min_count: int = 3
+    rca_diff_min_ratio: float = 3.0
+    rca_diff_min_z: float = 3.0
+    rca_diff_max_patterns: int = 20
+
+    rca_snapshot_enabled: bool = True
+    rca_snapshot_dir: str = "/tmp/aegis-rca-snapshots"
+    rca_snapshot_retention_h: float = 720.0
+    rca_snapshot_max_bytes: int = 512 * 1024 * 1024
+
+    replay_mode: str = "off"
+    replay_dir: str = "/tmp/aegis-rca-replay"
+    replay_fixture: str | None = None
+    replay_speed: float = 1.0
+    replay_latency_ms: float = 0.0
+
     llm_model: str = "doubao-seed-1-6-251015"
     ark_api_key: str | None = None
     ark_base_url: str = "https://ark.cn-beijing.volces.com/api/v3"
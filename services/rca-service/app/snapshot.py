@@ -0,0 +1,338 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, ParamSpec, TypeVar
+
+import numpy as np
+
+from .settings import settings
+from .singleflight import normalize_query
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"AEGISNAP1\n"
+_FOOTER = struct.Struct("<Q10s")
+_KIND_JSON = "json"
+_KIND_STREAMS = "streams"
+_CST = timezone(timedelta(hours=8))
+
+_current: contextvars.ContextVar["Snapshot | None"] = contextvars.ContextVar("evidence_snapshot", default=None)
+_totals = {"hits": 0, "misses": 0, "written": 0, "evicted": 0}
+
+
+def _entry_key(backend: str, path: str, params: dict | None) -> str:
+    items = sorted((k, normalize_query(v) if k == "query" else v) for k, v in (params or {}).items())
+    return json.dumps([backend, path, items], ensure_ascii=False, default=str)
+
+
+def _encode(data: dict) -> tuple[str, bytes]:
+    """Loki 日志流按列编码（流下标、时间戳、行偏移、行内容），其余响应保存为 JSON；两者都经 zlib 压缩。"""
+    body = data.get("data")
+    if not isinstance(body, dict) or body.get("resultType") != "streams":
+        return _KIND_JSON, zlib.compress(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+    streams: list[dict] = []
+    idx: list[int] = []
+    stamps: list[int] = []
+    lines: list[bytes] = []
+    for item in body.get("result") or []:
+        streams.append(item.get("stream") or {})
+        for ts, line in item.get("values") or []:
+            idx.append(len(streams) - 1)
+            stamps.append(int(ts))
+            lines.append(line.encode("utf-8"))
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    if lines:
+        np.cumsum([len(b) for b in lines], out=offsets[1:])
+    header = json.dumps({"status": data.get("status"), "streams": streams, "n": len(lines)}, ensure_ascii=False).encode("utf-8")
+    payload = b"".join(
+        [
+            struct.pack("<I", len(header)),
+            header,
+            np.asarray(idx, dtype=np.int32).tobytes(),
+            np.asarray(stamps, dtype=np.int64).tobytes(),
+            offsets.tobytes(),
+            b"".join(lines),
+        ]
+    )
+    return _KIND_STREAMS, zlib.compress(payload)
+
+
+def _decode(kind: str, blob: bytes) -> dict:
+    raw = zlib.decompress(blob)
+    if kind == _KIND_JSON:
+        return json.loads(raw)
+    (hlen,) = struct.unpack_from("<I", raw)
+    header = json.loads(raw[4 : 4 + hlen])
+    n = header["n"]
+    pos = 4 + hlen
+    idx = np.frombuffer(raw, dtype=np.int32, count=n, offset=pos)
+    pos += 4 * n
+    stamps = np.frombuffer(raw, dtype=np.int64, count=n, offset=pos)
+    pos += 8 * n
+    offsets = np.frombuffer(raw, dtype=np.int64, count=n + 1, offset=pos)
+    pos += 8 * (n + 1)
+    text = memoryview(raw)[pos:]
+    result = [{"stream": stream, "values": []} for stream in header["streams"]]
+    for i, ts, lo, hi in zip(idx.tolist(), stamps.tolist(), offsets[:-1].tolist(), offsets[1:].tolist()):
+        result[i]["values"].append([str(ts), bytes(text[lo:hi]).decode("utf-8")])
+    return {"status": header["status"], "data": {"resultType": "streams", "result": result}}
+
+
+class _Archive:
+    """只读打开的快照文件：内存映射整个文件，条目按需解压。
+
+    布局：魔数 | 各条目的压缩块 | 索引 JSON | 尾部（索引长度 + 魔数）。
+    """
+
+    def __init__(self, path: Path):
+        self._fh = open(path, "rb")
+        try:
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._fh.close()
+            raise
+        size = len(self._mm)
+        if size < len(_MAGIC) + _FOOTER.size or self._mm[: len(_MAGIC)] != _MAGIC:
+            self.close()
+            raise ValueError(f"不是有效的快照文件：{path}")
+        index_len, magic = _FOOTER.unpack_from(self._mm, size - _FOOTER.size)
+        if magic != _MAGIC:
+            self.close()
+            raise ValueError(f"快照文件不完整：{path}")
+        index_at = size - _FOOTER.size - index_len
+        index = json.loads(self._mm[index_at : size - _FOOTER.size])
+        self.meta: dict = index["meta"]
+        self.entries: dict[str, list] = index["entries"]
+
+    def blob(self, key: str) -> tuple[str, bytes] | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        kind, offset, length = entry
+        return kind, self._mm[offset : offset + length]
+
+    def close(self) -> None:
+        if getattr(self, "_mm", None) is not None:
+            self._mm.close()
+            self._mm = None
+        self._fh.close()
+
+
+def _write(path: Path, meta: dict, blobs: dict[str, tuple[str, bytes]]) -> int:
+    tmp = path.with_suffix(f".tmp{os.getpid()}")
+    entries: dict[str, list] = {}
+    with open(tmp, "wb") as fh:
+        fh.write(_MAGIC)
+        offset = len(_MAGIC)
+        for key, (kind, blob) in blobs.items():
+            fh.write(blob)
+            entries[key] = [kind, offset, len(blob)]
+            offset += len(blob)
+        index = json.dumps({"meta": meta, "entries": entries}, ensure_ascii=False).encode("utf-8")
+        fh.write(index)
+        fh.write(_FOOTER.pack(len(index), _MAGIC))
+        size = fh.tell()
+    os.replace(tmp, path)
+    return size
+
+
+def _enforce_budget(directory: Path, keep: Path) -> None:
+    """删除超过保留期的快照，再按最近使用时间从旧到新删除，直到总大小不超过预算。"""
+    cutoff = time.time() - settings.rca_snapshot_retention_h * 3600
+    files = []
+    for p in directory.glob("*.snap"):
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        if st.st_mtime < cutoff:
+            p.unlink(missing_ok=True)
+            _totals["evicted"] += 1
+            continue
+        files.append((st.st_mtime, st.st_size, p))
+    total = sum(size for _, size, _ in files)
+    # 刚写入的快照最后才考虑删除：只有它自己就超出预算时才删
+    for _, size, p in sorted(files, key=lambda f: (f[2] == keep, f[0])):
+        if total <= settings.rca_snapshot_max_bytes:
+            break
+        p.unlink(missing_ok=True)
+        _totals["evicted"] += 1
+        total -= size
+
+
+def _as_utc(dt: datetime) -> datetime:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=_CST)
+    return dt.astimezone(timezone.utc)
+
+
+class Snapshot:
+    """一次故障（incident_id + 时间范围）的证据快照：命中的上游查询直接从归档读取，未命中的照常查询并在会话结束时追加。"""
+
+    def __init__(self, incident_id: str | None, start: datetime, end: datetime):
+        start, end = _as_utc(start), _as_utc(end)
+        digest = hashlib.sha1(f"{incident_id or ''}|{start.isoformat()}|{end.isoformat()}".encode("utf-8")).hexdigest()
+        prefix = re.sub(r"[^\w.-]", "_", incident_id)[:60] if incident_id else "window"
+        self.id = f"{prefix}-{digest[:16]}"
+        self.path = Path(settings.rca_snapshot_dir) / f"{self.id}.snap"
+        self.meta = {
+            "incident_id": incident_id,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        self.hits = 0
+        self.misses = 0
+        self._archive: _Archive | None = None
+        self._pending: dict[str, tuple[str, bytes]] = {}
+
+    def open(self) -> None:
+        try:
+            self._archive = _Archive(self.path)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError):
+            logger.warning("snapshot unreadable, ignoring path=%s", self.path, exc_info=True)
+            return
+        self.meta = self._archive.meta
+        os.utime(self.path)
+
+    def get(self, key: str) -> dict | None:
+        found = self._pending.get(key)
+        if found is None and self._archive is not None:
+            found = self._archive.blob(key)
+        if found is None:
+            return None
+        return _decode(*found)
+
+    def put(self, key: str, data: dict) -> None:
+        self._pending[key] = _encode(data)
+
+    def save(self) -> None:
+        if not self._pending:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        blobs: dict[str, tuple[str, bytes]] = {}
+        # 重新打开磁盘上的最新版本再合并，减少并发分析同一故障时互相覆盖
+        try:
+            latest = _Archive(self.path)
+        except (OSError, ValueError, KeyError):
+            latest = None
+        try:
+            if latest is not None:
+                self.meta = latest.meta
+                for key in latest.entries:
+                    kind, blob = latest.blob(key)
+                    blobs[key] = (kind, bytes(blob))
+            blobs.update(self._pending)
+            size = _write(self.path, self.meta, blobs)
+        finally:
+            if latest is not None:
+                latest.close()
+        _totals["written"] += 1
+        logger.info("snapshot saved id=%s entries=%d bytes=%d", self.id, len(blobs), size)
+        _enforce_budget(self.path.parent, self.path)
+
+    def close(self) -> None:
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def info(self) -> dict:
+        return {
+            "id": self.id,
+            "created_at": self.meta.get("created_at"),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _settled(end: datetime | float | None) -> bool:
+    if end is None:
+        return True
+    end_s = end.timestamp() if isinstance(end, datetime) else float(end)
+    return end_s < time.time() - settings.upstream_cache_settle_s
+
+
+def info() -> dict | None:
+    snap = _current.get()
+    return snap.info() if snap is not None else None
+
+
+def session(fn: Callable[P, Awaitable[R]]) -> Callable[P, Awaitable[R]]:
+    """按请求的 incident_id 与时间范围打开证据快照；会话结束后把新查到的、已稳定的结果写回。"""
+
+    @functools.wraps(fn)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        req = args[0] if args else None
+        time_range = getattr(req, "time_range", None)
+        if not settings.rca_snapshot_enabled or settings.replay_mode != "off" or time_range is None:
+            return await fn(*args, **kwargs)
+        snap = Snapshot(getattr(req, "incident_id", None), time_range.start, time_range.end)
+        await asyncio.to_thread(snap.open)
+        token = _current.set(snap)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+            _totals["hits"] += snap.hits
+            _totals["misses"] += snap.misses
+            try:
+                await asyncio.to_thread(snap.save)
+            except OSError:
+                logger.warning("snapshot save failed id=%s", snap.id, exc_info=True)
+            finally:
+                snap.close()
+
+    return wrapper
+
+
+async def upstream(
+    backend: str,
+    path: str,
+    params: dict | None,
+    end: datetime | float | None,
+    fetch: Callable[[], Awaitable[dict]],
+) -> dict:
+    """命中快照时直接返回归档的响应；否则调用 fetch，并在查询窗口已稳定（不会再有新数据）时记入快照。"""
+    snap = _current.get()
+    if snap is None:
+        return await fetch()
+    key = _entry_key(backend, path, params)
+    cached = snap.get(key)
+    if cached is not None:
+        snap.hits += 1
+        return cached
+    snap.misses += 1
+    data = await fetch()
+    if _settled(end) and data.get("status", "success") == "success":
+        snap.put(key, data)
+    return data
+
+
+def stats() -> dict:
+    directory = Path(settings.rca_snapshot_dir)
+    files = list(directory.glob("*.snap")) if directory.is_dir() else []
+    return {
+        "files": len(files),
+        "bytes": sum(p.stat().st_size for p in files if p.exists()),
+        "max_bytes": settings.rca_snapshot_max_bytes,
+        **_totals,
+    }
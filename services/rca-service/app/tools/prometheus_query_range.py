@@ -1,11 +1,16 @@
 from __future__ import annotations
 
+import re
 from datetime import datetime, timezone
 
 import httpx
 from langchain_core.tools import tool
 
+from .. import metrics, replay, resilience, result_cache, snapshot
+from ..backpressure import BackendUnavailable, get_guard
 from ..settings import settings
+from ..singleflight import align_range, get_group, normalize_query
+from .memo import memo_key, memoized
 
 
 def _parse_dt(iso: str) -> datetime:
@@ -15,38 +20,93 @@ def _parse_dt(iso: str) -> datetime:
     return dt.astimezone(timezone.utc)
 
 
-@tool(
-    "prometheus_query_range",
-    description="按时间范围执行 PromQL 查询，返回时间序列数据及原始结果概要，适用于 Todo_List 项目的服务健康与资源分析。",
-)
-async def prometheus_query_range(
-    promql: str,
-    start_iso: str,
-    end_iso: str,
-    step: str = "60s",
-) -> dict:
-    try:
-        start = _parse_dt(start_iso)
-        end = _parse_dt(end_iso)
-    except Exception as exc:
-        return {
-            "error": "invalid_datetime",
-            "message": str(exc),
-            "promql": promql,
-            "start_raw": start_iso,
-            "end_raw": end_iso,
-        }
+_flight = get_group("prometheus")
+_cache = result_cache.get_cache("prometheus")
+
+
+async def _fetch(params: dict) -> dict:
+    return await resilience.call(
+        "prometheus.query_range",
+        lambda timeout_s: _attempt(params, timeout_s),
+        settings.request_timeout_s,
+    )
+
+
+async def _attempt(params: dict, timeout_s: float) -> dict:
+    async with get_guard("prometheus").slot():
+        with metrics.upstream_call("prometheus", "query_range") as call:
+            async with httpx.AsyncClient(timeout=timeout_s) as client:
+                r = await client.get(f"{settings.prometheus_base_url.rstrip('/')}/api/v1/query_range", params=params)
+            call["bytes"] = len(r.content)
+            r.raise_for_status()
+            return r.json()
+
+
+_STEP = re.compile(r"^(\d+(?:\.\d+)?)(ms|s|m|h|d)?$")
+_STEP_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0, "d": 86400.0}
+
+
+def _step_s(step: str) -> float | None:
+    m = _STEP.match(step.strip())
+    if m is None:
+        return None
+    return float(m.group(1)) * _STEP_UNITS[m.group(2) or "s"]
+
+
+def narrow_series(result: dict, start: datetime, end: datetime) -> dict | None:
+    """从覆盖更大时间范围的查询结果中截取 [start, end] 的样本点；两次查询的采样点不对齐时返回 None。"""
+    step = _step_s(str(result.get("step") or ""))
+    if not step or result.get("result_type") != "matrix":
+        return None
+    cached_start, _ = align_range(_parse_dt(result["start"]), _parse_dt(result["end"]), settings.upstream_align_s)
+    q_start, q_end = align_range(start, end, settings.upstream_align_s)
+    lo, hi = q_start.timestamp(), q_end.timestamp()
+    offset = (lo - cached_start.timestamp()) / step
+    if abs(offset - round(offset)) > 1e-6:
+        return None
+    series = []
+    for item in result.get("series") or []:
+        values = [[ts, val] for ts, val in item.get("values") or [] if lo <= float(ts) <= hi]
+        if values:
+            series.append({"metric": item.get("metric") or {}, "values": values})
+    return {**result, "start": start.isoformat(), "end": end.isoformat(), "series": series}
+
+
+def _reshape_series(data: dict) -> list[dict]:
+    series = []
+    for item in data.get("data", {}).get("result", []) or []:
+        metric = item.get("metric", {}) or {}
+        values = []
+        for ts, val in item.get("values") or []:
+            values.append([ts, val])
+        series.append({"metric": metric, "values": values})
+    return series
+
+
+async def fetch_prometheus_range(promql: str, start: datetime, end: datetime, step: str = "60s") -> dict:
+    q_start, q_end = align_range(start, end, settings.upstream_align_s)
     params = {
         "query": promql,
-        "start": start.isoformat(),
-        "end": end.isoformat(),
+        "start": q_start.isoformat(),
+        "end": q_end.isoformat(),
         "step": step,
     }
+    key = (normalize_query(promql), params["start"], params["end"], step)
     try:
-        async with httpx.AsyncClient(timeout=settings.request_timeout_s) as client:
-            r = await client.get(f"{settings.prometheus_base_url.rstrip('/')}/api/v1/query_range", params=params)
-        r.raise_for_status()
-        data = r.json()
+        data = await replay.upstream(
+            "prometheus",
+            "/api/v1/query_range",
+            params,
+            lambda: snapshot.upstream(
+                "prometheus",
+                "/api/v1/query_range",
+                params,
+                q_end,
+                lambda: _cache.get_or_fetch(key, result_cache.ttl_for(q_end), lambda: _flight.do(key, lambda: _fetch(params))),
+            ),
+        )
+    except BackendUnavailable as exc:
+        return {**exc.observation(), "promql": promql, "start": start.isoformat(), "end": end.isoformat(), "step": step}
     except Exception as exc:
         return {
             "error": "prometheus_request_failed",
@@ -56,18 +116,39 @@ async def prometheus_query_range(
             "end": end.isoformat(),
             "step": step,
         }
-    series = []
-    for item in data.get("data", {}).get("result", []) or []:
-        metric = item.get("metric", {}) or {}
-        values = []
-        for ts, val in item.get("values") or []:
-            values.append([ts, val])
-        series.append({"metric": metric, "values": values})
     return {
         "promql": promql,
         "start": start.isoformat(),
         "end": end.isoformat(),
         "step": step,
         "result_type": data.get("data", {}).get("resultType"),
-        "series": series,
+        "series": _reshape_series(data),
     }
+
+
+@tool(
+    "prometheus_query_range",
+    description="按时间范围执行 PromQL 查询，返回时间序列数据及原始结果概要，适用于 Todo_List 项目的服务健康与资源分析。",
+)
+async def prometheus_query_range(
+    promql: str,
+    start_iso: str,
+    end_iso: str,
+    step: str = "60s",
+) -> dict:
+    try:
+        start = _parse_dt(start_iso)
+        end = _parse_dt(end_iso)
+    except Exception as exc:
+        return {
+            "error": "invalid_datetime",
+            "message": str(exc),
+            "promql": promql,
+            "start_raw": start_iso,
+            "end_raw": end_iso,
+        }
+    return await memoized(
+        memo_key("prometheus_query_range", start, end, promql, step),
+        lambda: fetch_prometheus_range(promql, start, end, step),
+        narrow_series,
+    )
@@ -1,11 +1,17 @@
 from __future__ import annotations
 
+import asyncio
 from datetime import datetime, timezone
 
 from langchain_core.tools import tool
 
+from ..backpressure import BackendUnavailable
+from ..evidence_rank import EvidenceRanker
+from ..log_normalize import annotate, line_fingerprint, ts_of
+from ..logql import quote, regex_error
 from ..loki_client import LokiClient
 from ..settings import settings
+from .memo import memo_key, memoized
 
 
 def _parse_dt(iso: str) -> datetime:
@@ -32,6 +38,221 @@ def _prioritize_services(all_services: list[str], patterns: list[str] | None, ma
     return selected[:max_services]
 
 
+def _describe(exc: Exception) -> str:
+    return f"{type(exc).__name__}: {exc}"[:300]
+
+
+ERROR_REGEX = (
+    r'(?i)('
+    r'error|exception|traceback|panic|fatal|timeout|'
+    r'unauthorized|forbidden|denied|permission denied|'
+    r'authentication failed|login failed|invalid password|'
+    r'4\d\d|5\d\d|'
+    r'connection refused|connection reset'
+    r')'
+)
+
+
+DEFAULT_MAX_SERVICES = 50
+DEFAULT_PER_SERVICE_LOG_LIMIT = 200
+DEFAULT_MAX_TOTAL_LINES = 200
+
+
+def evidence_memo_key(
+    start: datetime,
+    end: datetime,
+    max_services: int = DEFAULT_MAX_SERVICES,
+    per_service_log_limit: int = DEFAULT_PER_SERVICE_LOG_LIMIT,
+    max_total_lines: int = DEFAULT_MAX_TOTAL_LINES,
+    service_patterns: list[str] | None = None,
+    text_patterns: list[str] | None = None,
+) -> tuple:
+    """工具调用与预取共用的备忘键，保证默认参数的调用命中同一条结果。"""
+    return memo_key(
+        "rca_collect_evidence",
+        start,
+        end,
+        max_services,
+        per_service_log_limit,
+        max_total_lines,
+        service_patterns or [],
+        text_patterns or [],
+    )
+
+
+def _selector(service: str) -> str:
+    return settings.loki_selector_template.format(label_key=settings.loki_service_label_key, service=service)
+
+
+def _empty_evidence(failed_queries: list[dict]) -> list[str]:
+    if failed_queries:
+        return [f"Loki 查询失败 {len(failed_queries)} 次，未能收集到日志证据（见 failed_queries），不能据此判断无错误。"]
+    return ["在该时间范围内未检索到明显的错误或相关日志（基于通用error正则与关键词搜索）。"]
+
+
+async def _collect_ranked(
+    loki: LokiClient,
+    start: datetime,
+    end: datetime,
+    services: list[str],
+    extra_patterns: list[str],
+    per_service_log_limit: int,
+    max_total_lines: int,
+    failed_queries: list[dict],
+) -> dict:
+    """并发拉取各服务的候选日志（及等长的前一窗口作为基线），按稀有度与严重度挑选证据，而不是按服务顺序先到先得。"""
+    ranker = EvidenceRanker(
+        settings.rca_evidence_max_templates,
+        settings.rca_evidence_diversity_decay,
+        max(1, settings.rca_evidence_max_candidates // max(1, len(services))),
+    )
+    # 打分是纯 CPU 计算（每行数十微秒），放到线程里执行以免阻塞事件循环；ranker 非线程安全，用锁串行化
+    rank_lock = asyncio.Lock()
+
+    def absorb(service: str, lines: list[str], baseline: bool) -> None:
+        for line in lines:
+            if baseline:
+                ranker.add_baseline(line)
+            else:
+                ranker.add(service, line)
+
+    queries: list[tuple[str, str, bool]] = []
+    for service in services:
+        selector = _selector(service)
+        queries.append((service, f"{selector} |~ {quote(ERROR_REGEX)}", False))
+        for pat in extra_patterns:
+            queries.append((service, f"{selector} |~ {quote(pat)}", False))
+        if settings.rca_evidence_baseline:
+            queries.append((service, f"{selector} |~ {quote(ERROR_REGEX)}", True))
+
+    async def run(service: str, query: str, baseline: bool) -> None:
+        q_start, q_end = (start - (end - start), start) if baseline else (start, end)
+        try:
+            res = await loki.query_range(query, start=q_start, end=q_end, limit=per_service_log_limit)
+        except Exception as exc:
+            failed_queries.append({"service": service, "query": query, "baseline": baseline, "error": _describe(exc)})
+            return
+        lines = res.flatten_log_lines(limit=per_service_log_limit)
+        async with rank_lock:
+            await asyncio.to_thread(absorb, service, lines, baseline)
+
+    await asyncio.gather(*(run(*q) for q in queries))
+    evidence_lines, tokens = await asyncio.to_thread(ranker.select, max_total_lines, settings.rca_evidence_token_budget)
+    return {
+        "services": services,
+        "evidence_lines": evidence_lines or _empty_evidence([q for q in failed_queries if not q.get("baseline")]),
+        "failed_queries": failed_queries,
+        "ranking": {
+            "candidate_lines": ranker.candidates,
+            "dropped_candidates": ranker.dropped,
+            "templates": ranker.templates,
+            "baseline_lines": ranker.baseline_lines,
+            "estimated_tokens": tokens,
+        },
+        "loki_api": {"path": "/loki/api/v1/query_range"},
+    }
+
+
+async def collect_evidence(
+    loki: LokiClient,
+    start: datetime,
+    end: datetime,
+    max_services: int = DEFAULT_MAX_SERVICES,
+    per_service_log_limit: int = DEFAULT_PER_SERVICE_LOG_LIMIT,
+    max_total_lines: int = DEFAULT_MAX_TOTAL_LINES,
+    service_patterns: list[str] | None = None,
+    text_patterns: list[str] | None = None,
+) -> dict:
+    failed_queries: list[dict] = []
+    try:
+        all_services = await loki.label_values(settings.loki_service_label_key)
+    except Exception as exc:
+        all_services = []
+        failed_queries.append({"query": f"label_values({settings.loki_service_label_key})", "error": _describe(exc)})
+
+    services = _prioritize_services(all_services, service_patterns, max_services)
+    error_regex = ERROR_REGEX
+    extra_patterns: list[str] = []
+    rejected: dict = {}
+    for pat in text_patterns or []:
+        problem = regex_error(pat) if pat else None
+        if problem is not None:
+            rejected.setdefault("invalid_patterns", []).append({"pattern": pat, "error": problem})
+        elif pat:
+            extra_patterns.append(pat)
+    if settings.rca_evidence_ranking:
+        result = await _collect_ranked(
+            loki, start, end, services, extra_patterns, per_service_log_limit, max_total_lines, failed_queries
+        )
+        return {**result, **rejected}
+
+    # 归一化指纹 -> [行下标, 次数, 最早时间, 最晚时间]；近似重复的行只保留首条，其余只累计次数与时间范围
+    kept: dict[int, list] = {}
+    seen: set[int] = set()
+    evidence_lines: list[str] = []
+    backend_down = False
+
+    def absorb(lines: list[str]) -> None:
+        for line in lines:
+            digest = hash(line)
+            if digest in seen:
+                continue
+            seen.add(digest)
+            key = line_fingerprint(line)
+            ts = ts_of(line)
+            slot = kept.get(key)
+            if slot is not None:
+                slot[1] += 1
+                if ts is not None:
+                    slot[2] = ts if slot[2] is None else min(slot[2], ts)
+                    slot[3] = ts if slot[3] is None else max(slot[3], ts)
+                continue
+            if len(evidence_lines) >= max_total_lines:
+                continue
+            kept[key] = [len(evidence_lines), 1, ts, ts]
+            evidence_lines.append(line)
+
+    for service in services:
+        selector = _selector(service)
+        query = f"{selector} |~ {quote(error_regex)}"
+        try:
+            res = await loki.query_range(query, start=start, end=end, limit=per_service_log_limit)
+            absorb(res.flatten_log_lines(limit=per_service_log_limit))
+        except Exception as exc:
+            failed_queries.append({"service": service, "query": query, "error": _describe(exc)})
+            backend_down = isinstance(exc, BackendUnavailable)
+        if backend_down or len(evidence_lines) >= max_total_lines:
+            break
+
+        for pat in extra_patterns:
+            extra_query = f"{selector} |~ {quote(pat)}"
+            try:
+                res2 = await loki.query_range(extra_query, start=start, end=end, limit=per_service_log_limit)
+                absorb(res2.flatten_log_lines(limit=per_service_log_limit))
+            except Exception as exc:
+                failed_queries.append({"service": service, "query": extra_query, "error": _describe(exc)})
+                backend_down = isinstance(exc, BackendUnavailable)
+                if backend_down:
+                    break
+                continue
+            if len(evidence_lines) >= max_total_lines:
+                break
+        if backend_down or len(evidence_lines) >= max_total_lines:
+            break
+
+    for index, count, first_ns, last_ns in kept.values():
+        evidence_lines[index] = annotate(evidence_lines[index], count, first_ns, last_ns)
+    if not evidence_lines:
+        evidence_lines = _empty_evidence(failed_queries)
+    return {
+        "services": services,
+        "evidence_lines": evidence_lines[:max_total_lines],
+        "failed_queries": failed_queries,
+        "loki_api": {"path": "/loki/api/v1/query_range"},
+        **rejected,
+    }
+
+
 def make_rca_collect_evidence(loki: LokiClient):
     @tool(
         "rca_collect_evidence",
@@ -44,81 +265,28 @@ def make_rca_collect_evidence(loki: LokiClient):
     async def rca_collect_evidence(
         start_iso: str,
         end_iso: str,
-        max_services: int = 50,
-        per_service_log_limit: int = 200,
-        max_total_lines: int = 200,
+        max_services: int = DEFAULT_MAX_SERVICES,
+        per_service_log_limit: int = DEFAULT_PER_SERVICE_LOG_LIMIT,
+        max_total_lines: int = DEFAULT_MAX_TOTAL_LINES,
         service_patterns: list[str] | None = None,
         text_patterns: list[str] | None = None,
     ) -> dict:
         start = _parse_dt(start_iso)
         end = _parse_dt(end_iso)
-        try:
-            all_services = await loki.label_values(settings.loki_service_label_key)
-        except Exception:
-            all_services = []
-
-        services = _prioritize_services(all_services, service_patterns, max_services)
-
-        error_regex = (
-            r'(?i)('
-            r'error|exception|traceback|panic|fatal|timeout|'
-            r'unauthorized|forbidden|denied|permission denied|'
-            r'authentication failed|login failed|invalid password|'
-            r'4\d\d|5\d\d|'
-            r'connection refused|connection reset'
-            r')'
+        return await memoized(
+            evidence_memo_key(
+                start, end, max_services, per_service_log_limit, max_total_lines, service_patterns, text_patterns
+            ),
+            lambda: collect_evidence(
+                loki,
+                start,
+                end,
+                max_services=max_services,
+                per_service_log_limit=per_service_log_limit,
+                max_total_lines=max_total_lines,
+                service_patterns=service_patterns,
+                text_patterns=text_patterns,
+            ),
         )
-        extra_patterns = [p for p in (text_patterns or []) if p]
-
-        seen: set[str] = set()
-        evidence_lines: list[str] = []
-
-        for service in services:
-            selector = settings.loki_selector_template.format(
-                label_key=settings.loki_service_label_key,
-                service=service,
-            )
-            query = f'{selector} |~ "{error_regex}"'
-            try:
-                res = await loki.query_range(query, start=start, end=end, limit=per_service_log_limit)
-                lines = res.flatten_log_lines(limit=per_service_log_limit)
-                for line in lines:
-                    if line not in seen:
-                        seen.add(line)
-                        evidence_lines.append(line)
-                        if len(evidence_lines) >= max_total_lines:
-                            break
-            except Exception:
-                pass
-            if len(evidence_lines) >= max_total_lines:
-                break
-
-            for pat in extra_patterns:
-                safe_pat = pat.replace('"', '\\"')
-                extra_query = f'{selector} |~ "{safe_pat}"'
-                try:
-                    res2 = await loki.query_range(extra_query, start=start, end=end, limit=per_service_log_limit)
-                    lines2 = res2.flatten_log_lines(limit=per_service_log_limit)
-                    for line in lines2:
-                        if line not in seen:
-                            seen.add(line)
-                            evidence_lines.append(line)
-                            if len(evidence_lines) >= max_total_lines:
-                                break
-                except Exception:
-                    continue
-                if len(evidence_lines) >= max_total_lines:
-                    break
-            if len(evidence_lines) >= max_total_lines:
-                break
-
-        if not evidence_lines:
-            evidence_lines = ["在该时间范围内未检索到明显的错误或相关日志（基于通用error正则与关键词搜索）。"]
-        return {
-            "services": services,
-            "evidence_lines": evidence_lines[:max_total_lines],
-            "loki_api": {"path": "/loki/api/v1/query_range"},
-        }
 
     return rca_collect_evidence
-
@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+from app.evidence_rank import EvidenceRanker
+
+
+def test_exact_duplicates_are_counted_once():
+    ranker = EvidenceRanker()
+    ranker.add("user", "ERROR db timeout id=1")
+    ranker.add("user", "ERROR db timeout id=1")
+    assert ranker.candidates == 1
+
+
+def test_candidates_are_capped_per_service_and_drops_reported():
+    ranker = EvidenceRanker(max_per_service=100)
+    # 先到的服务大量返回，不应挤掉后到服务的候选
+    for i in range(1000):
+        ranker.add("noisy", f"ERROR request {i} failed: code {i % 7}")
+    for i in range(50):
+        ranker.add("quiet", f"ERROR db pool exhausted {i}")
+    assert ranker.candidates == 150
+    assert ranker.dropped == 900
+    assert len(ranker._seen) == 150
+
+
+def test_rare_fatal_line_ranks_first():
+    ranker = EvidenceRanker()
+    for i in range(50):
+        ranker.add("todo", f"WARN slow query took {i}ms")
+    ranker.add("auth", "FATAL panic: nil pointer dereference")
+    lines, _ = ranker.select(1, 6000)
+    assert lines and lines[0].startswith("FATAL panic")
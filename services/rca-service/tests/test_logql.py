@@ -0,0 +1,14 @@
+from __future__ import annotations
+
+from app.logql import quote, regex_error
+
+
+def test_regex_error_only_flags_unsupported_re2_syntax():
+    for ok in [r"\d+\++", r"timeout|refused", r"foo\z", r"\Q(?=\E", r"\pL+"]:
+        assert regex_error(ok) is None, ok
+    for bad in [r"a++", r"(?!x)", r"(a)\1"]:
+        assert regex_error(bad) is not None, bad
+
+
+def test_quote_escapes_go_string():
+    assert quote('say "hi" \\d') == '"say \\"hi\\" \\\\d"'
@@ -0,0 +1,17 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+from app.tools.rca_collect_evidence import evidence_memo_key, make_rca_collect_evidence
+
+
+def test_prefetch_key_matches_tool_call_with_defaults():
+    start = datetime(2026, 6, 1, 4, 0, tzinfo=timezone.utc)
+    end = datetime(2026, 6, 1, 4, 30, tzinfo=timezone.utc)
+    tool = make_rca_collect_evidence(loki=None)
+    defaults = {
+        name: field.default
+        for name, field in tool.args_schema.model_fields.items()
+        if name not in ("start_iso", "end_iso")
+    }
+    assert evidence_memo_key(start, end, **defaults) == evidence_memo_key(start, end)